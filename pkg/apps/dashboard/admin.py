@@ -1,3 +1,100 @@
+from django.conf import settings
 from django.contrib import admin
+from django.utils.html import format_html, format_html_join
+from django.utils.translation import gettext_lazy as _
 
-# Register your models here.
+from . import models
+from .services import rate_limits, tracing
+
+SPAN_COLORS = {
+    "queue": "#bbb",
+    "llm": "#79aec8",
+    "tool": "#9c6",
+    "sql": "#e9a23b",
+    "agent": "#dde",
+}
+
+
+def _format_state(state):
+    return ", ".join(f"{kind}: {level}/{limit}" for kind, (level, limit) in state.items()) or "-"
+
+
+@admin.register(models.Data)
+class DataAdmin(admin.ModelAdmin):
+    list_display = ("title", "user", "protocol", "is_db", "is_api", "data_rate_limit", "user_rate_limit", "running_questions")
+    list_filter = ("is_db", "is_api", "protocol")
+    search_fields = ("title", "db_name", "user__email")
+    readonly_fields = ("schema_hash", "schema_refreshed_at", "spec_hash", "spec_refreshed_at", "data_rate_limit", "user_rate_limit", "running_questions")
+    exclude = ("schema",)
+
+    @admin.display(description=_("Source rate limit"))
+    def data_rate_limit(self, obj):
+        return _format_state(rate_limits.state("data", obj.id))
+
+    @admin.display(description=_("Owner rate limit"))
+    def user_rate_limit(self, obj):
+        return _format_state(rate_limits.state("user", obj.user_id))
+
+    @admin.display(description=_("Running questions"))
+    def running_questions(self, obj):
+        return rate_limits.running(obj.user_id)
+
+
+@admin.register(models.Crawl)
+class CrawlAdmin(admin.ModelAdmin):
+    list_display = ("crawler_name", "data", "state", "polls", "started_at", "finished_at")
+    list_filter = ("state",)
+    search_fields = ("crawler_name", "identifier", "glue_db_name")
+    readonly_fields = ("polls", "next_poll_at", "started_at", "finished_at", "error_message")
+
+
+@admin.register(models.Trace)
+class TraceAdmin(admin.ModelAdmin):
+    change_list_template = "admin/dashboard/trace/change_list.html"
+    list_display = ("started_at", "data", "question", "path", "status", "duration_ms")
+    list_filter = ("status", "path", "model")
+    search_fields = ("question",)
+    date_hierarchy = "started_at"
+    list_select_related = ("data",)
+    exclude = ("spans",)
+    readonly_fields = (
+        "data", "user", "message", "question", "model", "path", "status", "started_at", "duration_ms", "waterfall",
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description=_("Waterfall"))
+    def waterfall(self, obj):
+        total = max(obj.duration_ms, 1)
+        rows = (
+            (
+                kind,
+                name or "",
+                f"{duration:,.1f} ms",
+                ", ".join(f"{key}={value}" for key, value in (attributes or {}).items()),
+                f"{min(start / total * 100, 100):.2f}",
+                f"{max(min(duration / total * 100, 100 - start / total * 100), 0.2):.2f}",
+                SPAN_COLORS.get(kind, "#aaa"),
+            )
+            for kind, name, start, duration, attributes in sorted(obj.spans, key=lambda span: span[2])
+        )
+        return format_html(
+            '<table style="width:100%">{}</table>',
+            format_html_join(
+                "",
+                '<tr><td>{}</td><td>{}</td><td style="white-space:nowrap">{}</td><td>{}</td>'
+                '<td style="width:50%"><div style="position:relative;height:12px">'
+                '<div style="position:absolute;left:{}%;width:{}%;height:100%;background:{}"></div>'
+                "</div></td></tr>",
+                rows,
+            ),
+        )
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        changelist = getattr(response, "context_data", {}).get("cl")
+        if changelist is not None:
+            traces = changelist.queryset.values_list("duration_ms", "spans")[:settings.TRACE_STATS_WINDOW]
+            response.context_data["span_percentiles"] = sorted(tracing.percentiles(traces).items())
+        return response
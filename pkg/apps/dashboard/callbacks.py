@@ -0,0 +1,308 @@
+import abc
+import asyncio
+import time
+import uuid
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.callbacks.openai_info import MODEL_COST_PER_1K_TOKENS, get_openai_token_cost_for_model, standardize_model_name
+
+from .services import cancellation, rate_limits
+
+
+class ChannelStreamHandler(BaseCallbackHandler):
+    """
+    Forwards LLM tokens and agent steps of one question to the chat group as
+    `chat_stream` frames. Tokens are batched and flushed every `flush_interval`
+    seconds so a fast model doesn't flood the channel layer with one message per token.
+    """
+    def __init__(self, data_id, stream_id=None, flush_interval=0.05):
+        self.group_name = f"chat_{data_id}"
+        self.stream_id = stream_id or uuid.uuid4().hex
+        self.flush_interval = flush_interval
+        self.channel_layer = get_channel_layer()
+        self._buffer = []
+        self._last_flush = 0
+
+    def _frame(self, kind, text):
+        return {
+            "type": "chat_stream",
+            "stream_id": self.stream_id,
+            "kind": kind,
+            "text": text,
+        }
+
+    def _commit_frame(self, msg_id):
+        return {
+            "type": "chat_message",
+            "msg_id": msg_id,
+            "stream_id": self.stream_id,
+        }
+
+    def _due(self):
+        return time.monotonic() - self._last_flush >= self.flush_interval
+
+    def send(self, kind, text):
+        async_to_sync(self.channel_layer.group_send)(self.group_name, self._frame(kind, text))
+
+    def flush(self):
+        if self._buffer:
+            self.send("token", "".join(self._buffer))
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        # Flush immediately on the first token of each call for a fast first paint
+        self._last_flush = 0
+
+    def on_llm_new_token(self, token, **kwargs):
+        self._buffer.append(token)
+        if self._due():
+            self.flush()
+
+    def on_llm_end(self, response, **kwargs):
+        self.flush()
+
+    def on_agent_action(self, action, **kwargs):
+        self.flush()
+        self.send("step", f"{action.tool}: {action.tool_input}")
+
+    def commit(self, msg_id):
+        """Tell the clients the streamed answer is complete and persisted as `msg_id`."""
+        self.flush()
+        async_to_sync(self.channel_layer.group_send)(self.group_name, self._commit_frame(msg_id))
+
+
+class AsyncChannelStreamHandler(ChannelStreamHandler, AsyncCallbackHandler):
+    """ChannelStreamHandler for agents run with `acall` on the ASGI event loop."""
+    async def send(self, kind, text):
+        await self.channel_layer.group_send(self.group_name, self._frame(kind, text))
+
+    async def flush(self):
+        if self._buffer:
+            await self.send("token", "".join(self._buffer))
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    async def on_llm_start(self, serialized, prompts, **kwargs):
+        self._last_flush = 0
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self._buffer.append(token)
+        if self._due():
+            await self.flush()
+
+    async def on_llm_end(self, response, **kwargs):
+        await self.flush()
+
+    async def on_agent_action(self, action, **kwargs):
+        await self.flush()
+        await self.send("step", f"{action.tool}: {action.tool_input}")
+
+    async def commit(self, msg_id):
+        await self.flush()
+        await self.channel_layer.group_send(self.group_name, self._commit_frame(msg_id))
+
+
+class LLMUsageHandler(BaseCallbackHandler, abc.ABC):
+    """
+    Base for handlers that need the tokens of each LLM call. Streaming OpenAI
+    calls report no token_usage, so their prompt is counted with `llm`'s
+    tokenizer when the call starts and the completion from the streamed
+    tokens; calls that do report usage are taken as reported. Subclasses
+    implement `on_llm_usage`.
+    """
+    def __init__(self, llm):
+        self.llm = llm
+        self._calls = {}
+
+    def count_tokens(self, text):
+        try:
+            return self.llm.get_num_tokens(text)
+        except ImportError:
+            # no tiktoken: ~4 characters per token for English/SQL text
+            return len(text) // 4
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._calls[run_id] = [sum(self.count_tokens(prompt) for prompt in prompts), 0]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id in self._calls:
+            self._calls[run_id][1] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens, streamed_tokens = self._calls.pop(run_id, (0, 0))
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage")
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            completion_tokens = streamed_tokens or sum(
+                self.count_tokens(generation.text) for generations in response.generations for generation in generations
+            )
+        model_name = llm_output.get("model_name") or getattr(self.llm, "model_name", "")
+        self.on_llm_usage(run_id, model_name, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._calls.pop(run_id, None)
+
+    @abc.abstractmethod
+    def on_llm_usage(self, run_id, model_name, prompt_tokens, completion_tokens):
+        """Called once per finished LLM call with the tokens it used."""
+
+
+def llm_cost(model_name, prompt_tokens, completion_tokens):
+    """OpenAI list price of a call in USD; 0 for models LangChain has no price for."""
+    if standardize_model_name(model_name or "") not in MODEL_COST_PER_1K_TOKENS:
+        return 0.0
+    return (
+        get_openai_token_cost_for_model(model_name, prompt_tokens)
+        + get_openai_token_cost_for_model(model_name, completion_tokens, is_completion=True)
+    )
+
+
+class TokenCounter(LLMUsageHandler):
+    """Tokens and cost of a whole run, what get_openai_callback reports for non-streaming LLMs."""
+    def __init__(self, llm):
+        super().__init__(llm)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_cost = 0.0
+        self.successful_requests = 0
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def on_llm_usage(self, run_id, model_name, prompt_tokens, completion_tokens):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.total_cost += llm_cost(model_name, prompt_tokens, completion_tokens)
+        self.successful_requests += 1
+
+
+class RateLimitHandler(TokenCounter):
+    """
+    TokenCounter that draws every LLM call from the rate limit buckets of
+    `scope_ids` (see services.rate_limits): the counted prompt plus
+    LLM_ESTIMATED_COMPLETION_TOKENS when the call starts, settled to the tokens
+    actually used when it ends. A short bucket raises RateLimited on the first
+    call, so the question is retried later, and is waited out on later ones.
+    """
+    raise_error = True
+
+    def __init__(self, llm, scope_ids):
+        super().__init__(llm)
+        self.scope_ids = scope_ids
+        self._estimates = {}
+        self._started = False
+
+    def _estimate(self, run_id):
+        return self._calls[run_id][0] + settings.LLM_ESTIMATED_COMPLETION_TOKENS
+
+    def _granted(self, run_id, tokens, wait):
+        if not wait:
+            self._estimates[run_id] = tokens
+            self._started = True
+            return True
+        if not self._started:
+            raise rate_limits.RateLimited(wait)
+        return False
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        super().on_llm_start(serialized, prompts, run_id=run_id, **kwargs)
+        tokens = self._estimate(run_id)
+        wait = rate_limits.acquire(self.scope_ids, tokens)
+        while not self._granted(run_id, tokens, wait):
+            time.sleep(wait)
+            wait = rate_limits.acquire(self.scope_ids, tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        super().on_llm_error(error, run_id=run_id, **kwargs)
+        self._estimates.pop(run_id, None)
+
+    def on_llm_usage(self, run_id, model_name, prompt_tokens, completion_tokens):
+        super().on_llm_usage(run_id, model_name, prompt_tokens, completion_tokens)
+        estimate = self._estimates.pop(run_id, None)
+        if estimate is not None:
+            rate_limits.settle(self.scope_ids, prompt_tokens + completion_tokens, estimate)
+
+
+class AsyncRateLimitHandler(RateLimitHandler, AsyncCallbackHandler):
+    """RateLimitHandler for agents run with `acall`; waits without blocking the event loop."""
+    async def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        TokenCounter.on_llm_start(self, serialized, prompts, run_id=run_id, **kwargs)
+        tokens = self._estimate(run_id)
+        acquire = sync_to_async(rate_limits.acquire, thread_sensitive=False)
+        wait = await acquire(self.scope_ids, tokens)
+        while not self._granted(run_id, tokens, wait):
+            await asyncio.sleep(wait)
+            wait = await acquire(self.scope_ids, tokens)
+
+    async def on_llm_new_token(self, token, *, run_id, **kwargs):
+        RateLimitHandler.on_llm_new_token(self, token, run_id=run_id, **kwargs)
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        # settling is a Redis round trip
+        await sync_to_async(RateLimitHandler.on_llm_end, thread_sensitive=False)(self, response, run_id=run_id, **kwargs)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        RateLimitHandler.on_llm_error(self, error, run_id=run_id, **kwargs)
+
+
+class CancellationHandler(BaseCallbackHandler):
+    """
+    Stops the agent once its question was cancelled (see services.cancellation).
+    Checked before every LLM call, tool run and agent step, and every
+    `check_interval` seconds while tokens stream in.
+    """
+    # let the exception end the run instead of being logged by the callback manager
+    raise_error = True
+
+    def __init__(self, data_id, asked_at, check_interval=0.5):
+        self.data_id = data_id
+        self.asked_at = asked_at
+        self.check_interval = check_interval
+        self._last_check = 0
+
+    def check(self):
+        self._last_check = time.monotonic()
+        cancellation.check(self.data_id, self.asked_at)
+
+    def _due(self):
+        return time.monotonic() - self._last_check >= self.check_interval
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.check()
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self._due():
+            self.check()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.check()
+
+    def on_agent_action(self, action, **kwargs):
+        self.check()
+
+
+class AsyncCancellationHandler(CancellationHandler, AsyncCallbackHandler):
+    async def check(self):
+        self._last_check = time.monotonic()
+        await sync_to_async(cancellation.check, thread_sensitive=False)(self.data_id, self.asked_at)
+
+    async def on_llm_start(self, serialized, prompts, **kwargs):
+        await self.check()
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if self._due():
+            await self.check()
+
+    async def on_tool_start(self, serialized, input_str, **kwargs):
+        await self.check()
+
+    async def on_agent_action(self, action, **kwargs):
+        await self.check()
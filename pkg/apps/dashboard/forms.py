@@ -3,8 +3,8 @@ from django.core import exceptions
 from django.utils.translation import gettext as _
 
 from .models import Data 
-# from .utils import get_schema, generate_identifier
-# from .services import secrets
+from .utils import generate_identifier
+from .services import engines, schema_snapshots, secrets
 
 
 class CredentialsForm(forms.Form):
@@ -34,10 +34,9 @@ class DatabaseForm(forms.ModelForm, CredentialsForm):
                 self.cleaned_data["username"], 
                 self.cleaned_data["password"]
             )
-            schema = get_schema(conn_str)
-        except exception as e:
+            schema_snapshots.refresh(data, engines.get_engine(data, conn_str))
+        except Exception as e:
             raise exceptions.ValidationError({"credential": _(e)})
-        data.schema = schema 
             
         identifier = generate_identifier(user, data)
         secrets.create_secret(
@@ -79,4 +78,9 @@ class ChatForm(forms.Form):
         choices=[("gpt-3", _("GPT3")), ("gpt-4", _("GPT4"))],
         initial="gpt-3"
     )
-    message = forms.CharField(help_text=_("Natural language query"))
\ No newline at end of file
+    message = forms.CharField(help_text=_("Natural language query"))
+    bypass_cache = forms.BooleanField(
+        label=_("Fresh answer"), 
+        required=False, 
+        help_text=_("Skip previously cached answers and query the data source again")
+    )
\ No newline at end of file
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.llms.base import LLM
+from sqlalchemy import event
+
+from ... import utils
+from ...services import agents, engines, introspection, sql_cache, sql_guard
+from ...services.table_index import TableIndex
+from .. import wide_schema
+
+NO_ANSWER = "I don't know"
+
+# question -> the (tool, input) calls the scripted LLM replays before answering
+SCRIPTS = {
+    "How many customers are there?": [
+        ("sql_db_list_tables", ""),
+        ("sql_db_schema", "customers"),
+        ("sql_db_query", "SELECT COUNT(*) FROM customers"),
+    ],
+    "What is the total order amount per status?": [
+        ("sql_db_list_tables", ""),
+        ("sql_db_schema", "orders"),
+        ("sql_db_query", "SELECT order_status, SUM(amount) FROM orders GROUP BY order_status"),
+    ],
+    "Which 10 customers placed the most orders?": [
+        ("sql_db_list_tables", ""),
+        ("sql_db_schema", "customers, orders"),
+        ("sql_db_query",
+         "SELECT c.name, COUNT(*) AS n FROM orders o JOIN customers c ON c.id = o.customer_id "
+         "GROUP BY c.name ORDER BY n DESC LIMIT 10"),
+    ],
+    "What was the average invoice amount per month?": [
+        ("sql_db_list_tables", ""),
+        ("sql_db_schema", "invoices"),
+        ("sql_db_query",
+         "SELECT strftime('%Y-%m', created_at) AS month, AVG(amount) FROM invoices GROUP BY month ORDER BY month"),
+    ],
+    "How many support tickets are still open?": [
+        ("sql_db_list_tables", ""),
+        ("sql_db_schema", "tickets"),
+        ("sql_db_query", "SELECT COUNT(*) FROM tickets WHERE ticket_status = 'open'"),
+    ],
+    "List every refund with its amount": [
+        ("sql_db_list_tables", ""),
+        ("sql_db_schema", "refunds"),
+        # no LIMIT: the guard adds one
+        ("sql_db_query", "SELECT id, amount FROM refunds"),
+    ],
+}
+
+
+class ScriptedLLM(LLM):
+    """
+    Deterministic stand-in for OpenAI: replies to the SQL agent's prompt with
+    the next tool call scripted for its question, then a final answer.
+
+    Nothing is kept between calls, the step is read off the prompt's
+    scratchpad, so one instance serves any number of agents and threads.
+    """
+    scripts: dict
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def _reply(self, prompt):
+        # the last "Question:" is the input; the format instructions have one too
+        scratchpad = prompt.rsplit("Question: ", 1)[-1]
+        question = scratchpad.split("\n", 1)[0].strip()
+        steps = self.scripts.get(question, [])
+        done = scratchpad.count("Observation:")
+        if done < len(steps):
+            tool, tool_input = steps[done]
+            return f"I should use {tool}.\nAction: {tool}\nAction Input: {tool_input}"
+        observation = scratchpad.rsplit("Observation:", 1)[-1].strip().split("\n", 1)[0] if done else ""
+        return "I now know the final answer\nFinal Answer: " + (observation[:200] or NO_ANSWER)
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._reply(prompt)
+
+    async def _acall(self, prompt, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._reply(prompt)
+
+
+class PromptMeter(BaseCallbackHandler):
+    def __init__(self):
+        self.calls = 0
+        self.sizes = []
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.calls += 1
+        self.sizes += [len(prompt) for prompt in prompts]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the SQL agent offline: generated SQLite databases of several widths, a scripted LLM "
+        "replaying canned tool calls, and the same engine registry, table pruning, guard and result cache "
+        "the chat uses. Reports throughput, latency percentiles, SQL round trips, prompt sizes and memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--widths", default="20,200,1000", help="Comma-separated table counts of the fixtures")
+        parser.add_argument("--rows", type=int, default=1000, help="Rows per entity table")
+        parser.add_argument("--runs", type=int, default=60, help="Questions asked per width")
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the scripted LLM waits per call")
+        parser.add_argument("--prune", type=int, default=0, help="Show the agent the top K tables (0: all of them)")
+        parser.add_argument("--guard", action="store_true", help="Run queries through the SQL guard")
+        parser.add_argument("--result-cache", action="store_true", help="Cache query results in Redis")
+        parser.add_argument("--cache-agents", action="store_true", help="Reuse one agent per source through an AgentCache")
+        parser.add_argument("--async", dest="use_async", action="store_true", help="Answer with acall on aiosqlite")
+        parser.add_argument("--tracemalloc", action="store_true", help="Also report the Python heap peak (slower)")
+        parser.add_argument("--json", help="Write the results to this file, e.g. for a CI regression check")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def build(self, engine, async_engine, tables, llm, source, options):
+        result_cache = sql_cache.get_cache(source) if options["result_cache"] else None
+        guard = sql_guard.get_guard(source, engine.dialect.name) if options["guard"] else None
+        return utils.get_db_agent(
+            engine, tables=tables, result_cache=result_cache, async_engine=async_engine, guard=guard, llm=llm
+        )
+
+    def measure(self, width, options):
+        rng = random.Random(options["seed"])
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        data_id = f"benchmark-{width}"
+        conn_str = f"sqlite:///{path}"
+        engine = engines.registry.get_engine(data_id, conn_str)
+        async_engine = engines.registry.get_async_engine(data_id, conn_str) if options["use_async"] else None
+        if options["use_async"] and async_engine is None:
+            raise CommandError("--async needs aiosqlite installed")
+        # with either, the agent queries a CachedSQLDatabase, whose tables are narrowed per question
+        scoped = options["guard"] or options["result_cache"]
+        if options["use_async"] and not scoped:
+            raise CommandError("--async needs --guard or --result-cache, the async SQL tools come with them")
+        if options["cache_agents"] and options["prune"] and not scoped:
+            raise CommandError("--cache-agents with --prune needs --guard or --result-cache to narrow the tables per question")
+        # stands in for the Data row: no per-source limits or TTL, the settings' defaults apply
+        source = SimpleNamespace(id=data_id, query_row_limit=None, query_cost_limit=None, sql_cache_ttl=None)
+
+        round_trips = [0]
+        lock = threading.Lock()
+
+        def count(*args):
+            with lock:
+                round_trips[0] += 1
+
+        try:
+            wide_schema.create_fixture(engine, max(width, len(wide_schema.ENTITIES)), rng, rows=options["rows"])
+            for target in (engine, getattr(async_engine, "sync_engine", None)):
+                if target is not None:
+                    event.listen(target, "before_cursor_execute", count)
+            index = TableIndex(introspection.introspect(engine)) if options["prune"] else None
+            llm = ScriptedLLM(scripts=SCRIPTS, latency=options["llm_latency"])
+            questions = [rng.choice(list(SCRIPTS)) for _ in range(options["runs"])]
+            agent_cache = agents.AgentCache(max_size=settings.AGENT_CACHE_MAX_SIZE, ttl=settings.AGENT_CACHE_TTL)
+            key = ("benchmark", data_id, llm._llm_type)
+
+            def get_agent(question):
+                """The agent for `question` and the tables to narrow it to for the call."""
+                tables = (index.top_k(question, options["prune"]) or None) if index else None
+                if not options["cache_agents"]:
+                    return self.build(engine, async_engine, None if scoped else tables, llm, source, options), tables
+                # like agents.get_agent: one agent per source, concurrent misses may both build
+                agent = agent_cache.get(key, data_id)
+                if agent is None:
+                    agent = self.build(engine, async_engine, None, llm, source, options)
+                    agent_cache.set(key, data_id, agent)
+                return agent, tables
+
+            def ask(question):
+                started = time.perf_counter()
+                agent, tables = get_agent(question)
+                built = time.perf_counter()
+                meter = PromptMeter()
+                with sql_cache.include_tables(tables):
+                    response = agent(question, callbacks=[meter])
+                return built - started, time.perf_counter() - started, meter, response
+
+            async def aask(question, semaphore):
+                async with semaphore:
+                    started = time.perf_counter()
+                    agent, tables = await asyncio.to_thread(get_agent, question)
+                    built = time.perf_counter()
+                    meter = PromptMeter()
+                    with sql_cache.include_tables(tables):
+                        response = await agent.acall(question, callbacks=[meter])
+                    return built - started, time.perf_counter() - started, meter, response
+
+            async def ask_all():
+                semaphore = asyncio.Semaphore(options["concurrency"])
+                return await asyncio.gather(*(aask(question, semaphore) for question in questions))
+
+            round_trips[0] = 0
+            if options["tracemalloc"]:
+                tracemalloc.start()
+            started = time.perf_counter()
+            if options["use_async"]:
+                results = asyncio.run(ask_all())
+            else:
+                with ThreadPoolExecutor(options["concurrency"]) as pool:
+                    results = list(pool.map(ask, questions))
+            elapsed = time.perf_counter() - started
+            heap_peak = tracemalloc.get_traced_memory()[1] if options["tracemalloc"] else None
+            if options["tracemalloc"]:
+                tracemalloc.stop()
+        finally:
+            engines.registry.dispose(data_id)
+            os.remove(path)
+            if options["result_cache"]:
+                sql_cache.get_cache(source).clear()
+
+        builds = [build for build, _, _, _ in results]
+        latencies = [latency for _, latency, _, _ in results]
+        prompts = [size for _, _, meter, _ in results for size in meter.sizes]
+        answered = sum(1 for *_, response in results if not response["output"].startswith(("Agent stopped", NO_ANSWER)))
+        return {
+            "width": width,
+            "questions": len(results),
+            "answered": answered,
+            "seconds": round(elapsed, 3),
+            "questions_per_second": round(len(results) / elapsed, 2),
+            "latency_ms": {
+                f"p{q}": round(float(np.percentile(latencies, q)) * 1000, 1) for q in (50, 95, 99)
+            },
+            "agent_build_ms_p50": round(float(np.percentile(builds, 50)) * 1000, 1),
+            "sql_round_trips_per_question": round(round_trips[0] / len(results), 2),
+            "llm_calls_per_question": round(sum(meter.calls for _, _, meter, _ in results) / len(results), 2),
+            "prompt_chars": {
+                "mean": round(float(np.mean(prompts))),
+                "p95": round(float(np.percentile(prompts, 95))),
+                "max": max(prompts),
+            },
+            # kilobytes on Linux; the high-water mark of the whole process so far
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "heap_peak_mb": round(heap_peak / 2 ** 20, 1) if heap_peak is not None else None,
+        }
+
+    def handle(self, *args, **options):
+        try:
+            widths = [int(width) for width in options["widths"].split(",")]
+        except ValueError:
+            raise CommandError("--widths takes comma-separated table counts")
+
+        results = []
+        for width in widths:
+            result = self.measure(width, options)
+            results.append(result)
+            latency = result["latency_ms"]
+            self.stdout.write(
+                f"{width:>5} tables  {result['questions_per_second']:7.2f} q/s  "
+                f"p50 {latency['p50']:8.1f}ms  p95 {latency['p95']:8.1f}ms  p99 {latency['p99']:8.1f}ms  "
+                f"build p50 {result['agent_build_ms_p50']:7.1f}ms  "
+                f"{result['sql_round_trips_per_question']:5.1f} SQL/q  "
+                f"{result['llm_calls_per_question']:4.1f} LLM/q  "
+                f"prompt mean {result['prompt_chars']['mean']:>7} chars  max {result['prompt_chars']['max']:>7}  "
+                f"rss {result['max_rss_mb']:7.1f}MB"
+                + (f"  heap {result['heap_peak_mb']:6.1f}MB" if result["heap_peak_mb"] is not None else "")
+                + f"  answered {result['answered']}/{result['questions']}"
+            )
+
+        if options["json"]:
+            with open(options["json"], "w") as f:
+                json.dump({"options": {k: options[k] for k in (
+                    "rows", "runs", "concurrency", "llm_latency", "prune", "guard", "result_cache",
+                    "cache_agents", "use_async", "seed",
+                )}, "results": results}, f, indent=2)
@@ -0,0 +1,75 @@
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from langchain.callbacks.base import BaseCallbackHandler
+
+from ... import models
+from ...services import agents, examples, sql_cache
+
+
+class LLMCallCounter(BaseCallbackHandler):
+    def __init__(self):
+        self.calls = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.calls += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay past questions of a database source with and without few-shot examples and compare "
+        "agent steps and LLM calls per question. Each question's own answer is left out of its examples. "
+        "Calls the LLM for every question twice."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("data_id", help="Database source whose answered questions are replayed")
+        parser.add_argument("--limit", type=int, default=20, help="Most recent distinct questions to replay")
+        parser.add_argument("--model", default="gpt-3")
+
+    def replay(self, data, question, model, with_examples):
+        agent = agents.get_agent(data.user, data, model)
+        tables = agents.relevant_tables(data, question)
+        if with_examples:
+            question = examples.augment(data, question, exclude=question)
+        counter = LLMCallCounter()
+        with sql_cache.include_tables(tables):
+            response = agent(question, callbacks=[counter])
+        return len(response.get("intermediate_steps") or []), counter.calls
+
+    def handle(self, *args, **options):
+        data = models.Data.objects.filter(id=options["data_id"], is_db=True).select_related("user").first()
+        if data is None:
+            raise CommandError("No database source with this id")
+
+        questions = []
+        for _, question, _, _ in examples.answered(data).reverse():
+            if question not in questions:
+                questions.append(question)
+            if len(questions) == options["limit"]:
+                break
+        if not questions:
+            raise CommandError("The source has no answered questions to replay")
+
+        results = {False: {"steps": [], "llm_calls": []}, True: {"steps": [], "llm_calls": []}}
+        with_matches = 0
+        for question in questions:
+            if examples.similar(data, question, exclude=question):
+                with_matches += 1
+            for with_examples in (False, True):
+                try:
+                    steps, calls = self.replay(data, question, options["model"], with_examples)
+                except Exception as e:
+                    self.stderr.write(f"{question!r} ({'with' if with_examples else 'without'} examples): {e}")
+                    continue
+                results[with_examples]["steps"].append(steps)
+                results[with_examples]["llm_calls"].append(calls)
+
+        self.stdout.write(f"{len(questions)} questions, {with_matches} with similar past answers")
+        for with_examples, name in ((False, "without"), (True, "with")):
+            steps, calls = results[with_examples]["steps"], results[with_examples]["llm_calls"]
+            if not steps:
+                continue
+            self.stdout.write(
+                f"{name:<8} agent steps mean {np.mean(steps):5.2f}  p50 {np.percentile(steps, 50):4.1f}  "
+                f"LLM calls mean {np.mean(calls):5.2f}  p50 {np.percentile(calls, 50):4.1f}"
+            )
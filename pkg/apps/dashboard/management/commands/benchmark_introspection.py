@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from sqlalchemy import create_engine, event, text
+
+from ...services import introspection
+
+
+class Command(BaseCommand):
+    help = 'Compare bulk catalog introspection with the per-table inspector on generated fixture schemas'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10, 1000, 10000])
+        parser.add_argument(
+            "--url",
+            help="Database url to build the fixtures in (e.g. a scratch Postgres database). "
+                 "Defaults to a temporary SQLite file per size."
+        )
+        parser.add_argument("--skip-inspector-above", type=int, default=2000,
+                            help="Don't time the inspector fallback for fixtures larger than this")
+
+    def create_fixture(self, engine, size):
+        with engine.begin() as conn:
+            for i in range(size):
+                conn.execute(text(f"DROP TABLE IF EXISTS bench_{i}"))
+            for i in range(size):
+                parent = f", parent_id INTEGER REFERENCES bench_{i - 1}(id)" if i else ""
+                conn.execute(text(
+                    f"CREATE TABLE bench_{i} (id INTEGER PRIMARY KEY, name VARCHAR(64), created_at TIMESTAMP{parent})"
+                ))
+
+    def drop_fixture(self, engine, size):
+        with engine.begin() as conn:
+            for i in reversed(range(size)):
+                conn.execute(text(f"DROP TABLE IF EXISTS bench_{i}"))
+
+    def measure(self, engine, func):
+        statements = []
+        listener = lambda *args, **kwargs: statements.append(1)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            started = time.perf_counter()
+            tables = func(engine)
+            elapsed = time.perf_counter() - started
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        return elapsed, len(statements), len(tables)
+
+    def handle(self, *args, **options):
+        for size in options["sizes"]:
+            if options["url"]:
+                engine = create_engine(options["url"])
+                path = None
+            else:
+                fd, path = tempfile.mkstemp(suffix=".sqlite3")
+                os.close(fd)
+                engine = create_engine(f"sqlite:///{path}")
+            try:
+                self.create_fixture(engine, size)
+                elapsed, queries, tables = self.measure(engine, introspection.introspect)
+                self.stdout.write(f"{size:>6} tables  bulk       {elapsed:8.3f}s  {queries:>6} queries  ({tables} tables)")
+                if size <= options["skip_inspector_above"]:
+                    elapsed, queries, tables = self.measure(engine, introspection.inspector_introspect)
+                    self.stdout.write(f"{size:>6} tables  inspector  {elapsed:8.3f}s  {queries:>6} queries  ({tables} tables)")
+                if options["url"]:
+                    self.drop_fixture(engine, size)
+            finally:
+                engine.dispose()
+                if path:
+                    os.remove(path)
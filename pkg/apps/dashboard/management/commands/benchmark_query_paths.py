@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import models
+from ...services import async_queries, fair_share
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare p50/p95 latency of answering questions through Celery and on the event loop. "
+        "Needs a running worker and the Redis channel layer; caches are bypassed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("data_id", help="Database source to ask")
+        parser.add_argument("--question", default="How many tables are there?")
+        parser.add_argument("--model", default="gpt-3")
+        parser.add_argument("--runs", type=int, default=20)
+        parser.add_argument("--concurrency", type=int, default=4, help="Questions asked at once")
+        parser.add_argument("--timeout", type=int, default=120)
+
+    async def ask_batch(self, submit, size, channel, timeout):
+        """Submit `size` questions at once; returns (first frame, answer) latencies in seconds."""
+        layer = get_channel_layer()
+        started = time.perf_counter()
+        await asyncio.gather(*(submit() for _ in range(size)))
+        first_frames, answers = {}, []
+        while len(answers) < size:
+            event = await asyncio.wait_for(layer.receive(channel), timeout)
+            elapsed = time.perf_counter() - started
+            stream_id = event.get("stream_id")
+            first_frames.setdefault(stream_id, elapsed)
+            if event["type"] == "chat_message":
+                answers.append(elapsed)
+        return list(first_frames.values())[:size], answers
+
+    async def measure(self, name, submit, data, options):
+        layer = get_channel_layer()
+        group = f"chat_{data.id}"
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        first_frames, answers = [], []
+        try:
+            remaining = options["runs"]
+            while remaining > 0:
+                size = min(options["concurrency"], remaining)
+                first, done = await self.ask_batch(submit, size, channel, options["timeout"])
+                first_frames += first
+                answers += done
+                remaining -= size
+        finally:
+            await layer.group_discard(group, channel)
+
+        self.stdout.write(
+            f"{name:<8} first frame p50 {np.percentile(first_frames, 50):6.2f}s  p95 {np.percentile(first_frames, 95):6.2f}s  "
+            f"answer p50 {np.percentile(answers, 50):6.2f}s  p95 {np.percentile(answers, 95):6.2f}s"
+        )
+
+    async def run(self, data, options):
+        args = (options["question"], data.user_id, data.id, options["model"])
+
+        async def celery():
+            await sync_to_async(fair_share.submit)(*args, use_cache=False)
+
+        async def event_loop():
+            async_queries.submit(*args, use_cache=False)
+
+        await self.measure("celery", celery, data, options)
+        await self.measure("asyncio", event_loop, data, options)
+
+    def handle(self, *args, **options):
+        data = models.Data.objects.filter(id=options["data_id"]).first()
+        if data is None or not async_queries.supports_async(data):
+            raise CommandError("Need a database source and ASYNC_QUERY_EXECUTION enabled")
+        asyncio.run(self.run(data, options))
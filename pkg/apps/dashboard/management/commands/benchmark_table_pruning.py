@@ -0,0 +1,62 @@
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from langchain import SQLDatabase
+from sqlalchemy import create_engine
+
+from ...services import introspection
+from ...services.table_index import TableIndex
+from .. import wide_schema
+
+# (question, table that must be selected to answer it)
+QUESTIONS = [
+    ("What was the total invoice amount last month?", "invoices"),
+    ("Top 10 customers by number of orders", "orders"),
+    ("How many support tickets are still open?", "tickets"),
+    ("Which warehouse shipped the most shipments?", "shipments"),
+    ("Average refund amount per product category", "refunds"),
+    ("How many employees are in each department?", "employees"),
+]
+
+
+class Command(BaseCommand):
+    help = 'Measure the schema prompt size handed to the SQL agent with and without table pruning'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tables", type=int, default=500)
+        parser.add_argument("--top-k", type=int, default=8)
+
+    def handle(self, *args, **options):
+        fd, path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        engine = create_engine(f"sqlite:///{path}")
+        try:
+            wide_schema.create_fixture(engine, options["tables"], random.Random(0))
+            tables = introspection.introspect(engine)
+            started = time.perf_counter()
+            index = TableIndex(tables)
+            self.stdout.write(f"Indexed {len(index)} tables in {time.perf_counter() - started:.3f}s")
+
+            db = SQLDatabase(engine, sample_rows_in_table_info=0)
+            # ~4 characters per token for English/SQL text
+            full_tokens = len(db.get_table_info()) // 4
+            self.stdout.write(f"Schema prompt without pruning: ~{full_tokens} tokens")
+
+            hits = 0
+            for question, expected in QUESTIONS:
+                started = time.perf_counter()
+                selected = index.top_k(question, options["top_k"])
+                elapsed = (time.perf_counter() - started) * 1000
+                pruned_tokens = len(db.get_table_info(selected)) // 4 if selected else full_tokens
+                hits += expected in selected
+                self.stdout.write(
+                    f"{question[:45]:<45}  {len(selected):>3} tables  ~{pruned_tokens:>6} tokens  "
+                    f"{elapsed:6.2f}ms  {'hit' if expected in selected else 'MISS'}"
+                )
+            self.stdout.write(f"Recall@{options['top_k']}: {hits}/{len(QUESTIONS)}")
+        finally:
+            engine.dispose()
+            os.remove(path)
@@ -0,0 +1,57 @@
+"""
+Synthetic wide schemas for the benchmark commands.
+
+One table per entity in ENTITIES, every one but `customers` owned by a
+customer so questions can join, optionally filled with `rows` random rows;
+then empty look-alike `<entity>_history_<n>` tables that only widen the
+schema up to `width` tables.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+ENTITIES = [
+    "customer", "order", "invoice", "payment", "product", "supplier", "shipment", "warehouse",
+    "employee", "department", "campaign", "lead", "ticket", "refund", "subscription", "coupon",
+]
+ATTRIBUTES = ["status", "amount", "region", "channel", "category", "score", "currency", "note"]
+STATUSES = ["new", "open", "paid", "shipped", "closed", "cancelled"]
+
+
+def create_fixture(engine, width, rng, rows=0):
+    started = datetime(2026, 1, 1)
+    with engine.begin() as conn:
+        for entity in ENTITIES:
+            owned = entity != "customer"
+            conn.execute(text(
+                f"CREATE TABLE {entity}s (id INTEGER PRIMARY KEY, name VARCHAR(64), "
+                f"{entity}_status VARCHAR(16), amount NUMERIC, created_at TIMESTAMP"
+                + (", customer_id INTEGER REFERENCES customers(id))" if owned else ")")
+            ))
+            if not rows:
+                continue
+            columns = ["id", "name", f"{entity}_status", "amount", "created_at"] + (["customer_id"] if owned else [])
+            conn.execute(
+                text(
+                    f"INSERT INTO {entity}s ({', '.join(columns)}) "
+                    f"VALUES (:id, :name, :status, :amount, :created_at{', :customer_id' if owned else ''})"
+                ),
+                [
+                    {
+                        "id": i,
+                        "name": f"{entity} {i}",
+                        "status": rng.choice(STATUSES),
+                        "amount": round(rng.uniform(1, 1000), 2),
+                        "created_at": started + timedelta(minutes=rng.randrange(60 * 24 * 365)),
+                        "customer_id": rng.randrange(1, rows + 1),
+                    }
+                    for i in range(1, rows + 1)
+                ],
+            )
+        for i in range(width - len(ENTITIES)):
+            entity = rng.choice(ENTITIES)
+            columns = ", ".join(f"{attr}_{i} VARCHAR(32)" for attr in rng.sample(ATTRIBUTES, 3))
+            conn.execute(text(
+                f"CREATE TABLE {entity}_history_{i} (id INTEGER PRIMARY KEY, "
+                f"{entity}_id INTEGER REFERENCES {entity}s(id), {columns})"
+            ))
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0002_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='schema_hash',
+            field=models.CharField(help_text='Hash of the latest schema snapshot', max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='schema_refreshed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name='SchemaTable',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('fingerprint', models.CharField(help_text='Catalog fingerprint at the last refresh', max_length=40, null=True)),
+                ('content_hash', models.CharField(max_length=40)),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+                ('data', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schema_tables', to='dashboard.data')),
+            ],
+            options={
+                'ordering': ('name',),
+                'unique_together': {('data', 'name')},
+            },
+        ),
+        migrations.CreateModel(
+            name='SchemaColumn',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('type', models.CharField(max_length=255, null=True)),
+                ('position', models.IntegerField()),
+                ('is_primary_key', models.BooleanField(default=False)),
+                ('foreign_key_table', models.CharField(max_length=255, null=True)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='columns', to='dashboard.schematable')),
+            ],
+            options={
+                'ordering': ('position',),
+            },
+        ),
+    ]
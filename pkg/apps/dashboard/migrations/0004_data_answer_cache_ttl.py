@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0003_data_schema_hash_schematable_schemacolumn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='answer_cache_ttl',
+            field=models.IntegerField(blank=True, help_text='Seconds a repeated question is answered from cache (0 disables, empty uses the default)', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_data_answer_cache_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='sql_cache_ttl',
+            field=models.IntegerField(blank=True, help_text='Seconds an executed query result stays fresh (0 disables, empty uses the default)', null=True),
+        ),
+    ]
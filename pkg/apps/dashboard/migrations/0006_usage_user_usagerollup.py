@@ -0,0 +1,47 @@
+# Generated by Django 4.2.2 on 2026-10-18 13:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0005_data_sql_cache_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usage',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='usages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket', models.DateTimeField(help_text='Start of the hour or day')),
+                ('requests', models.IntegerField(default=0)),
+                ('prompt_tokens', models.BigIntegerField(default=0)),
+                ('completion_tokens', models.BigIntegerField(default=0)),
+                ('total_tokens', models.BigIntegerField(default=0)),
+                ('total_cost', models.DecimalField(decimal_places=5, default=0, max_digits=14)),
+                ('data', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='dashboard.data')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('period', 'bucket', 'user', 'data')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='usagerollup',
+            index=models.Index(fields=['user', 'period', 'bucket'], name='usagerollup_user_bucket_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usagerollup',
+            index=models.Index(fields=['data', 'period', 'bucket'], name='usagerollup_data_bucket_idx'),
+        ),
+    ]
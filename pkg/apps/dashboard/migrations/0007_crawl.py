@@ -0,0 +1,34 @@
+# Generated by Django 4.2.2 on 2026-10-18 15:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0006_usage_user_usagerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Crawl',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=255)),
+                ('crawler_name', models.CharField(max_length=255)),
+                ('glue_db_name', models.CharField(max_length=255)),
+                ('state', models.CharField(choices=[('starting', 'Starting'), ('running', 'Running'), ('stopping', 'Stopping'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='starting', max_length=10)),
+                ('error_message', models.TextField(blank=True, default='')),
+                ('polls', models.IntegerField(default=0)),
+                ('next_poll_at', models.DateTimeField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('data', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='crawls', to='dashboard.data')),
+            ],
+            options={
+                'ordering': ('-started_at',),
+                'indexes': [models.Index(fields=['state', 'next_poll_at'], name='crawl_state_next_poll_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0007_crawl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='query_cost_limit',
+            field=models.FloatField(blank=True, help_text="Highest EXPLAIN cost estimate a query may have, in the database's own units (empty uses the default)", null=True),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='query_row_limit',
+            field=models.IntegerField(blank=True, help_text='Most rows a query of the assistant may return (empty uses the default)', null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.2 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+def pair_questions(apps, schema_editor):
+    """Answers so far were saved right after the question they answer."""
+    Message = apps.get_model("dashboard", "Message")
+    question = {}
+    answers = []
+    for message in Message.objects.order_by("source_id", "id").iterator():
+        if not message.is_ai:
+            question[message.source_id] = message.text
+        elif message.sql_query and message.source_id in question:
+            message.question = question[message.source_id]
+            answers.append(message)
+    Message.objects.bulk_update(answers, ["question"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0008_data_query_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='question',
+            field=models.CharField(help_text='Question an AI message answers', max_length=255, null=True),
+        ),
+        migrations.RunPython(pair_questions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.2 on 2026-10-18 18:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dashboard', '0009_message_question'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question', models.CharField(max_length=255)),
+                ('model', models.CharField(max_length=32)),
+                ('path', models.CharField(help_text='Where the question was answered: celery or async', max_length=8)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('error', 'Error'), ('cancelled', 'Cancelled')], max_length=9)),
+                ('started_at', models.DateTimeField(help_text='When the question was asked')),
+                ('duration_ms', models.IntegerField()),
+                ('spans', models.JSONField(default=list, help_text='[kind, name, start ms, duration ms, attributes]')),
+                ('data', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='traces', to='dashboard.data')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='traces', to='dashboard.message')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='traces', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-started_at',),
+                'indexes': [models.Index(fields=['data', 'started_at'], name='trace_data_started_idx')],
+            },
+        ),
+    ]
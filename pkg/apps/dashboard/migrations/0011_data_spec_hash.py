@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_trace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='spec_hash',
+            field=models.CharField(help_text='Hash of the reduced spec last fetched', max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='spec_refreshed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0011_data_spec_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='sql_query',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:02
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+TOTALS = ("requests", "prompt_tokens", "completion_tokens", "total_tokens", "total_cost")
+
+
+def merge_duplicate_rollups(apps, schema_editor):
+    UsageRollup = apps.get_model("dashboard", "UsageRollup")
+    duplicates = (
+        UsageRollup.objects.filter(user__isnull=True)
+        .values("period", "bucket", "data")
+        .annotate(rows=Count("id"))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        rollups = UsageRollup.objects.filter(
+            user__isnull=True, period=duplicate["period"], bucket=duplicate["bucket"], data=duplicate["data"]
+        ).order_by("id")
+        totals = rollups.aggregate(**{field: Sum(field) for field in TOTALS})
+        keep = rollups.first()
+        rollups.exclude(pk=keep.pk).delete()
+        UsageRollup.objects.filter(pk=keep.pk).update(**totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0012_alter_message_sql_query'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_rollups, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='usagerollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('user__isnull', True)), fields=('period', 'bucket', 'data'), name='usagerollup_unique_without_user'),
+        ),
+    ]
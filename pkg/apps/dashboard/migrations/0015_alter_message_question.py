@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 21:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0014_data_query_limits_min_value'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='question',
+            field=models.TextField(help_text='Question an AI message answers', null=True),
+        ),
+    ]
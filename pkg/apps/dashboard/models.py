@@ -1,9 +1,12 @@
 from django.db import models
 from django.conf import settings
+from django.core.validators import MinValueValidator
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 
 import hashid_field
+import hashlib
+import json
 
 # Create your models here.
 class DataQuerySet(models.QuerySet):
@@ -48,7 +51,27 @@ class Data(models.Model):
     snowflake_schema = models.CharField(max_length=255, null=True, help_text=_("Snowflake database schema"))
     snowflake_warehouse = models.CharField(max_length=255, null=True, help_text=_("Snowflake database warehouse"))
     schema = models.TextField(null=True)
+    schema_hash = models.CharField(max_length=40, null=True, help_text=_("Hash of the latest schema snapshot"))
+    schema_refreshed_at = models.DateTimeField(null=True)
+    answer_cache_ttl = models.IntegerField(
+        null=True, blank=True, 
+        help_text=_("Seconds a repeated question is answered from cache (0 disables, empty uses the default)")
+    )
+    sql_cache_ttl = models.IntegerField(
+        null=True, blank=True, 
+        help_text=_("Seconds an executed query result stays fresh (0 disables, empty uses the default)")
+    )
+    query_row_limit = models.IntegerField(
+        null=True, blank=True, validators=[MinValueValidator(1)],
+        help_text=_("Most rows a query of the assistant may return (empty uses the default)")
+    )
+    query_cost_limit = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(1)],
+        help_text=_("Highest EXPLAIN cost estimate a query may have, in the database's own units (empty uses the default)")
+    )
     spec_url = models.URLField(null=True, help_text=_("Openapi spec url"))
+    spec_hash = models.CharField(max_length=40, null=True, help_text=_("Hash of the reduced spec last fetched"))
+    spec_refreshed_at = models.DateTimeField(null=True)
     header = models.JSONField(null=True, help_text=_("A dict of API request header"))
     created_at = models.DateTimeField(auto_now=True)
     updated_at = models.DateTimeField(auto_now_add=True)
@@ -66,10 +89,26 @@ class Data(models.Model):
     
     @property
     def tbls(self):
+        if not self.tables:
+            return []
         tables = self.tables.split(",")
         tables = [tbl.strip() for tbl in tables]
         return tables
     
+    @property
+    def fingerprint(self):
+        """
+        Hash of the fields an agent is built from; changes whenever the
+        connection details, table selection or API spec of the source change.
+        """
+        fields = [
+            self.protocol, self.host, self.port, self.db_name, self.tables,
+            self.snowflake_account, self.snowflake_schema, self.snowflake_warehouse,
+            self.spec_url, self.spec_hash, json.dumps(self.header, sort_keys=True, default=str),
+            self.schema_hash, self.sql_cache_ttl, self.query_row_limit, self.query_cost_limit,
+        ]
+        return hashlib.sha1("|".join(str(f) for f in fields).encode()).hexdigest()
+    
     def conn_str(self, username, password):
         if self.protocol == self.ProtocolType.SNOWFLAKE:
             return f"snowflake://{username}:{password}@{self.snowflake_account}/{self.db_name}/{self.snowflake_schema}?warehouse={self.snowflake_warehouse}"
@@ -82,12 +121,43 @@ class Data(models.Model):
         return f"jdbc:{self.protocol}://{self.host}:{self.port}/{self.db_name}"
 
 
+class SchemaTable(models.Model):
+    data = models.ForeignKey(Data, related_name="schema_tables", on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=40, null=True, help_text=_("Catalog fingerprint at the last refresh"))
+    content_hash = models.CharField(max_length=40)
+    refreshed_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ("data", "name")
+        ordering = ("name",)
+    
+    def __str__(self):
+        return self.name
+
+
+class SchemaColumn(models.Model):
+    table = models.ForeignKey(SchemaTable, related_name="columns", on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    type = models.CharField(max_length=255, null=True)
+    position = models.IntegerField()
+    is_primary_key = models.BooleanField(default=False)
+    foreign_key_table = models.CharField(max_length=255, null=True)
+    
+    class Meta:
+        ordering = ("position",)
+    
+    def __str__(self):
+        return self.name
+
+
 class Message(models.Model):
     id = hashid_field.HashidAutoField(primary_key=True)
     source = models.ForeignKey(Data, related_name="messages", on_delete=models.CASCADE)
     text = models.CharField(max_length=255)
     is_ai = models.BooleanField(default=False)
-    sql_query = models.CharField(null=True, max_length=255)
+    sql_query = models.TextField(null=True)
+    question = models.TextField(null=True, help_text=_("Question an AI message answers"))
 
 
 class Usage(models.Model):
@@ -96,5 +166,102 @@ class Usage(models.Model):
     total_tokens = models.IntegerField()
     total_cost = models.DecimalField(max_digits=12, decimal_places=5)
     data = models.ForeignKey(Data, on_delete=models.PROTECT, related_name="usages")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="usages")
     created_at = models.DateTimeField(auto_now=True)
-    updated_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    updated_at = models.DateTimeField(auto_now_add=True)
+
+
+class UsageRollup(models.Model):
+    """Usage totals per user and data source, kept incrementally per hour and per day"""
+    class Period(models.TextChoices):
+        HOUR = "hour", _("Hour")
+        DAY = "day", _("Day")
+    
+    period = models.CharField(max_length=4, choices=Period.choices)
+    bucket = models.DateTimeField(help_text=_("Start of the hour or day"))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, related_name="usage_rollups")
+    data = models.ForeignKey(Data, on_delete=models.CASCADE, related_name="usage_rollups")
+    requests = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    total_tokens = models.BigIntegerField(default=0)
+    total_cost = models.DecimalField(max_digits=14, decimal_places=5, default=0)
+    
+    class Meta:
+        unique_together = ("period", "bucket", "user", "data")
+        constraints = [
+            # NULLs are distinct in unique_together; rollups of usage without a user need their own
+            models.UniqueConstraint(
+                fields=["period", "bucket", "data"],
+                condition=models.Q(user__isnull=True),
+                name="usagerollup_unique_without_user",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["user", "period", "bucket"], name="usagerollup_user_bucket_idx"),
+            models.Index(fields=["data", "period", "bucket"], name="usagerollup_data_bucket_idx"),
+        ]
+
+class Crawl(models.Model):
+    """A Glue crawler run, advanced by `tasks.crawl_poll` until it reaches a final state"""
+    class State(models.TextChoices):
+        STARTING = "starting", _("Starting")
+        RUNNING = "running", _("Running")
+        STOPPING = "stopping", _("Stopping")
+        SUCCEEDED = "succeeded", _("Succeeded")
+        FAILED = "failed", _("Failed")
+        CANCELLED = "cancelled", _("Cancelled")
+    
+    FINAL_STATES = (State.SUCCEEDED, State.FAILED, State.CANCELLED)
+    
+    data = models.ForeignKey(Data, on_delete=models.CASCADE, null=True, blank=True, related_name="crawls")
+    identifier = models.CharField(max_length=255)
+    crawler_name = models.CharField(max_length=255)
+    glue_db_name = models.CharField(max_length=255)
+    state = models.CharField(max_length=10, choices=State.choices, default=State.STARTING)
+    error_message = models.TextField(blank=True, default="")
+    polls = models.IntegerField(default=0)
+    next_poll_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ("-started_at",)
+        indexes = [
+            models.Index(fields=["state", "next_poll_at"], name="crawl_state_next_poll_idx"),
+        ]
+    
+    def __str__(self):
+        return f"{self.crawler_name} ({self.state})"
+    
+    @property
+    def is_finished(self):
+        return self.state in self.FINAL_STATES
+
+
+class Trace(models.Model):
+    """Timeline of one answered question, written in bulk by `tasks.flush_traces`"""
+    class Status(models.TextChoices):
+        OK = "ok", _("OK")
+        ERROR = "error", _("Error")
+        CANCELLED = "cancelled", _("Cancelled")
+    
+    data = models.ForeignKey(Data, on_delete=models.CASCADE, related_name="traces")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="traces")
+    message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name="traces")
+    question = models.CharField(max_length=255)
+    model = models.CharField(max_length=32)
+    path = models.CharField(max_length=8, help_text=_("Where the question was answered: celery or async"))
+    status = models.CharField(max_length=9, choices=Status.choices)
+    started_at = models.DateTimeField(help_text=_("When the question was asked"))
+    duration_ms = models.IntegerField()
+    spans = models.JSONField(default=list, help_text=_("[kind, name, start ms, duration ms, attributes]"))
+    
+    class Meta:
+        ordering = ("-started_at",)
+        indexes = [
+            models.Index(fields=["data", "started_at"], name="trace_data_started_idx"),
+        ]
+    
+    def __str__(self):
+        return f"{self.question} ({self.duration_ms} ms)"
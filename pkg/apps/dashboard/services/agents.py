@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .. import models, utils
+from . import engines, secrets, sql_cache, sql_guard, table_index, tracing
+
+logger = logging.getLogger(__name__)
+
+
+class AgentCache:
+    """
+    Process-local cache of built agents.
+
+    Entries are evicted least-recently-used once `max_size` is reached and
+    dropped when they have been idle for longer than `ttl` seconds. Each entry
+    carries the fingerprint of the `Data` row it was built from so a changed
+    source is rebuilt instead of served stale.
+    """
+    def __init__(self, max_size=32, ttl=60 * 15):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, fingerprint):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            agent, entry_fingerprint, last_used = entry
+            if entry_fingerprint != fingerprint or time.monotonic() - last_used > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries[key] = (agent, entry_fingerprint, time.monotonic())
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return agent
+
+    def set(self, key, fingerprint, agent):
+        with self._lock:
+            self._entries[key] = (agent, fingerprint, time.monotonic())
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, identifier):
+        """Drop every cached agent (any model) built for `identifier`."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == identifier]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def invalidate_data(self, data_id):
+        """Drop every cached agent built for the `Data` row `data_id`."""
+        with self._lock:
+            keys = [key for key in self._entries if key[1] == str(data_id)]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [key for key, (_, _, last_used) in self._entries.items() if now - last_used > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        self.evictions += len(expired)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+agent_cache = AgentCache(
+    max_size=settings.AGENT_CACHE_MAX_SIZE,
+    ttl=settings.AGENT_CACHE_TTL
+)
+
+
+def build_agent(user, data: models.Data, model):
+    identifier = utils.generate_identifier(user, data)
+    tables = data.tbls
+    if data.is_db:
+        with tracing.span("secret"):
+            username, password = secrets.get_secret_value(identifier)
+        conn_str = data.conn_str(username, password)
+
+        if data.protocol == models.Data.ProtocolType.ELASTIC_SEARCH:
+            return utils.get_elasticsearch_agent(conn_str, model, tables)
+        engine = engines.get_engine(data, conn_str)
+        async_engine = engines.get_async_engine(data, conn_str) if settings.ASYNC_QUERY_EXECUTION else None
+        return utils.get_db_agent(
+            engine, model, tables,
+            result_cache=sql_cache.get_cache(data),
+            async_engine=async_engine,
+            guard=sql_guard.get_guard(data, engine.dialect.name)
+        )
+    elif data.is_api:
+        return utils.get_api_agent(
+            data,
+            header=data.header or {},
+            model=model
+        )
+    raise ValueError(f"Data source {data.id} is neither a database nor an API")
+
+
+def relevant_tables(data: models.Data, question):
+    """
+    The tables the agent of `data` should see for `question`, or None for all
+    of them; run the agent within `sql_cache.include_tables(...)` of these.
+    """
+    return table_index.relevant_tables(data, question) if data.is_db else None
+
+
+def get_agent(user, data: models.Data, model):
+    """
+    Return a cached agent for (user, data, model), building and caching it on a miss.
+
+    One agent serves every question of the source; for wide schemas the tables
+    it sees are narrowed per question with `relevant_tables`.
+    """
+    identifier = utils.generate_identifier(user, data)
+    key = (identifier, str(data.id), model)
+    # secret_changed only reaches this process; the generation in Redis is bumped by any of them
+    fingerprint = f"{data.fingerprint}:{secrets.credential_cache.generation(identifier)}" if data.is_db else data.fingerprint
+
+    agent = agent_cache.get(key, fingerprint)
+    if agent is not None and data.is_db:
+        # the agent holds the source's engine; don't let dispose_idle close it under it
+        engines.registry.touch(data.id)
+    if agent is None:
+        agent = build_agent(user, data, model)
+        agent_cache.set(key, fingerprint, agent)
+        logger.info("Built agent for %s (%s): %s", identifier, model, agent_cache.stats())
+    return agent
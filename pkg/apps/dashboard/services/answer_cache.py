@@ -0,0 +1,47 @@
+"""
+Cache of final answers in front of the agent.
+
+Entries are keyed on the normalized question, the model and the fingerprint
+of the data source (which includes its schema snapshot hash), so a schema
+change naturally misses. `invalidate` additionally bumps a per-source
+generation to drop every answer of a source at once.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+
+from common.utils import get_redis
+
+from .singleflight import normalize_question
+
+
+def _generation_key(data_id):
+    return f"answers:{data_id}:generation"
+
+
+def _key(data, question, model):
+    generation = int(get_redis().get(_generation_key(data.id)) or 0)
+    digest = hashlib.sha1(
+        f"{normalize_question(question)}|{model}|{data.fingerprint}".encode()
+    ).hexdigest()
+    return f"answers:{data.id}:{generation}:{digest}"
+
+
+def get(data, question, model):
+    """Return the cached {"text", "sql_query"} for the question, or None."""
+    value = get_redis().get(_key(data, question, model))
+    return json.loads(value) if value else None
+
+
+def set(data, question, model, text, sql_query):
+    ttl = data.answer_cache_ttl if data.answer_cache_ttl is not None else settings.ANSWER_CACHE_TTL
+    if ttl <= 0:
+        return
+    value = json.dumps({"text": text, "sql_query": sql_query})
+    get_redis().set(_key(data, question, model), value, ex=ttl)
+
+
+def invalidate(data_id):
+    """Drop every cached answer of the data source; old entries expire on their own."""
+    get_redis().incr(_generation_key(data_id))
@@ -0,0 +1,141 @@
+"""
+Parsed OpenAPI specs of API data sources.
+
+Building an API agent needs the source's spec reduced to the endpoints the
+planner picks from. Downloading and reducing a spec of several megabytes on
+every build is kept off the chat path: `refresh` fetches it with a
+conditional GET (If-None-Match / If-Modified-Since), reduces it once and
+stores the result in Redis; `tasks.refresh_api_specs` revalidates every
+source on a schedule. `get` serves the reduced spec from process memory,
+keyed by `Data.spec_hash`, and only downloads it when nothing is stored yet.
+"""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+import yaml
+from django.conf import settings
+from django.utils import timezone
+from langchain.agents.agent_toolkits.openapi.spec import ReducedOpenAPISpec, reduce_openapi_spec
+
+from common.utils import get_redis
+
+from .. import models
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "apispec:"
+
+_parsed = OrderedDict()
+_lock = threading.Lock()
+_MAX_SPECS = 64
+
+
+def _key(data_id):
+    return f"{PREFIX}{data_id}"
+
+
+def load(data_id):
+    """The stored entry of the source: url, validators, hash and reduced spec; None if there's none."""
+    value = get_redis().get(_key(data_id))
+    return json.loads(value) if value is not None else None
+
+
+def fetch(url, etag=None, last_modified=None):
+    """The spec at `url` as (dict, ETag, Last-Modified), or None when unchanged since the validators."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    response = requests.get(url, headers=headers, timeout=settings.API_SPEC_FETCH_TIMEOUT)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    try:
+        spec = response.json()
+    except ValueError:
+        spec = yaml.safe_load(response.text)
+    return spec, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+
+def refresh(data: models.Data, force=False):
+    """
+    Revalidate the stored spec of `data`, reducing and storing it again when it
+    changed. Returns True when the reduced spec differs from the stored one.
+    """
+    stored = load(data.id)
+    if stored is not None and stored["url"] != data.spec_url:
+        stored = None
+    validators = (stored["etag"], stored["last_modified"]) if stored and not force else (None, None)
+    fetched = fetch(data.spec_url, *validators)
+    fields = {"spec_refreshed_at": timezone.now()}
+    if fetched is None:
+        models.Data.objects.filter(pk=data.pk).update(**fields)
+        logger.info("API spec of %s not modified", data.id)
+        return False
+
+    spec, etag, last_modified = fetched
+    reduced = reduce_openapi_spec(spec)
+    payload = {"servers": reduced.servers, "description": reduced.description, "endpoints": reduced.endpoints}
+    # round-tripped through JSON so the hash matches what `get` rebuilds
+    payload = json.loads(json.dumps(payload, default=str))
+    spec_hash = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    get_redis().set(_key(data.id), json.dumps({
+        "url": data.spec_url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "hash": spec_hash,
+        "spec": payload,
+    }))
+
+    changed = stored is None or stored["hash"] != spec_hash
+    fields["spec_hash"] = spec_hash
+    # queryset update like schema_snapshots: agents of other processes see the new hash in the fingerprint
+    models.Data.objects.filter(pk=data.pk).update(**fields)
+    for field, value in fields.items():
+        setattr(data, field, value)
+    logger.info("Refreshed API spec of %s: %s endpoints, changed %s", data.id, len(payload["endpoints"]), changed)
+    return changed
+
+
+def get(data: models.Data):
+    """The reduced spec of `data`; downloads it only when it was never stored."""
+    key = (str(data.id), data.spec_hash)
+    with _lock:
+        spec = _parsed.get(key)
+        if spec is not None:
+            _parsed.move_to_end(key)
+            return spec
+
+    stored = load(data.id)
+    if stored is None or stored["url"] != data.spec_url:
+        # asked before the refresh task got to the source
+        refresh(data, force=True)
+        stored = load(data.id)
+    spec = ReducedOpenAPISpec(
+        servers=stored["spec"]["servers"],
+        description=stored["spec"]["description"],
+        endpoints=[tuple(endpoint) for endpoint in stored["spec"]["endpoints"]],
+    )
+    with _lock:
+        _parsed[(str(data.id), stored["hash"])] = spec
+        while len(_parsed) > _MAX_SPECS:
+            _parsed.popitem(last=False)
+    return spec
+
+
+def needs_refresh(data: models.Data):
+    """Whether the stored spec is missing or was fetched from another url."""
+    stored = load(data.id)
+    return stored is None or stored["url"] != data.spec_url
+
+
+def delete(data_id):
+    get_redis().delete(_key(data_id))
+    with _lock:
+        for key in [key for key in _parsed if key[0] == str(data_id)]:
+            del _parsed[key]
@@ -0,0 +1,187 @@
+"""
+In-process asyncio execution of chat questions.
+
+With ASYNC_QUERY_EXECUTION on, the chat consumer answers questions of database
+sources itself, on the ASGI event loop, instead of queueing
+`tasks.return_query_resp` and waiting for a worker to pick it up. The agent is
+run with `acall`, so LLM requests and (where an asyncio driver is installed)
+SQL queries are awaited instead of holding a thread. A per-process semaphore
+bounds how many questions run at once; questions that can't start right away
+or have to wait on a rate limit go to Celery as before.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .. import models, tasks, utils
+from ..callbacks import AsyncCancellationHandler, AsyncChannelStreamHandler, AsyncRateLimitHandler
+from . import agents, answer_cache, cancellation, examples, fair_share, rate_limits, singleflight, sql_cache, tracing, usage
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+_semaphore = None
+# strong references to running questions by data source, the loop only keeps weak ones
+_running = defaultdict(set)
+
+
+def get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(settings.ASYNC_QUERY_CONCURRENCY)
+    return _semaphore
+
+
+def supports_async(data: models.Data):
+    """The SQL agent's tools have async variants; API and Elasticsearch agents don't."""
+    return (
+        settings.ASYNC_QUERY_EXECUTION
+        and data.is_db
+        and data.protocol != models.Data.ProtocolType.ELASTIC_SEARCH
+    )
+
+
+def enqueue(query, user_id, data_id, model, flight_key=None, use_cache=True, asked_at=None):
+    """Queue the question on Celery, the path used when ASYNC_QUERY_EXECUTION is off."""
+    return database_sync_to_async(fair_share.submit)(
+        query, user_id, data_id, model, flight_key=flight_key, use_cache=use_cache, asked_at=asked_at
+    )
+
+
+async def _run_agent(query, user_id, data, model, stream, asked_at=None):
+    """Async counterpart of tasks._run_agent; returns None when the question has to wait."""
+    scope_ids = rate_limits.scopes(user_id, data.id)
+    slot = await sync_to_async(rate_limits.acquire_slot, thread_sensitive=False)(user_id)
+    if slot is None:
+        return None
+    try:
+        user = await database_sync_to_async(User.objects.get)(id=user_id)
+        with tracing.span("agent_build"):
+            agent = await database_sync_to_async(agents.get_agent)(user, data, model)
+            tables = await database_sync_to_async(agents.relevant_tables)(data, query)
+        with tracing.span("examples"):
+            question = await database_sync_to_async(examples.augment)(data, query)
+        llm = utils.agent_llm(agent)
+        cb = AsyncRateLimitHandler(llm, scope_ids)
+        callbacks = [stream, cb, AsyncCancellationHandler(data.id, asked_at), *tracing.handlers(llm)]
+        with tracing.span("agent"), sql_cache.include_tables(tables):
+            response = await agent.acall(question, callbacks=callbacks)
+    except rate_limits.RateLimited:
+        return None
+    finally:
+        await sync_to_async(rate_limits.release_slot, thread_sensitive=False)(user_id, slot)
+
+    is_full = await sync_to_async(usage.record, thread_sensitive=False)(
+        data.id, user_id,
+        prompt_tokens=cb.prompt_tokens,
+        completion_tokens=cb.completion_tokens,
+        total_tokens=cb.total_tokens,
+        total_cost=cb.total_cost,
+    )
+    if is_full:
+        await sync_to_async(tasks.flush_usage.delay, thread_sensitive=False)()
+
+    result = response.get("output", response.get("result"))
+    return result, utils.extract_sql(response.get("intermediate_steps"))
+
+
+async def answer(query, user_id, data_id, model, flight_key=None, use_cache=True, asked_at=None):
+    """Answer one question on the running loop, the way tasks.return_query_resp does."""
+    await sync_to_async(cancellation.check, thread_sensitive=False)(data_id, asked_at)
+    data = await database_sync_to_async(models.Data.objects.get)(id=data_id)
+    stream = AsyncChannelStreamHandler(data_id)
+
+    cached = None
+    with tracing.span("answer_cache") as span:
+        if use_cache:
+            cached = await sync_to_async(answer_cache.get, thread_sensitive=False)(data, query, model)
+        span["hit"] = bool(cached)
+    if cached:
+        result, sql_query = cached["text"], cached["sql_query"]
+    else:
+        answered = await _run_agent(query, user_id, data, model, stream, asked_at)
+        if answered is None:
+            # Celery retries until the user's slot and rate limits allow it
+            await enqueue(query, user_id, data_id, model, flight_key, use_cache, asked_at)
+            return None
+        result, sql_query = answered
+        await sync_to_async(answer_cache.set, thread_sensitive=False)(data, query, model, result, sql_query)
+
+    msg = await database_sync_to_async(models.Message.objects.create)(
+        source=data,
+        text=result,
+        sql_query=sql_query,
+        question=query,
+        is_ai=True
+    )
+    if tracing.current():
+        tracing.current().message_id = str(msg.id)
+    with tracing.span("publish"):
+        await stream.commit(str(msg.id))
+    if flight_key:
+        groups = await sync_to_async(singleflight.complete, thread_sensitive=False)(flight_key, str(msg.id))
+        for group in groups - {stream.group_name}:
+            await stream.channel_layer.group_send(group, {"type": "chat_message", "msg_id": str(msg.id)})
+    return result
+
+
+async def run(query, user_id, data_id, model, flight_key=None, use_cache=True, asked_at=None):
+    """
+    Answer within the process' concurrency bound, or queue the question on
+    Celery when every slot is taken.
+    """
+    semaphore = get_semaphore()
+    if semaphore.locked():
+        await enqueue(query, user_id, data_id, model, flight_key, use_cache, asked_at)
+        return None
+    async with semaphore:
+        tracer = tracing.start(data_id, user_id, query, model, "async", asked_at)
+        try:
+            result = await answer(query, user_id, data_id, model, flight_key, use_cache, asked_at)
+        except (Exception, asyncio.CancelledError) as e:
+            if flight_key:
+                await sync_to_async(singleflight.abandon, thread_sensitive=False)(flight_key)
+            cancelled = isinstance(e, (cancellation.QuestionCancelled, asyncio.CancelledError))
+            if tracer:
+                await sync_to_async(tracer.record, thread_sensitive=False)("cancelled" if cancelled else "error")
+            if isinstance(e, cancellation.QuestionCancelled):
+                logger.info("Cancelled a question on data source %s", data_id)
+                return None
+            raise
+        # None: handed over to Celery, which traces it from there
+        if tracer and result is not None:
+            await sync_to_async(tracer.record, thread_sensitive=False)("ok")
+        return result
+
+
+def _done(data_id, task):
+    _running[data_id].discard(task)
+    if not _running[data_id]:
+        del _running[data_id]
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Async question failed", exc_info=task.exception())
+
+
+def submit(query, user_id, data_id, model, flight_key=None, use_cache=True):
+    """Schedule `run` on the current loop without waiting for the answer."""
+    task = asyncio.get_running_loop().create_task(
+        run(query, user_id, data_id, model, flight_key, use_cache, asked_at=time.time())
+    )
+    _running[str(data_id)].add(task)
+    task.add_done_callback(lambda task: _done(str(data_id), task))
+    return task
+
+
+def cancel(data_id):
+    """Cancel the questions of `data_id` running on this process; returns how many."""
+    running = list(_running.get(str(data_id), ()))
+    for task in running:
+        task.cancel()
+    return len(running)
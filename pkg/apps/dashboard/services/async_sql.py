@@ -0,0 +1,54 @@
+"""
+Async variants of the SQL agent's tools.
+
+LangChain's SQL tools only implement `_run`. These let an agent driven with
+`acall` execute queries through `CachedSQLDatabase.arun` and run the catalog
+tools in a worker thread, so it never blocks the event loop it runs on.
+"""
+from asgiref.sync import sync_to_async
+from langchain.agents.agent_toolkits import SQLDatabaseToolkit
+from langchain.tools.sql_database.tool import (
+    InfoSQLDatabaseTool,
+    ListSQLDatabaseTool,
+    QuerySQLDataBaseTool,
+)
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class AsyncQuerySQLDataBaseTool(QuerySQLDataBaseTool):
+    async def _arun(self, query, run_manager=None):
+        try:
+            return await self.db.arun(query)
+        except SQLAlchemyError as e:
+            # same contract as SQLDatabase.run_no_throw: the agent reads the error and retries
+            return f"Error: {e}"
+
+
+class _ThreadedArun:
+    async def _arun(self, *args, run_manager=None, **kwargs):
+        return await sync_to_async(self._run, thread_sensitive=False)(*args, **kwargs)
+
+
+class AsyncInfoSQLDatabaseTool(_ThreadedArun, InfoSQLDatabaseTool):
+    pass
+
+
+class AsyncListSQLDatabaseTool(_ThreadedArun, ListSQLDatabaseTool):
+    pass
+
+
+ASYNC_TOOLS = {
+    QuerySQLDataBaseTool: AsyncQuerySQLDataBaseTool,
+    InfoSQLDatabaseTool: AsyncInfoSQLDatabaseTool,
+    ListSQLDatabaseTool: AsyncListSQLDatabaseTool,
+}
+
+
+class AsyncSQLDatabaseToolkit(SQLDatabaseToolkit):
+    """SQLDatabaseToolkit whose tools support both `run` and `arun`."""
+    def get_tools(self):
+        tools = []
+        for tool in super().get_tools():
+            tool_class = ASYNC_TOOLS.get(type(tool))
+            tools.append(tool_class(db=tool.db, description=tool.description) if tool_class else tool)
+        return tools
@@ -0,0 +1,191 @@
+"""
+Cancelling the questions of a data source.
+
+Stopping a chat cancels every question of its data source asked before the
+stop, wherever it is:
+
+- Celery tasks that haven't started are revoked;
+- running agents stop at their next LLM call or agent step
+  (`callbacks.CancellationHandler`), and questions answered on the ASGI event
+  loop have their asyncio task cancelled;
+- statements running on the customer database are cancelled server-side from
+  a second connection (pg_cancel_backend, KILL QUERY, SYSTEM$CANCEL_ALL_QUERIES)
+  using the session id recorded when the pooled connection was opened. A
+  session stays tracked while its statement executes and, for streamed
+  results, until its connection goes back to the pool.
+
+Questions still waiting in the fair-share queue see the cancel when they start.
+"""
+import logging
+import time
+
+from celery import current_app
+from django.conf import settings
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from common.utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "cancel:"
+
+# by dialect, run on a connection when it's opened
+SESSION_ID_SQL = {
+    "postgresql": "SELECT pg_backend_pid()",
+    "redshift": "SELECT pg_backend_pid()",
+    "mysql": "SELECT CONNECTION_ID()",
+    "snowflake": "SELECT CURRENT_SESSION()",
+}
+STATEMENT_TIMEOUT_SQL = {
+    "postgresql": "SET statement_timeout = {milliseconds}",
+    "redshift": "SET statement_timeout TO {milliseconds}",
+    "mysql": "SET SESSION max_execution_time = {milliseconds}",
+    "snowflake": "ALTER SESSION SET STATEMENT_TIMEOUT_IN_SECONDS = {seconds}",
+}
+# by dialect, run from another connection to stop what a session is executing
+CANCEL_SQL = {
+    "postgresql": "SELECT pg_cancel_backend({session})",
+    "redshift": "SELECT pg_cancel_backend({session})",
+    "mysql": "KILL QUERY {session}",
+    "snowflake": "SELECT SYSTEM$CANCEL_ALL_QUERIES({session})",
+}
+
+
+class QuestionCancelled(Exception):
+    pass
+
+
+def _epoch_key(data_id):
+    return f"{PREFIX}epoch:{data_id}"
+
+
+def _tasks_key(data_id):
+    return f"{PREFIX}tasks:{data_id}"
+
+
+def _sessions_key(data_id):
+    return f"{PREFIX}sessions:{data_id}"
+
+
+def cancelled(data_id, asked_at):
+    """Whether the question asked at `asked_at` (a timestamp) was cancelled since."""
+    epoch = get_redis().get(_epoch_key(data_id))
+    return epoch is not None and float(epoch) >= asked_at
+
+
+def check(data_id, asked_at):
+    if asked_at is not None and cancelled(data_id, asked_at):
+        raise QuestionCancelled(f"Question on data source {data_id} was cancelled")
+
+
+def track_task(data_id, task_id):
+    pipe = get_redis().pipeline()
+    pipe.hset(_tasks_key(data_id), task_id, time.time())
+    pipe.expire(_tasks_key(data_id), settings.QUESTION_CANCEL_TTL)
+    pipe.execute()
+
+
+def untrack_task(data_id, task_id):
+    get_redis().hdel(_tasks_key(data_id), task_id)
+
+
+def configure_session(dialect, timeout):
+    """Pool `connect` listener: applies the statement timeout and records the session id."""
+    def on_connect(dbapi_connection, connection_record):
+        if dialect == "mssql":
+            # pyodbc's query timeout, in seconds
+            dbapi_connection.timeout = timeout
+        elif dialect == "oracle":
+            dbapi_connection.call_timeout = timeout * 1000
+        if dialect not in SESSION_ID_SQL:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(SESSION_ID_SQL[dialect])
+            connection_record.info["session_id"] = int(cursor.fetchone()[0])
+            if timeout:
+                cursor.execute(STATEMENT_TIMEOUT_SQL[dialect].format(milliseconds=timeout * 1000, seconds=timeout))
+            # a rolled back SET would be undone when the connection goes back to the pool
+            dbapi_connection.commit()
+        except Exception:
+            # e.g. MariaDB has no max_execution_time; keep the connection, without a timeout
+            logger.warning("Couldn't set a statement timeout on a %s connection", dialect, exc_info=True)
+            dbapi_connection.rollback()
+        finally:
+            cursor.close()
+    return on_connect
+
+
+def watch(engine, data_id, timeout):
+    """Apply the statement timeout to `engine` and keep track of the sessions executing for `data_id`."""
+    dialect = engine.dialect.name
+    event.listen(engine, "connect", configure_session(dialect, timeout))
+    if dialect not in CANCEL_SQL:
+        return
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        session = conn.info.get("session_id")
+        if session is not None:
+            pipe = get_redis().pipeline()
+            pipe.hset(_sessions_key(data_id), session, time.time())
+            pipe.expire(_sessions_key(data_id), settings.QUESTION_CANCEL_TTL)
+            pipe.execute()
+
+    def untrack(info):
+        info.pop("streaming", None)
+        session = info.get("session_id")
+        if session is not None:
+            get_redis().hdel(_sessions_key(data_id), session)
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        if context.execution_options.get("stream_results"):
+            # the server keeps working while the rows are fetched; untracked when the connection is checked in
+            conn.info["streaming"] = True
+            return
+        untrack(conn.info)
+
+    def on_error(context):
+        if context.connection is not None:
+            untrack(context.connection.info)
+
+    def on_checkin(dbapi_connection, connection_record):
+        if connection_record is not None and connection_record.info.get("streaming"):
+            untrack(connection_record.info)
+
+    event.listen(engine, "before_cursor_execute", before_execute)
+    event.listen(engine, "after_cursor_execute", after_execute)
+    event.listen(engine, "handle_error", on_error)
+    event.listen(engine, "checkin", on_checkin)
+
+
+def cancel_sessions(data):
+    """Cancel the statements sessions of `data` are running; returns how many were signalled."""
+    from . import engines
+
+    sessions = [int(session) for session in get_redis().hkeys(_sessions_key(data.id))]
+    if not sessions:
+        return 0
+    try:
+        engine = engines.get_data_engine(data)
+        statement = CANCEL_SQL.get(engine.dialect.name)
+        if statement is None:
+            return 0
+        with engine.connect() as connection:
+            for session in sessions:
+                connection.execute(text(statement.format(session=session)))
+    except SQLAlchemyError:
+        # the agent still stops at its next step
+        logger.exception("Couldn't cancel the running queries of data source %s", data.id)
+        return 0
+    return len(sessions)
+
+
+def cancel(data):
+    """Cancel every question of `data` asked until now."""
+    redis = get_redis()
+    redis.set(_epoch_key(data.id), time.time(), ex=settings.QUESTION_CANCEL_TTL)
+    task_ids = [task_id.decode() for task_id in redis.hkeys(_tasks_key(data.id))]
+    if task_ids:
+        current_app.control.revoke(task_ids)
+    return {"tasks": len(task_ids), "sessions": cancel_sessions(data)}
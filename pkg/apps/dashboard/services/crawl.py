@@ -1,6 +1,31 @@
+import logging
+import random
+import re
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
+from django.utils import timezone
+
+from common import aws
+
+from .. import models
 from ..wrappers import role_wrapper, policy_wrapper, bucket_wrapper, glue_wrapper
-import time
+
+logger = logging.getLogger(__name__)
+
+# Glue crawler State -> Crawl.State while a run is in progress
+CRAWLER_STATES = {
+    "RUNNING": models.Crawl.State.RUNNING,
+    "STOPPING": models.Crawl.State.STOPPING,
+}
+# LastCrawl.Status -> final Crawl.State once the crawler is READY again
+LAST_CRAWL_STATES = {
+    "SUCCEEDED": models.Crawl.State.SUCCEEDED,
+    "FAILED": models.Crawl.State.FAILED,
+    "CANCELLED": models.Crawl.State.CANCELLED,
+}
 
 
 def get_s3_policy_doc(bucket_name):
@@ -210,24 +235,105 @@ def get_jdbc_policy_doc(jdbc_secret_id):
     return policy_doc
 
 
-def create_policy(name, self.target_type):
-    policy_desc = f"This is {self.target_type} policy"
-    if self.target_type == "jdbc":
+def create_policy(name, target_type):
+    policy_desc = f"This is {target_type} policy"
+    if target_type == "jdbc":
         pass
-    elif self.target_type == "s3":
-        s3_resource = boto3.resource('s3')
-        bucket = bucket_wrapper.BucketWrapper(s3_resource.Bucket(settings.BUCKET_NAME)
+    elif target_type == "s3":
+        s3_resource = aws.get_resource('s3')
+        bucket = bucket_wrapper.BucketWrapper(s3_resource.Bucket(settings.BUCKET_NAME))
         if not bucket.exists():
             bucket.create()
-        policy_doc = get_s3_policy_doc()
+        policy_doc = get_s3_policy_doc(settings.BUCKET_NAME)
     
     policy = policy_wrapper.create_policy(name, policy_desc, policy_doc)
     return policy
 
 
+def get_glue():
+    glue_client = aws.get_client(
+        'glue',
+        aws_access_key_id=settings.DEV_ACCESS_KEY,
+        aws_secret_access_key=settings.DEV_SECRET_KEY,
+        region_name=settings.DEV_REGION,
+    )
+    return glue_wrapper.GlueWrapper(glue_client)
+
+
+def next_delay(polls):
+    """Exponential backoff between polls, jittered so crawls started together spread out."""
+    delay = min(settings.CRAWL_POLL_MAX_DELAY, settings.CRAWL_POLL_INITIAL_DELAY * 2 ** polls)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def advance(crawl: models.Crawl, crawler):
+    """
+    Move `crawl` to the state Glue reports in `crawler` (a GetCrawler description).
+    A missing crawler or a run past CRAWL_TIMEOUT counts as failed.
+    """
+    now = timezone.now()
+    if crawler is None:
+        crawl.state = models.Crawl.State.FAILED
+        crawl.error_message = "The crawler no longer exists"
+    elif crawler["State"] in CRAWLER_STATES:
+        crawl.state = CRAWLER_STATES[crawler["State"]]
+    elif crawler["State"] == "READY":
+        last = crawler.get("LastCrawl") or {}
+        started = last.get("StartTime")
+        # READY before the run shows up in LastCrawl means it hasn't started yet
+        if crawl.state != models.Crawl.State.STARTING or (started and started >= crawl.started_at):
+            crawl.state = LAST_CRAWL_STATES.get(last.get("Status"), models.Crawl.State.FAILED)
+            crawl.error_message = last.get("ErrorMessage", "")
+
+    if not crawl.is_finished and (now - crawl.started_at).total_seconds() > settings.CRAWL_TIMEOUT:
+        crawl.state = models.Crawl.State.FAILED
+        crawl.error_message = "Timed out waiting for the crawler"
+    if crawl.is_finished:
+        crawl.finished_at = now
+    return crawl.state
+
+
+def notify(crawl: models.Crawl):
+    if crawl.data_id is None:
+        return
+    async_to_sync(get_channel_layer().group_send)(f"chat_{crawl.data_id}", {
+        "type": "crawl_status",
+        "crawl_id": crawl.id,
+        "state": crawl.state,
+        "error_message": crawl.error_message,
+    })
+
+
+def poll(crawl: models.Crawl, glue=None):
+    """
+    Check the crawler once and persist the outcome. Returns the seconds until the
+    next poll, or None once the crawl is finished.
+    """
+    glue = glue or get_glue()
+    advance(crawl, glue.get_crawler(crawl.crawler_name))
+    crawl.polls += 1
+    delay = None if crawl.is_finished else next_delay(crawl.polls)
+    crawl.next_poll_at = timezone.now() + timedelta(seconds=delay) if delay else None
+
+    fields = ["state", "error_message", "polls", "next_poll_at", "finished_at"]
+    # only the poller that moves the crawl out of a running state reports it
+    updated = models.Crawl.objects.filter(
+        pk=crawl.pk
+    ).exclude(state__in=models.Crawl.FINAL_STATES).update(
+        **{field: getattr(crawl, field) for field in fields}
+    )
+    if updated and crawl.is_finished:
+        # re-read on next use; only the tables the crawl touched come back as changed
+        glue_wrapper.catalog_cache.expire(crawl.glue_db_name)
+        logger.info("Crawl %s finished: %s", crawl.crawler_name, crawl.state)
+        notify(crawl)
+    return delay
+
+
 class GlueIngestion:
-    def __init__(self, identifier, target_type="jdbc", target_path=None):
+    def __init__(self, identifier, target_type="jdbc", target_path=None, data=None):
         self.identifier = identifier
+        self.data = data
         self.target_type = target_type
         self.target_path = target_path
         self.role_name = settings.ROLE_NAME # AWSGlueServiceRole-custom
@@ -283,14 +389,7 @@ class GlueIngestion:
         
         role = self.get_iam_role()
         
-        glue_client = boto3.client(
-            'glue',
-            aws_access_key_id=settings.DEV_ACCESS_KEY,
-            aws_secret_access_key=settings.DEV_SECRET_KEY,
-            region_name=settings.DEV_REGION,
-        )
-        
-        glue = glue_wrapper.GlueWrapper(glue_client)
+        glue = get_glue()
         glue.create_database(self.glue_db_name)
         
         if self.target_type == "s3":
@@ -332,17 +431,24 @@ class GlueIngestion:
             target
         )
         
-        glue.start_crawler(self.glue_crawler_name)
-        
-        while True:
-            response = client.get_crawler(Name=glue_crawler_name)
-             # Extract the crawler state
-            status = response['Crawler']['State']
-            # Print the crawler status
-            print(f"Crawler '{glue_crawler_name}' status: {status}")
-            if status == 'READY':  # Replace 'READY' with the desired completed state
-                break  # Exit the loop if the desired state is reached
-    
-            time.sleep(5)  # Sleep for 10 seconds before checking the status again
+        # tasks.crawl_poll follows the crawler from here without holding a worker
+        from .. import tasks
         
-        
\ No newline at end of file
+        crawl = models.Crawl.objects.create(
+            data=self.data,
+            identifier=self.identifier,
+            crawler_name=self.glue_crawler_name,
+            glue_db_name=self.glue_db_name,
+            next_poll_at=timezone.now() + timedelta(seconds=settings.CRAWL_POLL_INITIAL_DELAY),
+        )
+        try:
+            glue.start_crawler(self.glue_crawler_name)
+        except Exception as e:
+            crawl.state = models.Crawl.State.FAILED
+            crawl.error_message = str(e)
+            crawl.finished_at = timezone.now()
+            crawl.next_poll_at = None
+            crawl.save()
+            raise
+        tasks.crawl_poll.apply_async((crawl.id, crawl.polls), countdown=settings.CRAWL_POLL_INITIAL_DELAY)
+        return crawl
@@ -0,0 +1,183 @@
+import hashlib
+import importlib.util
+import logging
+import threading
+import time
+
+from django.conf import settings
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .. import utils
+from . import cancellation, secrets
+
+logger = logging.getLogger(__name__)
+
+# asyncio drivers used by the async query path, by backend
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "mysql": "aiomysql",
+    "sqlite": "aiosqlite",
+}
+
+
+class EngineRegistry:
+    """
+    Process-wide registry of SQLAlchemy engines, one per data source and
+    credential version, so schema introspection and agents share a single
+    connection pool instead of opening a new one per question.
+    """
+    def __init__(self, pool_size=5, max_overflow=5, pool_recycle=1800, pool_pre_ping=True, idle_timeout=60 * 30):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.idle_timeout = idle_timeout
+        self._engines = {}
+        self._async_engines = {}
+        self._lock = threading.RLock()
+        self.created = 0
+        self.disposed = 0
+
+    @staticmethod
+    def credential_version(conn_str):
+        return hashlib.sha1(conn_str.encode()).hexdigest()[:12]
+
+    def _engine_kwargs(self, conn_str):
+        kwargs = {
+            "echo": False,
+            "pool_pre_ping": self.pool_pre_ping,
+            "pool_recycle": self.pool_recycle,
+        }
+        # SQLite uses a non-queue pool that rejects sizing arguments
+        if make_url(conn_str).get_backend_name() != "sqlite":
+            kwargs["pool_size"] = self.pool_size
+            kwargs["max_overflow"] = self.max_overflow
+        return kwargs
+
+    def get_engine(self, data_id, conn_str):
+        key = (str(data_id), self.credential_version(conn_str))
+        with self._lock:
+            self.dispose_idle()
+            entry = self._engines.get(key)
+            if entry is None:
+                # Credentials changed: the pools built with the old ones are stale
+                self.dispose(data_id)
+                engine = create_engine(conn_str, **self._engine_kwargs(conn_str))
+                cancellation.watch(engine, data_id, settings.DATA_SOURCE_STATEMENT_TIMEOUT)
+                self.created += 1
+                logger.info("Created engine for data source %s", data_id)
+            else:
+                engine = entry[0]
+            self._engines[key] = (engine, time.monotonic())
+            return engine
+
+    def get_async_engine(self, data_id, conn_str):
+        """
+        AsyncEngine for the source, or None when its backend has no asyncio
+        driver installed. Shares the sync engine's lifetime and pool settings.
+        """
+        url = make_url(conn_str)
+        driver = ASYNC_DRIVERS.get(url.get_backend_name())
+        if driver is None or importlib.util.find_spec(driver) is None:
+            return None
+        key = (str(data_id), self.credential_version(conn_str))
+        with self._lock:
+            entry = self._async_engines.get(key)
+            if entry is None:
+                engine = create_async_engine(
+                    url.set(drivername=f"{url.get_backend_name()}+{driver}"),
+                    **self._engine_kwargs(conn_str)
+                )
+                # queries on the loop are cancelled with their asyncio task, only the timeout applies
+                event.listen(
+                    engine.sync_engine, "connect",
+                    cancellation.configure_session(engine.dialect.name, settings.DATA_SOURCE_STATEMENT_TIMEOUT)
+                )
+                self.created += 1
+                logger.info("Created async engine for data source %s", data_id)
+            else:
+                engine = entry[0]
+            self._async_engines[key] = (engine, time.monotonic())
+            return engine
+
+    def touch(self, data_id):
+        """Mark the source's engines as used, e.g. when a cached agent holding them answers."""
+        now = time.monotonic()
+        with self._lock:
+            for engines in (self._engines, self._async_engines):
+                for key, (engine, _) in engines.items():
+                    if key[0] == str(data_id):
+                        engines[key] = (engine, now)
+
+    def _dispose_keys(self, keys):
+        for key in keys:
+            for engines in (self._engines, self._async_engines):
+                if key in engines:
+                    engine, _ = engines.pop(key)
+                    # AsyncEngine.dispose is a coroutine; its sync engine closes the same pool
+                    getattr(engine, "sync_engine", engine).dispose()
+                    self.disposed += 1
+
+    def dispose(self, data_id):
+        with self._lock:
+            self._dispose_keys({
+                key for key in [*self._engines, *self._async_engines] if key[0] == str(data_id)
+            })
+
+    def dispose_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            keys = {
+                key
+                for engines in (self._engines, self._async_engines)
+                for key, (_, last_used) in engines.items()
+                if now - last_used > self.idle_timeout
+            }
+            self._dispose_keys(keys)
+            for key in keys:
+                logger.info("Disposed idle engine for data source %s", key[0])
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            pools = {}
+            for (data_id, version), (engine, last_used) in self._engines.items():
+                pool = engine.pool
+                pools[data_id] = {
+                    "credential_version": version,
+                    "status": pool.status(),
+                    "checked_out": getattr(pool, "checkedout", lambda: None)(),
+                    "idle_seconds": round(time.monotonic() - last_used, 1),
+                }
+            return {
+                "engines": len(self._engines),
+                "created": self.created,
+                "disposed": self.disposed,
+                "async_engines": len(self._async_engines),
+                "pools": pools,
+            }
+
+
+registry = EngineRegistry(
+    pool_size=settings.DATA_SOURCE_POOL_SIZE,
+    max_overflow=settings.DATA_SOURCE_POOL_MAX_OVERFLOW,
+    pool_recycle=settings.DATA_SOURCE_POOL_RECYCLE,
+    pool_pre_ping=settings.DATA_SOURCE_POOL_PRE_PING,
+    idle_timeout=settings.DATA_SOURCE_POOL_IDLE_TIMEOUT,
+)
+
+
+def get_engine(data, conn_str):
+    return registry.get_engine(data.id, conn_str)
+
+
+def get_async_engine(data, conn_str):
+    return registry.get_async_engine(data.id, conn_str)
+
+
+def get_data_engine(data):
+    """Engine for `data` using the credentials stored for its owner."""
+    username, password = secrets.get_secret_value(utils.generate_identifier(data.user, data))
+    return get_engine(data, data.conn_str(username, password))
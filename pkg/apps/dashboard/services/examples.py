@@ -0,0 +1,172 @@
+"""
+Few-shot examples from past answers.
+
+Every AI message that ran SQL records the question it answered. Per source,
+those (question, SQL) pairs are kept in a process-local index of hashed
+word and word-pair vectors, searched by brute-force cosine similarity with
+NumPy. The queries that answered the most similar earlier questions are
+appended to the question handed to the SQL agent, so it can reuse their
+tables and joins instead of rediscovering them step by step.
+
+Indexes are loaded on first use. New answers are added as messages are saved
+in this process and picked up from the database by other processes on their
+next lookup.
+"""
+import hashlib
+import math
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from .. import models
+from .table_index import tokenize
+
+DIMENSIONS = 2 ** 12
+
+# too common in questions to say anything about which tables answer them
+STOPWORDS = {
+    "a", "an", "and", "are", "by", "can", "did", "do", "doe", "for", "from", "give",
+    "how", "i", "in", "is", "it", "list", "many", "me", "much", "of", "on", "or",
+    "show", "that", "the", "there", "to", "wa", "we", "were", "what", "when",
+    "where", "which", "who", "with",
+}
+
+# answers that ran SQL but didn't answer the question
+_FAILED_ANSWERS = ("agent stopped", "i don't know", "i don’t know")
+
+
+def embed(text):
+    """L2-normalized signed feature hashing of the question's words and word pairs."""
+    words = [token for token in tokenize(text) if token not in STOPWORDS]
+    features = Counter(words + [f"{a} {b}" for a, b in zip(words, words[1:])])
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for feature, count in features.items():
+        digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+        sign = 1.0 if digest & 1 else -1.0
+        vector[(digest >> 1) % DIMENSIONS] += sign * (1 + math.log(count))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _normalize(question):
+    return " ".join(tokenize(question))
+
+
+class ExampleIndex:
+    def __init__(self, capacity=64):
+        self.vectors = np.zeros((capacity, DIMENSIONS), dtype=np.float32)
+        self.examples = []
+        self._rows = {}
+        self.last_pk = None
+
+    def __len__(self):
+        return len(self.examples)
+
+    def add(self, question, sql_query):
+        """Add a pair; a question asked again replaces its earlier SQL."""
+        key = _normalize(question)
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self.examples)
+            if row == len(self.vectors):
+                grown = np.zeros((2 * len(self.vectors), DIMENSIONS), dtype=np.float32)
+                grown[:row] = self.vectors
+                self.vectors = grown
+            self._rows[key] = row
+            self.examples.append(None)
+        self.vectors[row] = embed(question)
+        self.examples[row] = (question, sql_query)
+
+    def search(self, question, k, min_similarity=0.0, exclude=None):
+        """Up to `k` (question, sql, similarity) of the most similar pairs, most similar first."""
+        if not self.examples:
+            return []
+        scores = self.vectors[:len(self.examples)] @ embed(question)
+        if exclude is not None and _normalize(exclude) in self._rows:
+            scores[self._rows[_normalize(exclude)]] = -1
+        matching = np.flatnonzero(scores >= max(min_similarity, 1e-6))
+        if len(matching) > k:
+            matching = matching[np.argpartition(-scores[matching], k - 1)[:k]]
+        ranked = matching[np.argsort(-scores[matching])]
+        return [(*self.examples[i], float(scores[i])) for i in ranked]
+
+
+def answered(data, after=None):
+    messages = models.Message.objects.filter(
+        source=data, is_ai=True, sql_query__isnull=False, question__isnull=False
+    )
+    if after is not None:
+        messages = messages.filter(pk__gt=after)
+    return messages.order_by("pk").values_list("pk", "question", "sql_query", "text")
+
+
+def _usable(text):
+    return not (text or "").strip().lower().startswith(_FAILED_ANSWERS)
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+_MAX_INDEXES = 64
+
+
+def get_index(data):
+    """The source's index, caught up with the answers saved since it was last read."""
+    key = int(data.id)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = ExampleIndex()
+            while len(_indexes) > _MAX_INDEXES:
+                _indexes.popitem(last=False)
+        _indexes.move_to_end(key)
+        after = index.last_pk
+    # the query runs unlocked so lookups of other sources don't wait on it
+    rows = list(answered(data, after))
+    with _lock:
+        for pk, question, sql_query, text in rows:
+            if index.last_pk is not None and int(pk) <= int(index.last_pk):
+                # applied by a thread that caught up at the same time
+                continue
+            if _usable(text):
+                index.add(question, sql_query)
+            index.last_pk = pk
+    return index
+
+
+def add(message):
+    """Add a saved AI message to this process' index of its source, if loaded."""
+    with _lock:
+        index = _indexes.get(int(message.source_id))
+        # last_pk stays put: answers saved by other processes before this one are still to be read
+        if index is not None and _usable(message.text):
+            index.add(message.question, message.sql_query)
+
+
+def similar(data, question, k=None, exclude=None):
+    """(question, sql, similarity) of the past answers closest to `question`."""
+    return get_index(data).search(
+        question,
+        k or settings.FEW_SHOT_EXAMPLES,
+        min_similarity=settings.FEW_SHOT_MIN_SIMILARITY,
+        exclude=exclude,
+    )
+
+
+def augment(data, question, exclude=None):
+    """The question to hand the agent: `question` followed by the queries of similar past questions."""
+    if not settings.FEW_SHOT_EXAMPLES or not data.is_db:
+        return question
+    found = similar(data, question, exclude=exclude)
+    if not found:
+        return question
+    lines = [
+        question,
+        "",
+        "These queries answered similar questions on this database before; "
+        "reuse their tables and joins where they fit:",
+    ]
+    for past_question, sql_query, _ in found:
+        lines.append(f'- "{past_question}": {sql_query}')
+    return "\n".join(lines)
@@ -0,0 +1,161 @@
+"""
+Fair-share dispatch of chat questions to Celery.
+
+Questions wait in per-user Redis queues instead of going straight onto the
+broker, and are released to `tasks.return_query_resp` by stride scheduling:
+every user has a pass value that grows by 1/weight per dispatched question and
+the user with the lowest pass goes next, so a heavier subscription tier gets
+proportionally more turns and nobody is starved. Only FAIR_SHARE_MAX_IN_FLIGHT
+questions are on the broker at a time, at most FAIR_SHARE_MAX_IN_FLIGHT_PER_USER
+of them per user, so one user's backlog queues behind everyone else's first
+question instead of in front of it.
+"""
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+
+from common.utils import get_redis
+
+from . import cancellation
+
+PREFIX = "fairshare:"
+READY_KEY = f"{PREFIX}ready"        # zset user -> pass, users with queued questions
+IN_FLIGHT_KEY = f"{PREFIX}inflight" # zset job -> dispatch time, all users
+PASS_KEY = f"{PREFIX}pass"          # hash user -> pass, kept while the user is idle
+STRIDE_KEY = f"{PREFIX}stride"      # hash user -> 1 / weight
+VTIME_KEY = f"{PREFIX}vtime"        # pass of the last dispatched question
+
+# KEYS: user queue, ready, pass, stride, vtime  ARGV: job, user, stride
+_PUSH = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+if not redis.call('ZSCORE', KEYS[2], ARGV[2]) then
+    -- a returning user resumes at the current virtual time, idling earns no credit
+    local own = tonumber(redis.call('HGET', KEYS[3], ARGV[2])) or 0
+    local vtime = tonumber(redis.call('GET', KEYS[5])) or 0
+    redis.call('ZADD', KEYS[2], math.max(own, vtime), ARGV[2])
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# KEYS: ready, in-flight, pass, stride, vtime
+# ARGV: now, max in flight, max per user, timeout, key prefix
+# Returns the next job to dispatch, or nil when nothing may start now.
+_NEXT = """
+local now = tonumber(ARGV[1])
+local expired = now - tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', expired)
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[2]) then
+    return nil
+end
+local ready = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+for i = 1, #ready, 2 do
+    local user = ready[i]
+    local pass = tonumber(ready[i + 1])
+    local queue = ARGV[5] .. 'queue:' .. user
+    local in_flight = ARGV[5] .. 'inflight:' .. user
+    redis.call('ZREMRANGEBYSCORE', in_flight, '-inf', expired)
+    if redis.call('ZCARD', in_flight) < tonumber(ARGV[3]) then
+        local job = redis.call('LPOP', queue)
+        if not job then
+            redis.call('ZREM', KEYS[1], user)
+        else
+            local id = cjson.decode(job)['id']
+            redis.call('ZADD', in_flight, now, id)
+            redis.call('EXPIRE', in_flight, ARGV[4])
+            redis.call('ZADD', KEYS[2], now, id)
+            local next_pass = pass + (tonumber(redis.call('HGET', KEYS[4], user)) or 1)
+            redis.call('SET', KEYS[5], math.max(pass, tonumber(redis.call('GET', KEYS[5])) or 0))
+            redis.call('HSET', KEYS[3], user, next_pass)
+            if redis.call('LLEN', queue) == 0 then
+                redis.call('ZREM', KEYS[1], user)
+            else
+                redis.call('ZADD', KEYS[1], next_pass, user)
+            end
+            return job
+        end
+    end
+end
+return nil
+"""
+
+
+def weight(user_id):
+    """Highest FAIR_SHARE_WEIGHTS entry among the user's subscription plan groups (see finances.utils)."""
+    names = Group.objects.filter(user__id=user_id).values_list("name", flat=True)
+    weights = [settings.FAIR_SHARE_WEIGHTS[name] for name in names if name in settings.FAIR_SHARE_WEIGHTS]
+    return max(weights, default=settings.FAIR_SHARE_DEFAULT_WEIGHT)
+
+
+def submit(query, user_id, data_id, model, flight_key=None, use_cache=True, asked_at=None):
+    """Queue a question for `tasks.return_query_resp` and dispatch what may start now."""
+    job = {
+        "id": uuid.uuid4().hex,
+        "query": query,
+        "user_id": str(user_id),
+        "data_id": str(data_id),
+        "model": model,
+        "flight_key": flight_key,
+        "use_cache": use_cache,
+        "asked_at": asked_at or time.time(),
+    }
+    get_redis().register_script(_PUSH)(
+        keys=[f"{PREFIX}queue:{user_id}", READY_KEY, PASS_KEY, STRIDE_KEY, VTIME_KEY],
+        args=[json.dumps(job), str(user_id), 1 / weight(user_id)],
+    )
+    drain()
+    return job["id"]
+
+
+def drain():
+    """Send queued questions to Celery while the in-flight caps allow; returns how many."""
+    from .. import tasks
+
+    next_job = get_redis().register_script(_NEXT)
+    dispatched = 0
+    while True:
+        job = next_job(
+            keys=[READY_KEY, IN_FLIGHT_KEY, PASS_KEY, STRIDE_KEY, VTIME_KEY],
+            args=[
+                time.time(),
+                settings.FAIR_SHARE_MAX_IN_FLIGHT,
+                settings.FAIR_SHARE_MAX_IN_FLIGHT_PER_USER,
+                settings.FAIR_SHARE_TIMEOUT,
+                PREFIX,
+            ],
+        )
+        if job is None:
+            return dispatched
+        job = json.loads(job)
+        result = tasks.return_query_resp.delay(
+            job["query"], job["user_id"], job["data_id"], job["model"],
+            flight_key=job["flight_key"], use_cache=job["use_cache"], job_id=job["id"],
+            asked_at=job.get("asked_at"),
+        )
+        # so stopping the chat can revoke it
+        cancellation.track_task(job["data_id"], result.id)
+        dispatched += 1
+
+
+def release(user_id, job_id):
+    """Mark a dispatched question finished and let the next one start."""
+    pipe = get_redis().pipeline()
+    pipe.zrem(f"{PREFIX}inflight:{user_id}", job_id)
+    pipe.zrem(IN_FLIGHT_KEY, job_id)
+    pipe.execute()
+    return drain()
+
+
+def stats():
+    redis = get_redis()
+    users = redis.zrange(READY_KEY, 0, -1, withscores=True)
+    return {
+        "in_flight": redis.zcard(IN_FLIGHT_KEY),
+        "queued": {
+            user.decode(): {"pass": round(pass_, 3), "queued": redis.llen(f"{PREFIX}queue:{user.decode()}")}
+            for user, pass_ in users
+        },
+    }
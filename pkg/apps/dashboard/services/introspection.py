@@ -0,0 +1,336 @@
+"""
+Bulk catalog introspection.
+
+`introspect` reads the columns, primary keys and foreign keys of every table in
+a schema with a handful of catalog queries instead of three inspector round
+trips per table. Dialects without a bulk backend, or whose catalog query fails
+(permissions, unusual engines), fall back to the SQLAlchemy inspector.
+
+The result maps each table name to::
+
+    {"columns": [(name, type), ...], "primary_keys": [name, ...], "foreign_keys": {column: referred_table}}
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+
+def _empty_table():
+    return {"columns": [], "primary_keys": [], "foreign_keys": {}}
+
+
+def _collect(conn, columns_sql, pk_sql, fk_sql, params, normalize=None):
+    normalize = normalize or (lambda name: name)
+    tables = OrderedDict()
+    for table_name, column_name, data_type in conn.execute(text(columns_sql), params):
+        table = tables.setdefault(normalize(table_name), _empty_table())
+        table["columns"].append((normalize(column_name), data_type))
+    for table_name, column_name in conn.execute(text(pk_sql), params):
+        if normalize(table_name) in tables:
+            tables[normalize(table_name)]["primary_keys"].append(normalize(column_name))
+    for table_name, column_name, referred_table in conn.execute(text(fk_sql), params):
+        if normalize(table_name) in tables:
+            tables[normalize(table_name)]["foreign_keys"][normalize(column_name)] = normalize(referred_table)
+    return tables
+
+
+def _postgresql(conn, schema, dialect):
+    columns_sql = """
+        SELECT c.table_name, c.column_name, c.data_type
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+            ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = :schema AND t.table_type = 'BASE TABLE'
+        ORDER BY c.table_name, c.ordinal_position
+    """
+    # constraint names are only unique per table, so keys are read from pg_constraint by
+    # table oid; ANY(conkey) gives one row per constrained column, also for composite keys
+    pk_sql = """
+        SELECT cl.relname, a.attname
+        FROM pg_catalog.pg_constraint con
+        JOIN pg_catalog.pg_class cl ON cl.oid = con.conrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = cl.relnamespace
+        JOIN pg_catalog.pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = ANY(con.conkey)
+        WHERE con.contype = 'p' AND n.nspname = :schema
+        ORDER BY cl.relname, a.attnum
+    """
+    fk_sql = """
+        SELECT cl.relname, a.attname, ref.relname
+        FROM pg_catalog.pg_constraint con
+        JOIN pg_catalog.pg_class cl ON cl.oid = con.conrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = cl.relnamespace
+        JOIN pg_catalog.pg_class ref ON ref.oid = con.confrelid
+        JOIN pg_catalog.pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = ANY(con.conkey)
+        WHERE con.contype = 'f' AND n.nspname = :schema
+    """
+    return _collect(conn, columns_sql, pk_sql, fk_sql, {"schema": schema})
+
+
+def _mysql(conn, schema, dialect):
+    columns_sql = """
+        SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE
+        FROM information_schema.COLUMNS c
+        JOIN information_schema.TABLES t
+            ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+        WHERE c.TABLE_SCHEMA = :schema AND t.TABLE_TYPE = 'BASE TABLE'
+        ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+    """
+    pk_sql = """
+        SELECT TABLE_NAME, COLUMN_NAME
+        FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = :schema AND CONSTRAINT_NAME = 'PRIMARY'
+    """
+    fk_sql = """
+        SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME
+        FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = :schema AND REFERENCED_TABLE_NAME IS NOT NULL
+    """
+    return _collect(conn, columns_sql, pk_sql, fk_sql, {"schema": schema})
+
+
+def _mssql(conn, schema, dialect):
+    columns_sql = """
+        SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE
+        FROM INFORMATION_SCHEMA.COLUMNS c
+        JOIN INFORMATION_SCHEMA.TABLES t
+            ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+        WHERE c.TABLE_SCHEMA = :schema AND t.TABLE_TYPE = 'BASE TABLE'
+        ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+    """
+    pk_sql = """
+        SELECT kcu.TABLE_NAME, kcu.COLUMN_NAME
+        FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
+        JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
+            ON kcu.CONSTRAINT_NAME = tc.CONSTRAINT_NAME AND kcu.CONSTRAINT_SCHEMA = tc.CONSTRAINT_SCHEMA
+        WHERE tc.CONSTRAINT_TYPE = 'PRIMARY KEY' AND tc.TABLE_SCHEMA = :schema
+    """
+    fk_sql = """
+        SELECT kcu.TABLE_NAME, kcu.COLUMN_NAME, pk.TABLE_NAME
+        FROM INFORMATION_SCHEMA.REFERENTIAL_CONSTRAINTS rc
+        JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
+            ON kcu.CONSTRAINT_NAME = rc.CONSTRAINT_NAME AND kcu.CONSTRAINT_SCHEMA = rc.CONSTRAINT_SCHEMA
+        JOIN INFORMATION_SCHEMA.TABLE_CONSTRAINTS pk
+            ON pk.CONSTRAINT_NAME = rc.UNIQUE_CONSTRAINT_NAME AND pk.CONSTRAINT_SCHEMA = rc.UNIQUE_CONSTRAINT_SCHEMA
+        WHERE kcu.TABLE_SCHEMA = :schema
+    """
+    return _collect(conn, columns_sql, pk_sql, fk_sql, {"schema": schema})
+
+
+def _oracle(conn, schema, dialect):
+    columns_sql = """
+        SELECT c.table_name, c.column_name, c.data_type
+        FROM all_tab_columns c
+        JOIN all_tables t ON t.owner = c.owner AND t.table_name = c.table_name
+        WHERE c.owner = :schema
+        ORDER BY c.table_name, c.column_id
+    """
+    pk_sql = """
+        SELECT cc.table_name, cc.column_name
+        FROM all_constraints c
+        JOIN all_cons_columns cc ON cc.owner = c.owner AND cc.constraint_name = c.constraint_name
+        WHERE c.constraint_type = 'P' AND c.owner = :schema
+    """
+    fk_sql = """
+        SELECT cc.table_name, cc.column_name, r.table_name
+        FROM all_constraints c
+        JOIN all_cons_columns cc ON cc.owner = c.owner AND cc.constraint_name = c.constraint_name
+        JOIN all_constraints r ON r.owner = c.r_owner AND r.constraint_name = c.r_constraint_name
+        WHERE c.constraint_type = 'R' AND c.owner = :schema
+    """
+    return _collect(
+        conn, columns_sql, pk_sql, fk_sql,
+        {"schema": dialect.denormalize_name(schema)},
+        normalize=dialect.normalize_name
+    )
+
+
+def _snowflake(conn, schema, dialect):
+    normalize = dialect.normalize_name
+    tables = OrderedDict()
+    columns_sql = """
+        SELECT c.table_name, c.column_name, c.data_type
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+            ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = :schema AND t.table_type = 'BASE TABLE'
+        ORDER BY c.table_name, c.ordinal_position
+    """
+    for table_name, column_name, data_type in conn.execute(text(columns_sql), {"schema": dialect.denormalize_name(schema)}):
+        table = tables.setdefault(normalize(table_name), _empty_table())
+        table["columns"].append((normalize(column_name), data_type))
+
+    # Key columns are only exposed through SHOW commands, which cannot be bound
+    quoted_schema = dialect.identifier_preparer.quote_identifier(dialect.denormalize_name(schema))
+    for row in conn.execute(text(f"SHOW PRIMARY KEYS IN SCHEMA {quoted_schema}")):
+        row = row._mapping
+        table = tables.get(normalize(row["table_name"]))
+        if table is not None:
+            table["primary_keys"].append(normalize(row["column_name"]))
+    for row in conn.execute(text(f"SHOW IMPORTED KEYS IN SCHEMA {quoted_schema}")):
+        row = row._mapping
+        table = tables.get(normalize(row["fk_table_name"]))
+        if table is not None:
+            table["foreign_keys"][normalize(row["fk_column_name"])] = normalize(row["pk_table_name"])
+    return tables
+
+
+def _sqlite(conn, schema, dialect):
+    # pragma table-valued functions read the whole catalog in one statement each
+    columns_sql = """
+        SELECT m.name, p.name, p.type
+        FROM sqlite_master m JOIN pragma_table_info(m.name) p
+        WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+        ORDER BY m.name, p.cid
+    """
+    pk_sql = """
+        SELECT m.name, p.name
+        FROM sqlite_master m JOIN pragma_table_info(m.name) p
+        WHERE m.type = 'table' AND p.pk > 0
+    """
+    fk_sql = """
+        SELECT m.name, f."from", f."table"
+        FROM sqlite_master m JOIN pragma_foreign_key_list(m.name) f
+        WHERE m.type = 'table'
+    """
+    return _collect(conn, columns_sql, pk_sql, fk_sql, {})
+
+
+def format_schema(tables):
+    """Render introspected tables as the `table|column` text stored on `Data.schema`."""
+    columns_str = ''
+    for table_name, table in tables.items():
+        primary_keys = table["primary_keys"]
+        foreign_keys = table["foreign_keys"]
+        for name, type in table["columns"]:
+            column = name
+            if name in primary_keys:
+                column += f"({type})-pk"
+            
+            if name in foreign_keys:
+                column += f"-fk({foreign_keys[name]})"
+            columns_str = columns_str + f'\n{table_name}|{column}'
+    return columns_str
+
+
+BACKENDS = {
+    "postgresql": _postgresql,
+    "redshift": _postgresql,
+    "mysql": _mysql,
+    "mariadb": _mysql,
+    "mssql": _mssql,
+    "oracle": _oracle,
+    "snowflake": _snowflake,
+    "sqlite": _sqlite,
+}
+
+
+def inspector_introspect(engine, schema=None, table_names=None):
+    """
+    Per-table fallback using the SQLAlchemy inspector (3N+1 round trips).
+    Pass `table_names` to introspect only those tables.
+    """
+    inspector = inspect(engine)
+    schema = schema or inspector.default_schema_name
+    tables = OrderedDict()
+    if table_names is None:
+        table_names = inspector.get_table_names(schema)
+    for table_name in table_names:
+        table = tables.setdefault(table_name, _empty_table())
+        for col in inspector.get_columns(table_name, schema):
+            table["columns"].append((col.get("name"), col.get("type")))
+        table["primary_keys"] = list(
+            inspector.get_pk_constraint(table_name, schema).get("constrained_columns") or []
+        )
+        for fk in inspector.get_foreign_keys(table_name, schema):
+            for column in fk["constrained_columns"]:
+                table["foreign_keys"][column] = fk["referred_table"]
+    return tables
+
+
+def introspect(engine, schema=None):
+    """
+    Return the columns, primary keys and foreign keys of every table in `schema`
+    (the connection's default schema when omitted).
+    """
+    dialect = engine.dialect
+    backend = BACKENDS.get(dialect.name)
+    if backend is not None:
+        try:
+            with engine.connect() as conn:
+                if schema is None and dialect.name != "sqlite":
+                    schema = dialect.default_schema_name or inspect(conn).default_schema_name
+                return backend(conn, schema, dialect)
+        except Exception:
+            logger.warning(
+                "Bulk introspection failed for %s, falling back to the inspector",
+                dialect.name, exc_info=True
+            )
+    return inspector_introspect(engine, schema)
+
+
+# Cheap per-table values that change whenever a table's definition changes.
+# They are compared between refreshes to find which tables need re-introspection.
+FINGERPRINT_QUERIES = {
+    # the pg_class row is rewritten (new xmin) by every ALTER TABLE
+    "postgresql": """
+        SELECT c.relname, c.xmin::text || ':' || c.relnatts
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')
+    """,
+    "mysql": """
+        SELECT TABLE_NAME, CONCAT(COALESCE(CREATE_TIME, ''), ':', COALESCE(UPDATE_TIME, ''))
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = :schema AND TABLE_TYPE = 'BASE TABLE'
+    """,
+    "mssql": """
+        SELECT o.name, CONVERT(varchar(33), o.modify_date, 126)
+        FROM sys.objects o JOIN sys.schemas s ON s.schema_id = o.schema_id
+        WHERE s.name = :schema AND o.type = 'U'
+    """,
+    "oracle": """
+        SELECT object_name, TO_CHAR(last_ddl_time, 'YYYY-MM-DD HH24:MI:SS')
+        FROM all_objects
+        WHERE owner = :schema AND object_type = 'TABLE'
+    """,
+    "snowflake": """
+        SELECT table_name, TO_VARCHAR(last_altered)
+        FROM information_schema.tables
+        WHERE table_schema = :schema AND table_type = 'BASE TABLE'
+    """,
+    "sqlite": """
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+    """,
+}
+FINGERPRINT_QUERIES["mariadb"] = FINGERPRINT_QUERIES["mysql"]
+
+
+def catalog_fingerprints(engine, schema=None):
+    """
+    Return {table: fingerprint} for every table in `schema` with one catalog
+    query, or None when the dialect has no cheap way to tell tables apart.
+    """
+    dialect = engine.dialect
+    query = FINGERPRINT_QUERIES.get(dialect.name)
+    if query is None:
+        return None
+    normalize = (lambda name: name)
+    if dialect.name in ("oracle", "snowflake"):
+        normalize = dialect.normalize_name
+    try:
+        with engine.connect() as conn:
+            if schema is None and dialect.name != "sqlite":
+                schema = dialect.default_schema_name or inspect(conn).default_schema_name
+            if dialect.name in ("oracle", "snowflake"):
+                schema = dialect.denormalize_name(schema)
+            return {
+                normalize(table_name): hashlib.sha1(str(fingerprint).encode()).hexdigest()
+                for table_name, fingerprint in conn.execute(text(query), {"schema": schema})
+            }
+    except Exception:
+        logger.warning("Couldn't read catalog fingerprints for %s", dialect.name, exc_info=True)
+        return None
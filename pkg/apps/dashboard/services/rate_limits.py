@@ -0,0 +1,164 @@
+"""
+Redis token buckets for LLM traffic shared by every Celery worker.
+
+Each LLM call draws one request and an estimated number of tokens from the
+requests-per-minute and tokens-per-minute buckets of its API key, user and
+data source (see callbacks.RateLimitHandler). When any bucket is short nothing
+is taken and the caller gets the number of seconds to wait, so over-limit work
+is delayed instead of failing with a 429 from OpenAI. After the call `settle`
+charges the difference between the estimate and the tokens actually used.
+
+A per-user concurrency slot caps how many questions run at the same time.
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+
+from common.utils import get_redis
+
+# KEYS: bucket keys  ARGV: now, then (capacity, refill per second, cost) per key.
+# Takes from every bucket or from none; returns seconds until all could be served.
+_ACQUIRE = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (math.min(cost, capacity) - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    redis.call('HSET', key, 'tokens', levels[i] - cost, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 60)
+end
+return '0'
+"""
+
+# KEYS: bucket keys  ARGV: now, amount. Charges (or refunds) without waiting.
+_SETTLE = """
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HINCRBYFLOAT', key, 'tokens', -tonumber(ARGV[2]))
+    end
+end
+return 0
+"""
+
+
+class RateLimited(Exception):
+    """A bucket is short; `wait` is the number of seconds until it can serve the call."""
+    def __init__(self, wait):
+        super().__init__(f"Rate limited, retry in {wait:.1f}s")
+        self.wait = wait
+
+
+def scopes(user_id, data_id, api_key=None):
+    """The (scope, id) pairs a question is limited by."""
+    api_key = api_key or settings.OPENAI_API_KEY
+    return [
+        ("key", hashlib.sha1(api_key.encode()).hexdigest()[:12]),
+        ("user", str(user_id)),
+        ("data", str(data_id)),
+    ]
+
+
+def _bucket_key(scope, scope_id, kind):
+    return f"ratelimit:{scope}:{scope_id}:{kind}"
+
+
+def _buckets(scope_ids, tokens):
+    """[(key, capacity, refill per second, cost)] for the rpm and tpm bucket of each scope."""
+    buckets = []
+    for scope, scope_id in scope_ids:
+        limits = settings.LLM_RATE_LIMITS.get(scope, {})
+        for kind, cost in (("rpm", 1), ("tpm", tokens)):
+            limit = limits.get(kind)
+            if limit:
+                buckets.append((_bucket_key(scope, scope_id, kind), limit, limit / 60, cost))
+    return buckets
+
+
+def acquire(scope_ids, tokens=None):
+    """
+    Take one request and `tokens` (default: the configured estimate) from every
+    bucket. Returns 0 when granted, otherwise the seconds to wait before retrying.
+    """
+    tokens = settings.LLM_ESTIMATED_TOKENS if tokens is None else tokens
+    buckets = _buckets(scope_ids, tokens)
+    if not buckets:
+        return 0
+    args = [time.time()]
+    for _, capacity, rate, cost in buckets:
+        args.extend([capacity, rate, cost])
+    wait = get_redis().register_script(_ACQUIRE)(keys=[b[0] for b in buckets], args=args)
+    return float(wait)
+
+
+def settle(scope_ids, used_tokens, estimated_tokens=None):
+    """Charge the tpm buckets for the tokens used beyond (or refund below) the estimate."""
+    estimated_tokens = settings.LLM_ESTIMATED_TOKENS if estimated_tokens is None else estimated_tokens
+    difference = used_tokens - estimated_tokens
+    keys = [key for key, _, _, _ in _buckets(scope_ids, 0) if key.endswith(":tpm")]
+    if difference and keys:
+        get_redis().register_script(_SETTLE)(keys=keys, args=[time.time(), difference])
+
+
+def state(scope, scope_id):
+    """Current {kind: (level, capacity)} of a scope's buckets, for the admin."""
+    redis = get_redis()
+    now = time.time()
+    result = {}
+    for kind, limit in settings.LLM_RATE_LIMITS.get(scope, {}).items():
+        if not limit:
+            continue
+        tokens, ts = redis.hmget(_bucket_key(scope, scope_id, kind), "tokens", "ts")
+        level = limit
+        if tokens is not None:
+            level = min(limit, float(tokens) + (now - float(ts)) * limit / 60)
+        result[kind] = (int(level), limit)
+    return result
+
+
+def acquire_slot(user_id):
+    """
+    Take one of the user's concurrent question slots. Returns a slot id, or None
+    when all are busy. Slots of crashed workers expire after LLM_SLOT_TIMEOUT.
+    """
+    key = f"ratelimit:slots:{user_id}"
+    slot = uuid.uuid4().hex
+    now = time.time()
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.zremrangebyscore(key, "-inf", now - settings.LLM_SLOT_TIMEOUT)
+    pipe.zadd(key, {slot: now})
+    pipe.zrank(key, slot)
+    pipe.expire(key, settings.LLM_SLOT_TIMEOUT)
+    _, _, rank, _ = pipe.execute()
+    if rank >= settings.LLM_MAX_CONCURRENT_PER_USER:
+        redis.zrem(key, slot)
+        return None
+    return slot
+
+
+def release_slot(user_id, slot):
+    get_redis().zrem(f"ratelimit:slots:{user_id}", slot)
+
+
+def running(user_id):
+    return get_redis().zcard(f"ratelimit:slots:{user_id}")
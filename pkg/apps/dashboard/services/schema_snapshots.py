@@ -0,0 +1,147 @@
+"""
+Versioned schema snapshots of database data sources.
+
+Each `Data` row keeps one `SchemaTable` per table with its columns and a
+content hash. A refresh compares cheap catalog fingerprints with the stored
+ones and re-introspects only the tables whose definition moved, so large
+sources pay in proportion to what changed. `Data.schema_hash` summarises the
+whole snapshot and is what caches and agents compare to decide whether to reload.
+"""
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from django.db import transaction
+from django.utils import timezone
+
+from .. import models
+from . import answer_cache, introspection, sql_cache
+
+logger = logging.getLogger(__name__)
+
+# Above this share of changed tables one bulk pass is cheaper than per-table inspection
+INCREMENTAL_MAX_SHARE = 0.2
+INCREMENTAL_MIN_TABLES = 20
+
+
+def table_hash(table):
+    payload = {
+        "columns": [(name, str(type)) for name, type in table["columns"]],
+        "primary_keys": sorted(table["primary_keys"]),
+        "foreign_keys": sorted(table["foreign_keys"].items()),
+    }
+    return hashlib.sha1(json.dumps(payload).encode()).hexdigest()
+
+
+def load(data: models.Data):
+    """Return the stored snapshot in the shape produced by `introspection.introspect`."""
+    tables = OrderedDict()
+    for schema_table in data.schema_tables.prefetch_related("columns"):
+        table = tables[schema_table.name] = {"columns": [], "primary_keys": [], "foreign_keys": {}}
+        for column in schema_table.columns.all():
+            table["columns"].append((column.name, column.type))
+            if column.is_primary_key:
+                table["primary_keys"].append(column.name)
+            if column.foreign_key_table:
+                table["foreign_keys"][column.name] = column.foreign_key_table
+    return tables
+
+
+def has_changed(data: models.Data, engine):
+    """
+    Cheap check, one catalog query, of whether any table was added, removed or
+    altered since the last refresh. Errs on the side of True when the dialect
+    can't tell.
+    """
+    fingerprints = introspection.catalog_fingerprints(engine)
+    if fingerprints is None:
+        return True
+    stored = dict(data.schema_tables.values_list("name", "fingerprint"))
+    return stored != fingerprints
+
+
+def _save_table(data, name, table, content_hash, fingerprint, existing=None):
+    if existing is None:
+        existing = models.SchemaTable.objects.create(
+            data=data, name=name, content_hash=content_hash, fingerprint=fingerprint
+        )
+    else:
+        existing.columns.all().delete()
+        existing.content_hash = content_hash
+        existing.fingerprint = fingerprint
+        existing.save(update_fields=["content_hash", "fingerprint", "refreshed_at"])
+
+    models.SchemaColumn.objects.bulk_create([
+        models.SchemaColumn(
+            table=existing,
+            name=column_name,
+            type=str(type),
+            position=position,
+            is_primary_key=column_name in table["primary_keys"],
+            foreign_key_table=table["foreign_keys"].get(column_name),
+        )
+        for position, (column_name, type) in enumerate(table["columns"])
+    ])
+
+
+@transaction.atomic
+def refresh(data: models.Data, engine, force=False):
+    """
+    Bring the snapshot of `data` up to date and return True when its content changed.
+    """
+    fingerprints = introspection.catalog_fingerprints(engine)
+    stored = {table.name: table for table in data.schema_tables.all()}
+
+    changed = None
+    if fingerprints is not None and stored and not force:
+        changed = [
+            name for name, fingerprint in fingerprints.items()
+            if name not in stored or stored[name].fingerprint != fingerprint
+        ]
+        if len(changed) > max(INCREMENTAL_MIN_TABLES, len(fingerprints) * INCREMENTAL_MAX_SHARE):
+            changed = None
+
+    if changed is None:
+        introspected = introspection.introspect(engine)
+        current = set(introspected)
+    else:
+        introspected = introspection.inspector_introspect(engine, table_names=changed) if changed else {}
+        current = set(fingerprints)
+
+    removed = set(stored) - current
+    if removed:
+        data.schema_tables.filter(name__in=removed).delete()
+
+    updated = 0
+    for name, table in introspected.items():
+        content_hash = table_hash(table)
+        fingerprint = fingerprints.get(name) if fingerprints else None
+        existing = stored.get(name)
+        if existing is not None and existing.content_hash == content_hash:
+            if existing.fingerprint != fingerprint:
+                existing.fingerprint = fingerprint
+                existing.save(update_fields=["fingerprint", "refreshed_at"])
+            continue
+        _save_table(data, name, table, content_hash, fingerprint, existing)
+        updated += 1
+
+    has_updates = bool(updated or removed)
+    fields = {"schema_refreshed_at": timezone.now()}
+    if has_updates or data.schema_hash is None:
+        hashes = sorted(data.schema_tables.values_list("name", "content_hash"))
+        fields["schema_hash"] = hashlib.sha1(json.dumps(hashes).encode()).hexdigest()
+        fields["schema"] = introspection.format_schema(load(data))
+    # queryset update: an unchanged refresh must not fire post_save and drop cached agents
+    models.Data.objects.filter(pk=data.pk).update(**fields)
+    for field, value in fields.items():
+        setattr(data, field, value)
+    if has_updates:
+        answer_cache.invalidate(data.id)
+        sql_cache.get_cache(data).clear()
+
+    logger.info(
+        "Refreshed schema of %s: %s introspected, %s updated, %s removed",
+        data.id, len(introspected), updated, len(removed)
+    )
+    return has_updates
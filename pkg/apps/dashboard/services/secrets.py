@@ -1,10 +1,154 @@
 import json
-import boto3
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.dispatch import Signal
+
+from common import aws
+from common.utils import get_redis
 
 from ..wrappers import secretsmanager_wrapper 
 
+logger = logging.getLogger(__name__)
+
+# Sent with `identifier` whenever a stored credential is changed or removed
+secret_changed = Signal()
+
+AWSCURRENT = "AWSCURRENT"
+AWSPENDING = "AWSPENDING"
+
+
+class CredentialCache:
+    """
+    Process-local cache of secret values per (identifier, version stage).
+
+    Entries live `ttl` seconds (`pending_ttl` for AWSPENDING, which only exists
+    mid-rotation). A read in the last `refresh_ahead` seconds returns the cached
+    value and reloads it in the background, so the chat path doesn't wait on
+    Secrets Manager. Each entry carries the secret's generation counter in
+    Redis, which `update_value`/`delete_secret` bump, so changes made by any
+    process are seen on the next read.
+    """
+    def __init__(self, ttl=300, refresh_ahead=60, pending_ttl=30):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.pending_ttl = pending_ttl
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="secret-refresh")
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @staticmethod
+    def generation(identifier):
+        return int(get_redis().get(f"secrets:generation:{identifier}") or 0)
+
+    @staticmethod
+    def bump(identifier):
+        return get_redis().incr(f"secrets:generation:{identifier}")
+
+    def _ttl(self, stage, ttl=None):
+        if ttl is not None:
+            return ttl
+        return self.pending_ttl if stage == AWSPENDING else self.ttl
+
+    def _load(self, identifier, stage, ttl, generation):
+        response = _secret().get_value(name=identifier, stage=stage)
+        entry = {
+            "value": json.loads(response["SecretString"]),
+            "version_id": response.get("VersionId"),
+            "generation": generation,
+            "expires_at": time.monotonic() + self._ttl(stage, ttl),
+        }
+        with self._lock:
+            previous = self._entries.get((identifier, stage))
+            self._entries[(identifier, stage)] = entry
+        return entry, previous
+
+    def _refresh(self, identifier, stage, ttl, generation):
+        try:
+            entry, previous = self._load(identifier, stage, ttl, generation)
+            self.refreshes += 1
+            if stage == AWSCURRENT and previous and previous["version_id"] != entry["version_id"]:
+                # rotated outside the app: agents built with the old credentials are stale
+                logger.info("Secret %s rotated to version %s", identifier, entry["version_id"])
+                # other processes' agents are keyed on the generation; this entry is already current
+                entry["generation"] = self.bump(identifier)
+                secret_changed.send(sender=None, identifier=identifier)
+        except Exception:
+            logger.exception("Couldn't refresh secret %s ahead of expiry", identifier)
+        finally:
+            with self._lock:
+                self._refreshing.discard((identifier, stage))
+
+    def get(self, identifier, stage=AWSCURRENT, ttl=None):
+        generation = self.generation(identifier)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((identifier, stage))
+            usable = entry is not None and entry["generation"] == generation and entry["expires_at"] > now
+            refresh = (
+                usable
+                and entry["expires_at"] - now < self.refresh_ahead
+                and (identifier, stage) not in self._refreshing
+            )
+            if refresh:
+                self._refreshing.add((identifier, stage))
+        if usable:
+            self.hits += 1
+            if refresh:
+                self._executor.submit(self._refresh, identifier, stage, ttl, generation)
+            return entry["value"]
+        self.misses += 1
+        entry, _ = self._load(identifier, stage, ttl, generation)
+        return entry["value"]
+
+    def prime(self, identifier, secret_string, version_id=None, stage=AWSCURRENT, ttl=None):
+        """Store a value read elsewhere, e.g. by `batch_get_secret_values`."""
+        with self._lock:
+            self._entries[(identifier, stage)] = {
+                "value": json.loads(secret_string),
+                "version_id": version_id,
+                "generation": self.generation(identifier),
+                "expires_at": time.monotonic() + self._ttl(stage, ttl),
+            }
+
+    def invalidate(self, identifier):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == identifier]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+            }
+
+
+credential_cache = CredentialCache(
+    ttl=settings.SECRET_CACHE_TTL,
+    refresh_ahead=settings.SECRET_CACHE_REFRESH_AHEAD,
+    pending_ttl=settings.SECRET_CACHE_PENDING_TTL,
+)
+
+
+def _secret():
+    return secretsmanager_wrapper.SecretsManagerSecret(aws.get_client('secretsmanager'))
+
+
+def _changed(identifier):
+    credential_cache.bump(identifier)
+    credential_cache.invalidate(identifier)
+    secret_changed.send(sender=None, identifier=identifier)
 
-sm_client = boto3.client('secretsmanager')
 
 def create_secret(identifier, username, password):
     value = json.dumps({
@@ -12,24 +156,48 @@ def create_secret(identifier, username, password):
         "password": password
     })
     
-    secret = secretsmanager_wrapper.SecretsManagerSecret(sm_client)
-    return secret.create(identifier, value)
+    response = _secret().create(identifier, value)
+    # the name may have been used by a deleted secret still cached somewhere
+    credential_cache.bump(identifier)
+    return response
 
 
-def get_secret_value(identifier):
-    secret = secretsmanager_wrapper.SecretsManagerSecret(sm_client)
-    response = secret.get_value(name=identifier)
-    secrets_credentials = json.loads(response['SecretString'])
+def get_secret_value(identifier, stage=AWSCURRENT):
+    secrets_credentials = credential_cache.get(identifier, stage)
     return secrets_credentials['username'], secrets_credentials['password']
 
 
+def batch_get_secret_values(identifiers, batch_size=20):
+    """
+    Read many secrets with BatchGetSecretValue (up to 20 per call) into the
+    credential cache. Returns {identifier: (username, password)} for the ones found.
+    """
+    client = aws.get_client('secretsmanager')
+    identifiers = list(identifiers)
+    found = {}
+    for start in range(0, len(identifiers), batch_size):
+        kwargs = {"SecretIdList": identifiers[start:start + batch_size]}
+        while True:
+            response = client.batch_get_secret_value(**kwargs)
+            for value in response.get("SecretValues", []):
+                credential_cache.prime(value["Name"], value["SecretString"], value.get("VersionId"))
+                credentials = json.loads(value["SecretString"])
+                found[value["Name"]] = (credentials["username"], credentials["password"])
+            for error in response.get("Errors", []):
+                logger.warning("Couldn't read secret %s: %s", error.get("SecretId"), error.get("ErrorCode"))
+            if not response.get("NextToken"):
+                break
+            kwargs["NextToken"] = response["NextToken"]
+    return found
+
+
 def update_value(identifier, value):
-    secret = secretsmanager_wrapper.SecretsManagerSecret(sm_client)
-    response = secret.put_value(name=identifier, secret_value=value)
+    response = _secret().put_value(name=identifier, secret_value=value)
+    _changed(identifier)
     return response
 
 
 def delete_secret(identifier, without_recovery=False):
-    secret = secretsmanager_wrapper.SecretsManagerSecret(sm_client)
-    response = secret.delete(identifier, without_recovery)
-    return 
\ No newline at end of file
+    response = _secret().delete(identifier, without_recovery)
+    _changed(identifier)
+    return response
@@ -0,0 +1,85 @@
+"""
+Single-flight coalescing of identical in-flight questions.
+
+The first request for a (data source, normalized question, model) key becomes
+the leader and runs the agent. Requests arriving while it runs only register
+the websocket group that wants the answer; when the leader finishes it
+publishes its message to every registered group. Coordination lives in Redis
+so it holds across web processes and Celery workers.
+"""
+import hashlib
+import re
+
+from django.conf import settings
+
+from common.utils import get_redis
+
+LEADER = "leader"
+FOLLOWER = "follower"
+
+# KEYS: lock, groups, result  ARGV: group, lock ttl
+_JOIN = """
+local result = redis.call('GET', KEYS[3])
+if result then
+    return {'result', result}
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return {'leader', ''}
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return {'follower', ''}
+"""
+
+# KEYS: lock, groups, result  ARGV: msg id, result ttl
+_COMPLETE = """
+redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[2])
+local groups = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[1], KEYS[2])
+return groups
+"""
+
+
+def normalize_question(question):
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!. ")
+
+
+def flight_key(data_id, question, model):
+    digest = hashlib.sha1(f"{data_id}|{normalize_question(question)}|{model}".encode()).hexdigest()
+    return f"singleflight:{digest}"
+
+
+def _keys(key):
+    return [key, f"{key}:groups", f"{key}:result"]
+
+
+def join(key, group):
+    """
+    Join the flight `key` on behalf of websocket `group`.
+
+    Returns (LEADER, None) when the caller must run the question,
+    (FOLLOWER, None) when it will be notified by the leader, or
+    ("result", msg_id) when an identical question was answered moments ago.
+    """
+    redis = get_redis()
+    status, value = redis.register_script(_JOIN)(
+        keys=_keys(key), args=[group, settings.SINGLE_FLIGHT_TIMEOUT]
+    )
+    status = status.decode()
+    return status, value.decode() or None
+
+
+def complete(key, msg_id):
+    """Publish the leader's answer and return the follower groups to notify."""
+    redis = get_redis()
+    groups = redis.register_script(_COMPLETE)(
+        keys=_keys(key), args=[msg_id, settings.SINGLE_FLIGHT_RESULT_TTL]
+    )
+    return {group.decode() for group in groups}
+
+
+def abandon(key):
+    """Release a flight whose leader failed so the next request runs it again."""
+    lock, groups, _ = _keys(key)
+    get_redis().delete(lock, groups)
@@ -0,0 +1,307 @@
+"""
+Cache of executed SQL results.
+
+`CachedSQLDatabase` is what the SQL agent's toolkit runs queries through: read
+statements are keyed on the data source and the canonicalized SQL and served
+from Redis while fresh, so the exploratory `SELECT COUNT(*) ...` calls an agent
+repeats within and across questions stop hitting the warehouse. Every source
+has a byte budget; the oldest results are evicted once it's exceeded.
+
+One `CachedSQLDatabase` serves every question asked of a source: the tables a
+question was pruned to (see table_index) are set per call with
+`include_tables`, and table metadata is reflected as the agent first asks
+about a table instead of for the whole warehouse up front.
+"""
+import contextvars
+import hashlib
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from langchain import SQLDatabase
+from sqlalchemy import MetaData, text
+
+from common.utils import get_redis
+
+from . import sql_guard, tracing
+
+_LITERAL = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+_included_tables = contextvars.ContextVar("included_tables", default=None)
+
+
+@contextmanager
+def include_tables(tables):
+    """Limit the tables CachedSQLDatabase shows the agent to `tables` (None: all of them) in this context."""
+    token = _included_tables.set(frozenset(tables) if tables else None)
+    try:
+        yield
+    finally:
+        _included_tables.reset(token)
+
+
+class _DeferredMetaData(MetaData):
+    """MetaData that ignores SQLDatabase.__init__'s reflection of every usable table."""
+    def reflect(self, bind, **kwargs):
+        pass
+
+
+def canonicalize(sql):
+    """Collapse whitespace and case outside quoted literals and drop trailing semicolons."""
+    parts = _LITERAL.split(sql.strip().rstrip(";").strip())
+    return "".join(
+        part if index % 2 else re.sub(r"\s+", " ", part).lower()
+        for index, part in enumerate(parts)
+    )
+
+
+# KEYS: result, index, sizes, used  ARGV: result, ttl, now, size
+# Stores a result and returns the bytes the source's results take up now.
+_STORE = """
+local previous = tonumber(redis.call('HGET', KEYS[3], KEYS[1])) or 0
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], ARGV[4])
+return redis.call('INCRBY', KEYS[4], tonumber(ARGV[4]) - previous)
+"""
+
+# KEYS: index, sizes, used, then the results to drop. Returns the bytes still used.
+_DROP = """
+local freed = 0
+for i = 4, #KEYS do
+    freed = freed + (tonumber(redis.call('HGET', KEYS[2], KEYS[i])) or 0)
+    redis.call('DEL', KEYS[i])
+    redis.call('ZREM', KEYS[1], KEYS[i])
+    redis.call('HDEL', KEYS[2], KEYS[i])
+end
+return redis.call('DECRBY', KEYS[3], freed)
+"""
+
+
+class SQLResultCache:
+    def __init__(self, data_id, ttl, budget):
+        self.data_id = data_id
+        self.ttl = ttl
+        self.budget = budget
+        self.prefix = f"sqlcache:{data_id}"
+
+    def _key(self, sql):
+        return f"{self.prefix}:{hashlib.sha1(canonicalize(sql).encode()).hexdigest()}"
+
+    def _bookkeeping_keys(self):
+        # the running byte count saves summing every entry's size on each store
+        return [f"{self.prefix}:index", f"{self.prefix}:sizes", f"{self.prefix}:used"]
+
+    def get(self, sql):
+        value = get_redis().get(self._key(sql))
+        return value.decode() if value is not None else None
+
+    def set(self, sql, result):
+        size = len(result.encode())
+        if self.ttl <= 0 or size > settings.SQL_RESULT_CACHE_MAX_BYTES:
+            return
+        used = get_redis().register_script(_STORE)(
+            keys=[self._key(sql), *self._bookkeeping_keys()], args=[result, self.ttl, time.time(), size]
+        )
+        self._enforce_budget(used)
+
+    def _drop(self, keys):
+        """Delete the results `keys` and return the bytes the source's remaining results use."""
+        return get_redis().register_script(_DROP)(keys=[*self._bookkeeping_keys(), *keys])
+
+    def _enforce_budget(self, used):
+        redis = get_redis()
+        expired = redis.zrangebyscore(f"{self.prefix}:index", "-inf", time.time() - self.ttl)
+        if expired:
+            used = self._drop(expired)
+        while used > self.budget:
+            oldest = redis.zrange(f"{self.prefix}:index", 0, 0)
+            if not oldest:
+                break
+            used = self._drop(oldest)
+
+    def clear(self):
+        redis = get_redis()
+        while True:
+            keys = redis.zrange(f"{self.prefix}:index", 0, 499)
+            if not keys:
+                break
+            self._drop(keys)
+
+
+def get_cache(data):
+    ttl = data.sql_cache_ttl if data.sql_cache_ttl is not None else settings.SQL_RESULT_CACHE_TTL
+    return SQLResultCache(data.id, ttl, settings.SQL_RESULT_CACHE_BUDGET)
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """
+    SQLDatabase whose read queries go through the source's SQLResultCache.
+
+    With a `guard` (see sql_guard.get_guard) every statement is checked,
+    limited and costed first, and results are fetched within its caps. With an
+    `async_engine` (see engines.get_async_engine) `arun` executes on the
+    asyncio driver instead of blocking a thread of the event loop.
+    """
+    def __init__(self, engine, result_cache: SQLResultCache = None, async_engine=None, guard=None, **kwargs):
+        super().__init__(engine, metadata=_DeferredMetaData(), **kwargs)
+        self.result_cache = result_cache
+        self.async_engine = async_engine
+        self.guard = guard
+        self._view_support = kwargs.get("view_support", False)
+        self._reflected = set()
+        self._reflect_lock = threading.Lock()
+
+    def get_usable_table_names(self):
+        tables = super().get_usable_table_names()
+        included = _included_tables.get()
+        if included is None:
+            return tables
+        return [table for table in tables if table in included]
+
+    def get_table_info(self, table_names=None):
+        self.reflect_tables(table_names if table_names is not None else self.get_usable_table_names())
+        return super().get_table_info(table_names)
+
+    def reflect_tables(self, table_names):
+        """Reflect the metadata of the tables among `table_names` that weren't reflected yet."""
+        with self._reflect_lock:
+            missing = [name for name in table_names if name not in self._reflected and name in self._all_tables]
+            if missing:
+                MetaData.reflect(
+                    self._metadata, bind=self._engine, only=missing, schema=self._schema, views=self._view_support
+                )
+                self._reflected.update(missing)
+
+    def _cacheable(self, command, fetch):
+        return self.result_cache is not None and fetch == "all" and sql_guard.is_read_only(command)
+
+    def run(self, command, fetch="all", *args, **kwargs):
+        with tracing.span("sql") as span:
+            if self.guard is not None:
+                return self._run_guarded(command, fetch, span)
+            if not self._cacheable(command, fetch):
+                return super().run(command, fetch, *args, **kwargs)
+            result = self.result_cache.get(command)
+            span["cached"] = result is not None
+            if result is None:
+                result = super().run(command, fetch, *args, **kwargs)
+                self.result_cache.set(command, result)
+            return result
+
+    @property
+    def _search_path(self):
+        return f"SET search_path TO {self._schema}" if self._schema is not None else None
+
+    def _run_guarded(self, command, fetch, span):
+        candidates = self.guard.candidates(command)
+        sql, note = next(candidates)
+        cacheable = self._cacheable(sql, fetch)
+        result = self.result_cache.get(sql) if cacheable else None
+        span["cached"] = result is not None
+        if result is not None:
+            return result
+        key = sql
+        with self._engine.begin() as connection:
+            if self.guard.read_only_sql:
+                connection.exec_driver_sql(self.guard.read_only_sql)
+            if self._search_path:
+                connection.exec_driver_sql(self._search_path)
+            explain = self.guard.explain_sql(sql)
+            while explain is not None:
+                cost = self.guard.cost(connection.execute(text(explain)).fetchall())
+                span["cost"] = cost
+                if cost <= self.guard.cost_limit:
+                    break
+                sql, note = next(candidates, (None, None))
+                if sql is None:
+                    self.guard.reject(cost)
+                explain = self.guard.explain_sql(sql)
+
+            cursor = connection.execute(text(sql).execution_options(stream_results=True))
+            if not cursor.returns_rows:
+                return ""
+            writer = self.guard.writer()
+            for row in cursor if fetch == "all" else [cursor.fetchone()]:
+                if row is None or not writer.add(row):
+                    break
+            cursor.close()
+        span["rows"] = len(writer.parts)
+        result = writer.result(note)
+        if cacheable:
+            self.result_cache.set(key, result)
+        return result
+
+    async def _arun_guarded(self, command, fetch, span):
+        candidates = self.guard.candidates(command)
+        sql, note = next(candidates)
+        cacheable = self._cacheable(sql, fetch)
+        result = None
+        if cacheable:
+            result = await sync_to_async(self.result_cache.get, thread_sensitive=False)(sql)
+        span["cached"] = result is not None
+        if result is not None:
+            return result
+        key = sql
+        async with self.async_engine.begin() as connection:
+            if self.guard.read_only_sql:
+                await connection.exec_driver_sql(self.guard.read_only_sql)
+            if self._search_path:
+                await connection.exec_driver_sql(self._search_path)
+            explain = self.guard.explain_sql(sql)
+            while explain is not None:
+                plan = await connection.execute(text(explain))
+                cost = self.guard.cost(plan.fetchall())
+                span["cost"] = cost
+                if cost <= self.guard.cost_limit:
+                    break
+                sql, note = next(candidates, (None, None))
+                if sql is None:
+                    self.guard.reject(cost)
+                explain = self.guard.explain_sql(sql)
+
+            cursor = await connection.stream(text(sql))
+            writer = self.guard.writer()
+            if fetch == "all":
+                async for row in cursor:
+                    if not writer.add(row):
+                        break
+            else:
+                row = await cursor.fetchone()
+                if row is not None:
+                    writer.add(row)
+            await cursor.close()
+        span["rows"] = len(writer.parts)
+        result = writer.result(note)
+        if cacheable:
+            await sync_to_async(self.result_cache.set, thread_sensitive=False)(key, result)
+        return result
+
+    async def _execute(self, command, fetch):
+        # mirrors SQLDatabase.run on the async connection
+        async with self.async_engine.begin() as connection:
+            if self._search_path:
+                await connection.exec_driver_sql(self._search_path)
+            cursor = await connection.execute(text(command))
+            if cursor.returns_rows:
+                result = cursor.fetchall() if fetch == "all" else cursor.fetchone()
+                return str(result)
+        return ""
+
+    async def arun(self, command, fetch="all"):
+        if self.async_engine is None:
+            return await sync_to_async(self.run, thread_sensitive=False)(command, fetch)
+        with tracing.span("sql") as span:
+            if self.guard is not None:
+                return await self._arun_guarded(command, fetch, span)
+            if not self._cacheable(command, fetch):
+                return await self._execute(command, fetch)
+            result = await sync_to_async(self.result_cache.get, thread_sensitive=False)(command)
+            span["cached"] = result is not None
+            if result is None:
+                result = await self._execute(command, fetch)
+                await sync_to_async(self.result_cache.set, thread_sensitive=False)(command, result)
+            return result
@@ -0,0 +1,208 @@
+"""
+Guard in front of the SQL the agent writes.
+
+Every statement the SQL tool runs goes through `SQLGuard` first. The guard:
+
+- only lets through a single SELECT (or WITH ... SELECT), with no writes,
+  SELECT INTO, session setters such as set_config or server-side functions
+  such as pg_sleep;
+- adds a LIMIT of the source's row limit, or lowers a larger one;
+- asks the database for the statement's estimated cost with EXPLAIN. A query
+  over the source's cost budget is retried at SQL_GUARD_SAMPLE_ROWS rows, and
+  refused if it is still too expensive.
+
+On PostgreSQL, Redshift and MySQL the statement runs in a read-only
+transaction, so the database refuses any write the parse let slip. Rows are
+then fetched from a server-side cursor and capped in count and bytes by
+`ResultWriter`. Refusals are raised as `QueryRejected`, a SQLAlchemyError,
+so the SQL tool hands the reason back to the agent like any database error
+and it can rewrite the query.
+"""
+import json
+import re
+
+import sqlparse
+from django.conf import settings
+from sqlalchemy.exc import SQLAlchemyError
+from sqlparse import tokens as T
+
+# dialects that take a trailing LIMIT; the rest are only capped while fetching
+LIMIT_DIALECTS = {"postgresql", "redshift", "mysql", "sqlite", "snowflake", "bigquery", "duckdb"}
+
+# dialects whose transactions can be made read-only with SET TRANSACTION
+READ_ONLY_DIALECTS = {"postgresql", "redshift", "mysql"}
+
+# functions that sleep, read files, reach other servers or change session or server settings
+FORBIDDEN_FUNCTIONS = {
+    "pg_sleep", "pg_terminate_backend", "pg_cancel_backend", "pg_read_file",
+    "pg_read_binary_file", "pg_ls_dir", "lo_import", "lo_export", "dblink",
+    "sleep", "benchmark", "load_file", "system$wait",
+    "set_config", "pg_reload_conf", "pg_rotate_logfile",
+    "system$abort_session", "system$cancel_query", "system$cancel_all_queries",
+}
+
+_PLAN_COST = re.compile(r"cost=[\d.]+\.\.([\d.]+)")
+
+
+class QueryRejected(SQLAlchemyError):
+    pass
+
+
+class ResultWriter:
+    """Renders rows the way SQLDatabase.run does, stopping at the row and byte caps."""
+    def __init__(self, max_rows, max_bytes):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 2
+        self.truncated = None
+
+    def add(self, row):
+        """Append a row; returns False once a cap is reached and nothing more should be fetched."""
+        if len(self.parts) >= self.max_rows:
+            self.truncated = f"{self.max_rows} rows"
+            return False
+        part = str(tuple(row))
+        self.size += len(part.encode()) + 2
+        if self.size > self.max_bytes:
+            self.truncated = f"{self.max_bytes} bytes"
+            return False
+        self.parts.append(part)
+        return True
+
+    def result(self, note=None):
+        notes = [note] if note else []
+        if self.truncated:
+            notes.append(f"Result truncated at {self.truncated}; aggregate, filter or select fewer columns")
+        return "[" + ", ".join(self.parts) + "]" + "".join(f"\n({note})" for note in notes)
+
+
+def parse(sql):
+    """The single read-only statement in `sql`; raises QueryRejected otherwise."""
+    sql = sqlparse.format(sql, strip_comments=True).strip().rstrip(";").strip()
+    statements = [statement for statement in sqlparse.parse(sql) if str(statement).strip(" ;\n\t")]
+    if len(statements) != 1:
+        raise QueryRejected("Query refused: run exactly one statement at a time")
+    statement = statements[0]
+    if statement.get_type() != "SELECT":
+        raise QueryRejected("Query refused: only SELECT statements may be run")
+    tokens = [token for token in statement.flatten() if not token.is_whitespace]
+    for token, following in zip(tokens, tokens[1:] + [None]):
+        if token.ttype in (T.Keyword.DML, T.Keyword.DDL, T.Keyword.DCL) and token.normalized != "SELECT":
+            raise QueryRejected(f"Query refused: {token.normalized} isn't allowed, the database is read-only")
+        if token.ttype in T.Keyword and token.normalized == "INTO":
+            raise QueryRejected("Query refused: SELECT ... INTO isn't allowed, the database is read-only")
+        # only calls: columns may well be named sleep or benchmark
+        is_call = following is not None and following.match(T.Punctuation, "(")
+        is_name = token.ttype in T.Name or token.ttype in T.Literal.String.Symbol
+        if is_call and is_name and token.value.strip('"`').lower() in FORBIDDEN_FUNCTIONS:
+            raise QueryRejected(f"Query refused: {token.value} isn't allowed")
+    return statement
+
+
+def is_read_only(sql):
+    """Whether `sql` is a single statement `parse` lets through."""
+    try:
+        parse(sql)
+    except QueryRejected:
+        return False
+    return True
+
+
+class SQLGuard:
+    def __init__(self, dialect, row_limit, cost_limit=None, sample_rows=10, max_bytes=32 * 1024):
+        self.dialect = dialect
+        self.row_limit = row_limit
+        self.cost_limit = cost_limit
+        self.sample_rows = min(sample_rows, row_limit)
+        self.max_bytes = max_bytes
+
+    def parse(self, sql):
+        return parse(sql)
+
+    def _wrap(self, sql, rows):
+        return f"SELECT * FROM ({sql}) AS guarded_query LIMIT {rows}"
+
+    def limit(self, statement, rows):
+        """`statement` returning at most `rows` rows, and a note when the agent asked for more."""
+        sql = str(statement)
+        if self.dialect not in LIMIT_DIALECTS:
+            return sql, None
+        top_level = [token for token in statement.tokens if not token.is_whitespace]
+        keywords = [token.normalized for token in top_level if token.ttype in T.Keyword]
+        if "LIMIT" not in keywords:
+            if "OFFSET" in keywords or "FETCH" in keywords:
+                return self._wrap(sql, rows), None
+            return f"{sql} LIMIT {rows}", None
+
+        position = next(i for i, token in enumerate(top_level) if token.ttype in T.Keyword and token.normalized == "LIMIT")
+        clause = top_level[position + 1] if position + 1 < len(top_level) else None
+        numbers = [token for token in (clause.flatten() if clause else []) if token.ttype in T.Number.Integer]
+        if not numbers:
+            # LIMIT ALL, LIMIT :param and the like
+            return self._wrap(sql, rows), None
+        # MySQL's LIMIT offset, count
+        count = numbers[-1]
+        if int(count.value) <= rows:
+            return sql, None
+        count.value = str(rows)
+        return str(statement), f"LIMIT lowered to {rows} rows"
+
+    def candidates(self, sql):
+        """The guarded statement, then a sampling fallback tried when it's over the cost budget."""
+        statement = self.parse(sql)
+        limited = self.limit(statement, self.row_limit)
+        yield limited
+        if self.cost_limit is not None and self.sample_rows < self.row_limit:
+            sampled, _ = self.limit(self.parse(sql), self.sample_rows)
+            if sampled != limited[0]:
+                yield sampled, f"Estimated too expensive in full, LIMIT lowered to {self.sample_rows} rows"
+
+    @property
+    def read_only_sql(self):
+        """The statement making the current transaction read-only, or None when the dialect has none."""
+        return "SET TRANSACTION READ ONLY" if self.dialect in READ_ONLY_DIALECTS else None
+
+    def explain_sql(self, sql):
+        """The EXPLAIN statement estimating `sql`, or None when there's no budget to check."""
+        if self.cost_limit is None:
+            return None
+        if self.dialect in ("postgresql", "redshift"):
+            return f"EXPLAIN {sql}"
+        if self.dialect == "mysql":
+            return f"EXPLAIN FORMAT=JSON {sql}"
+        if self.dialect == "snowflake":
+            return f"EXPLAIN USING JSON {sql}"
+        return None
+
+    def cost(self, rows):
+        """Estimated cost from the EXPLAIN output: planner cost, or partitions scanned on Snowflake."""
+        if self.dialect in ("postgresql", "redshift"):
+            # the first line is the top plan node: "Limit  (cost=0.00..1.23 rows=10 width=4)"
+            match = _PLAN_COST.search(rows[0][0])
+            return float(match.group(1)) if match else 0.0
+        plan = json.loads(rows[0][0])
+        if self.dialect == "mysql":
+            return float(plan["query_block"].get("cost_info", {}).get("query_cost", 0))
+        return float(plan.get("GlobalStats", {}).get("partitionsAssigned", 0))
+
+    def reject(self, cost):
+        raise QueryRejected(
+            f"Query refused: estimated cost {cost:,.0f} is over this source's budget of {self.cost_limit:,.0f}. "
+            "Filter on indexed columns, aggregate, or join fewer tables"
+        )
+
+    def writer(self):
+        return ResultWriter(self.row_limit, self.max_bytes)
+
+
+def get_guard(data, dialect):
+    row_limit = data.query_row_limit if data.query_row_limit is not None else settings.SQL_GUARD_ROW_LIMIT
+    cost_limit = data.query_cost_limit if data.query_cost_limit is not None else settings.SQL_GUARD_COST_LIMITS.get(dialect)
+    return SQLGuard(
+        dialect,
+        row_limit,
+        cost_limit=cost_limit,
+        sample_rows=settings.SQL_GUARD_SAMPLE_ROWS,
+        max_bytes=settings.SQL_GUARD_MAX_BYTES,
+    )
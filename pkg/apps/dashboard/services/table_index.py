@@ -0,0 +1,120 @@
+"""
+Relevance-based table pruning for wide schemas.
+
+A TF-IDF index over the table and column names of a source's schema snapshot
+picks the tables most related to a question, so the SQL agent is built with a
+handful of tables instead of the whole warehouse. Documents are scored with an
+inverted index and NumPy accumulation, which stays small for tens of thousands
+of tables and needs nothing beyond the CPU.
+"""
+import math
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+import numpy as np
+from django.conf import settings
+
+from . import schema_snapshots
+
+# Table names say more about relevance than any single column
+TABLE_NAME_WEIGHT = 3
+
+
+def tokenize(text):
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", text.lower()):
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class TableIndex:
+    def __init__(self, tables):
+        self.names = list(tables)
+        self.foreign_keys = {name: set(table["foreign_keys"].values()) for name, table in tables.items()}
+        docs = []
+        for name, table in tables.items():
+            terms = Counter(tokenize(name) * TABLE_NAME_WEIGHT)
+            for column_name, _ in table["columns"]:
+                terms.update(tokenize(column_name))
+            docs.append(terms)
+
+        document_frequency = Counter(term for terms in docs for term in terms)
+        total = len(docs)
+        self.idf = {term: math.log((1 + total) / (1 + count)) + 1 for term, count in document_frequency.items()}
+
+        postings = defaultdict(lambda: ([], []))
+        for doc_id, terms in enumerate(docs):
+            weights = {term: (1 + math.log(count)) * self.idf[term] for term, count in terms.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for term, weight in weights.items():
+                postings[term][0].append(doc_id)
+                postings[term][1].append(weight / norm)
+        self.postings = {
+            term: (np.array(doc_ids, dtype=np.int32), np.array(weights, dtype=np.float32))
+            for term, (doc_ids, weights) in postings.items()
+        }
+
+    def __len__(self):
+        return len(self.names)
+
+    def scores(self, question):
+        terms = Counter(token for token in tokenize(question) if token in self.postings)
+        scores = np.zeros(len(self.names), dtype=np.float32)
+        if not terms:
+            return scores
+        weights = {term: (1 + math.log(count)) * self.idf[term] for term, count in terms.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        for term, weight in weights.items():
+            doc_ids, doc_weights = self.postings[term]
+            np.add.at(scores, doc_ids, doc_weights * (weight / norm))
+        return scores
+
+    def top_k(self, question, k):
+        """Return up to `k` table names ranked by cosine similarity, plus the tables they reference."""
+        scores = self.scores(question)
+        matching = np.flatnonzero(scores)
+        if not len(matching):
+            return []
+        if len(matching) > k:
+            matching = matching[np.argpartition(-scores[matching], k - 1)[:k]]
+        ranked = [self.names[i] for i in matching[np.argsort(-scores[matching])]]
+        # Keep join targets so the agent can still follow foreign keys
+        related = [ref for name in ranked for ref in sorted(self.foreign_keys[name]) if ref in self.foreign_keys]
+        return list(OrderedDict.fromkeys(ranked + related))
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+_MAX_INDEXES = 64
+
+
+def get_index(data):
+    """Process-local index of the source's snapshot, rebuilt when its schema hash moves."""
+    with _lock:
+        entry = _indexes.get(data.id)
+        if entry is not None and entry[0] == data.schema_hash:
+            _indexes.move_to_end(data.id)
+            return entry[1]
+    index = TableIndex(schema_snapshots.load(data))
+    with _lock:
+        _indexes[data.id] = (data.schema_hash, index)
+        while len(_indexes) > _MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def relevant_tables(data, question):
+    """
+    Tables to build the agent with for `question`, or None to use the source's
+    configured tables (explicit `Data.tables`, small schemas, no match).
+    """
+    if data.tbls or not data.schema_hash or not question:
+        return None
+    index = get_index(data)
+    if len(index) <= settings.TABLE_PRUNING_THRESHOLD:
+        return None
+    return index.top_k(question, settings.TABLE_PRUNING_TOP_K) or None
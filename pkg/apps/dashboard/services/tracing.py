@@ -0,0 +1,252 @@
+"""
+Per-question tracing.
+
+A `Tracer` follows one question from the moment it was asked to the answer
+being published, as a list of spans: queue wait, answer cache, secret fetch,
+agent build, few-shot lookup, every LLM call with its tokens, every tool run,
+every SQL statement with its rows, and the websocket publish. The running
+tracer lives in a context variable, so code anywhere below the task or the
+async question opens spans with `span(...)` without it being passed around,
+and does nothing when the question isn't traced.
+
+Finished traces are buffered in Redis like usage rows and written in bulk by
+`tasks.flush_traces`. Each is stored as one `Trace` row whose spans are a
+JSON list of [kind, name, start ms, duration ms, attributes].
+"""
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from common.utils import get_redis
+
+from .. import models
+from ..callbacks import LLMUsageHandler
+
+logger = logging.getLogger(__name__)
+
+BUFFER_KEY = "traces:buffer"
+FLUSH_LOCK_KEY = "traces:flush_lock"
+
+_current = ContextVar("trace", default=None)
+
+
+class Tracer:
+    def __init__(self, data_id, user_id, question, model, path, asked_at=None):
+        self.data_id = data_id
+        self.user_id = user_id
+        self.question = question
+        self.model = model
+        self.path = path
+        self.message_id = None
+        self.spans = []
+        now = time.time()
+        self.started = min(asked_at or now, now)
+        # perf_counter reading at `started`, spans are measured against it
+        self._origin = time.perf_counter() - (now - self.started)
+        if asked_at:
+            self.add("queue", None, self._origin, time.perf_counter())
+
+    def add(self, kind, name, start, end, **attributes):
+        self.spans.append([
+            kind,
+            name,
+            round((start - self._origin) * 1000, 1),
+            round((end - start) * 1000, 1),
+            attributes or None,
+        ])
+
+    @contextmanager
+    def span(self, kind, name=None, **attributes):
+        """Time the block; the yielded dict takes attributes known only at the end (rows, tokens)."""
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.add(kind, name, start, time.perf_counter(), **attributes)
+
+    def record(self, status):
+        """Buffer the finished trace for `flush`."""
+        get_redis().rpush(BUFFER_KEY, json.dumps({
+            "data_id": str(self.data_id),
+            "user_id": str(self.user_id) if self.user_id is not None else None,
+            "message_id": self.message_id,
+            "question": self.question[:255],
+            "model": self.model,
+            "path": self.path,
+            "status": status,
+            "started_at": self.started,
+            "duration_ms": round((time.perf_counter() - self._origin) * 1000),
+            "spans": self.spans,
+        }, default=str))
+
+
+def start(data_id, user_id, question, model, path, asked_at=None):
+    """Trace the question on this context with probability TRACE_SAMPLE_RATE; returns the tracer or None."""
+    tracer = None
+    if random.random() < settings.TRACE_SAMPLE_RATE:
+        tracer = Tracer(data_id, user_id, question, model, path, asked_at)
+    # also clears the trace a previous task left on this worker thread
+    _current.set(tracer)
+    return tracer
+
+
+def current():
+    return _current.get()
+
+
+def handlers(llm):
+    """Callback handlers recording the steps of an agent reasoning with `llm` in the current trace."""
+    tracer = _current.get()
+    return [TracingHandler(tracer, llm)] if tracer is not None else []
+
+
+@contextmanager
+def span(kind, name=None, **attributes):
+    """Span of the current trace, if any."""
+    tracer = _current.get()
+    if tracer is None:
+        yield attributes
+        return
+    with tracer.span(kind, name, **attributes) as attributes:
+        yield attributes
+
+
+class TracingHandler(LLMUsageHandler):
+    """Records the agent's LLM calls, with their tokens counted by `llm`, and tool runs as spans of `tracer`."""
+    def __init__(self, tracer, llm):
+        super().__init__(llm)
+        self.tracer = tracer
+        self._started = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        super().on_llm_start(serialized, prompts, run_id=run_id, **kwargs)
+        self._started[run_id] = (time.perf_counter(), sum(len(prompt) for prompt in prompts))
+
+    def on_llm_usage(self, run_id, model_name, prompt_tokens, completion_tokens):
+        start, prompt_chars = self._started.pop(run_id, (time.perf_counter(), 0))
+        self.tracer.add(
+            "llm", model_name, start, time.perf_counter(),
+            prompt_chars=prompt_chars,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        super().on_llm_error(error, run_id=run_id, **kwargs)
+        start, _ = self._started.pop(run_id, (time.perf_counter(), 0))
+        self.tracer.add("llm", None, start, time.perf_counter(), error=type(error).__name__)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = (time.perf_counter(), serialized.get("name"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        start, name = self._started.pop(run_id, (time.perf_counter(), None))
+        self.tracer.add("tool", name, start, time.perf_counter(), output_chars=len(str(output)))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        start, name = self._started.pop(run_id, (time.perf_counter(), None))
+        self.tracer.add("tool", name, start, time.perf_counter(), error=type(error).__name__)
+
+
+def _existing(model, ids):
+    ids = {pk for pk in ids if pk is not None}
+    return {str(pk) for pk in model.objects.filter(pk__in=ids).values_list("pk", flat=True)} if ids else set()
+
+
+def _resolve(rows):
+    """
+    `rows` without the traces of deleted sources, with deleted users and
+    messages cleared the way their SET_NULL foreign keys would.
+    """
+    data_ids = _existing(models.Data, (row["data_id"] for row in rows))
+    user_ids = _existing(get_user_model(), (row["user_id"] for row in rows))
+    message_ids = _existing(models.Message, (row["message_id"] for row in rows))
+    resolved = []
+    for row in rows:
+        if row["data_id"] not in data_ids:
+            continue
+        if row["user_id"] not in user_ids:
+            row["user_id"] = None
+        if row["message_id"] not in message_ids:
+            row["message_id"] = None
+        resolved.append(row)
+    return resolved
+
+
+def flush(batch_size=None):
+    """Write buffered traces; returns how many."""
+    redis = get_redis()
+    batch_size = batch_size or settings.TRACE_FLUSH_ROWS
+    # a batch leaves the buffer only once written, so two flushers would write it twice
+    if not redis.set(FLUSH_LOCK_KEY, 1, nx=True, ex=60):
+        return 0
+    written = 0
+    try:
+        while True:
+            batch = redis.lrange(BUFFER_KEY, 0, batch_size - 1)
+            if not batch:
+                break
+            rows = _resolve([json.loads(row) for row in batch])
+            _write(rows)
+            redis.ltrim(BUFFER_KEY, len(batch), -1)
+            written += len(rows)
+    finally:
+        redis.delete(FLUSH_LOCK_KEY)
+    if written:
+        logger.info("Flushed %s traces", written)
+    return written
+
+
+def _write(rows):
+    models.Trace.objects.bulk_create([
+        models.Trace(
+            data_id=row["data_id"],
+            user_id=row["user_id"],
+            message_id=row["message_id"],
+            question=row["question"],
+            model=row["model"],
+            path=row["path"],
+            status=row["status"],
+            started_at=datetime.fromtimestamp(row["started_at"], tz=dt_timezone.utc),
+            duration_ms=row["duration_ms"],
+            spans=row["spans"],
+        )
+        for row in rows
+    ])
+
+
+def prune():
+    """Delete traces older than TRACE_RETENTION_DAYS."""
+    cutoff = timezone.now() - timedelta(days=settings.TRACE_RETENTION_DAYS)
+    deleted, _ = models.Trace.objects.filter(started_at__lt=cutoff).delete()
+    return deleted
+
+
+def percentiles(traces):
+    """p50/p95 of span durations per kind (plus the whole question) over `traces`, in ms."""
+    durations = {"total": []}
+    for duration_ms, spans in traces:
+        durations["total"].append(duration_ms)
+        per_kind = {}
+        # a question makes several LLM and SQL calls; what it waited on each kind is their sum
+        for kind, _, _, duration, _ in spans:
+            per_kind[kind] = per_kind.get(kind, 0) + duration
+        for kind, duration in per_kind.items():
+            durations.setdefault(kind, []).append(duration)
+    return {
+        kind: {
+            "count": len(values),
+            "p50": round(float(np.percentile(values, 50)), 1),
+            "p95": round(float(np.percentile(values, 95)), 1),
+        }
+        for kind, values in durations.items()
+        if values
+    }
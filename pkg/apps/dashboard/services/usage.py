@@ -0,0 +1,136 @@
+"""
+Write-behind usage accounting.
+
+`record` only appends to a Redis list; `flush` drains it in batches with one
+`bulk_create` and folds the batch into hourly and daily `UsageRollup` rows, so
+billing and quota checks read a few pre-aggregated rows instead of scanning
+every `Usage` row.
+"""
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from common.utils import get_redis
+
+from .. import models
+
+logger = logging.getLogger(__name__)
+
+BUFFER_KEY = "usage:buffer"
+FLUSH_LOCK_KEY = "usage:flush-lock"
+
+# Pops a batch off the buffer atomically. KEYS: buffer  ARGV: batch size
+_POP_BATCH = """
+local rows = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+redis.call('LTRIM', KEYS[1], #rows, -1)
+return rows
+"""
+
+
+def record(data_id, user_id, prompt_tokens, completion_tokens, total_tokens, total_cost):
+    """Buffer one usage row; returns True when the buffer is full enough to flush now."""
+    row = json.dumps({
+        "data_id": str(data_id),
+        "user_id": str(user_id) if user_id is not None else None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "total_cost": str(total_cost),
+        "at": timezone.now().timestamp(),
+    })
+    return get_redis().rpush(BUFFER_KEY, row) >= settings.USAGE_FLUSH_ROWS
+
+
+def _buckets(at):
+    hour = at.replace(minute=0, second=0, microsecond=0)
+    return (
+        (models.UsageRollup.Period.HOUR, hour),
+        (models.UsageRollup.Period.DAY, hour.replace(hour=0)),
+    )
+
+
+@transaction.atomic
+def _apply(rows):
+    models.Usage.objects.bulk_create([
+        models.Usage(
+            data_id=row["data_id"],
+            user_id=row["user_id"],
+            prompt_tokens=row["prompt_tokens"],
+            completion_tokens=row["completion_tokens"],
+            total_tokens=row["total_tokens"],
+            total_cost=Decimal(row["total_cost"]),
+        )
+        for row in rows
+    ])
+
+    sums = defaultdict(lambda: {
+        "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "total_cost": Decimal(0)
+    })
+    for row in rows:
+        at = datetime.fromtimestamp(row["at"], tz=dt_timezone.utc)
+        for period, bucket in _buckets(at):
+            total = sums[(period, bucket, row["user_id"], row["data_id"])]
+            total["requests"] += 1
+            total["prompt_tokens"] += row["prompt_tokens"]
+            total["completion_tokens"] += row["completion_tokens"]
+            total["total_tokens"] += row["total_tokens"]
+            total["total_cost"] += Decimal(row["total_cost"])
+
+    for (period, bucket, user_id, data_id), total in sums.items():
+        rollup, _ = models.UsageRollup.objects.get_or_create(
+            period=period, bucket=bucket, user_id=user_id, data_id=data_id
+        )
+        models.UsageRollup.objects.filter(pk=rollup.pk).update(
+            **{field: F(field) + value for field, value in total.items()}
+        )
+
+
+def flush(batch_size=None):
+    """Drain the buffer into Usage and the rollups; returns the number of rows written."""
+    redis = get_redis()
+    batch_size = batch_size or settings.USAGE_FLUSH_ROWS
+    # one flusher at a time keeps the rollup increments free of lost updates
+    if not redis.set(FLUSH_LOCK_KEY, 1, nx=True, ex=60):
+        return 0
+    written = 0
+    try:
+        pop = redis.register_script(_POP_BATCH)
+        while True:
+            rows = [json.loads(row) for row in pop(keys=[BUFFER_KEY], args=[batch_size])]
+            if not rows:
+                break
+            try:
+                _apply(rows)
+            except Exception:
+                # put the batch back so it's retried on the next flush
+                redis.lpush(BUFFER_KEY, *reversed([json.dumps(row) for row in rows]))
+                raise
+            written += len(rows)
+    finally:
+        redis.delete(FLUSH_LOCK_KEY)
+    if written:
+        logger.info("Flushed %s usage rows", written)
+    return written
+
+
+def totals(period=models.UsageRollup.Period.DAY, since=None, **filters):
+    """
+    Sum the rollups of `period` from `since` on, filtered by e.g. user=... or data=...
+    """
+    rollups = models.UsageRollup.objects.filter(period=period, **filters)
+    if since is not None:
+        rollups = rollups.filter(bucket__gte=since)
+    return rollups.aggregate(
+        requests=Sum("requests"),
+        prompt_tokens=Sum("prompt_tokens"),
+        completion_tokens=Sum("completion_tokens"),
+        total_tokens=Sum("total_tokens"),
+        total_cost=Sum("total_cost"),
+    )
@@ -0,0 +1,126 @@
+"""
+Worker warm-up.
+
+A fresh worker process pays for the secret fetch, engine, schema index and
+agent build on the first question of every source. `warm_up` does that work
+ahead of time for the sources asked about most recently: their credentials are
+read with BatchGetSecretValue in a few calls, then engines, table indexes and
+agents are built in a thread pool until WORKER_WARMUP_BUDGET seconds run out.
+Agents of wide schemas also reflect the tables their source's recent questions
+were pruned to, which they would otherwise do on first use.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max
+
+from .. import models, utils
+from . import agents, engines, secrets, sql_cache, table_index
+
+logger = logging.getLogger(__name__)
+
+# Outcome of the last warm-up of this process
+last_run = {}
+_metrics_lock = threading.Lock()
+
+
+def _count(metrics, key):
+    with _metrics_lock:
+        metrics[key] += 1
+
+
+def recent_sources(limit):
+    """The database sources with the most recent questions, newest first."""
+    recent = (
+        models.Message.objects.filter(is_ai=False, source__is_db=True)
+        .values("source")
+        .annotate(last=Max("id"))
+        .order_by("-last")[:limit]
+    )
+    ids = [row["source"] for row in recent]
+    sources = models.Data.objects.filter(id__in=ids).select_related("user")
+    order = {data_id: position for position, data_id in enumerate(ids)}
+    return sorted(sources, key=lambda data: order[data.id])
+
+
+def recent_questions(data, limit):
+    """The distinct questions last answered on `data`, newest first."""
+    questions = (
+        models.Message.objects.filter(source=data, is_ai=True, question__isnull=False)
+        .order_by("-id")
+        .values_list("question", flat=True)[:limit]
+    )
+    return list(dict.fromkeys(questions))
+
+
+def _warm_tables(data, built):
+    databases = [db for db in map(utils.agent_db, built) if isinstance(db, sql_cache.CachedSQLDatabase)]
+    if not databases:
+        return
+    tables = set()
+    for question in recent_questions(data, settings.WORKER_WARMUP_QUESTIONS):
+        tables.update(agents.relevant_tables(data, question) or ())
+    for db in databases:
+        db.reflect_tables(tables)
+
+
+def _warm_source(data, models_to_build, metrics):
+    try:
+        identifier = utils.generate_identifier(data.user, data)
+        username, password = secrets.get_secret_value(identifier)
+        if data.protocol != models.Data.ProtocolType.ELASTIC_SEARCH:
+            engine = engines.get_engine(data, data.conn_str(username, password))
+            # open one pooled connection so the first question skips the handshake
+            with engine.connect():
+                pass
+            _count(metrics, "engines")
+            if data.schema_hash:
+                table_index.get_index(data)
+        built = []
+        for model in models_to_build:
+            built.append(agents.get_agent(data.user, data, model))
+            _count(metrics, "agents")
+        _warm_tables(data, built)
+    except Exception:
+        _count(metrics, "failures")
+        logger.exception("Couldn't warm up data source %s", data.id)
+    finally:
+        connections.close_all()
+
+
+def warm_up(limit=None, budget=None, max_workers=None):
+    """Prefetch credentials and build engines and agents; returns the metrics of the run."""
+    limit = limit or settings.WORKER_WARMUP_SOURCES
+    budget = budget or settings.WORKER_WARMUP_BUDGET
+    max_workers = max_workers or settings.WORKER_WARMUP_THREADS
+    started = time.monotonic()
+    metrics = {"sources": 0, "secrets": 0, "engines": 0, "agents": 0, "failures": 0, "skipped": 0}
+
+    sources = recent_sources(limit)
+    metrics["sources"] = len(sources)
+    if sources:
+        found = secrets.batch_get_secret_values(
+            utils.generate_identifier(data.user, data) for data in sources
+        )
+        metrics["secrets"] = len(found)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="warmup")
+        futures = [
+            executor.submit(_warm_source, data, settings.WORKER_WARMUP_MODELS, metrics)
+            for data in sources
+        ]
+        remaining = budget - (time.monotonic() - started)
+        _, pending = wait(futures, timeout=max(remaining, 0))
+        # out of budget: drop what hasn't started, let running builds finish on their own
+        metrics["skipped"] = sum(future.cancel() for future in pending)
+        executor.shutdown(wait=False)
+
+    metrics["seconds"] = round(time.monotonic() - started, 2)
+    last_run.clear()
+    last_run.update(metrics)
+    logger.info("Worker warm-up: %s", metrics)
+    return metrics
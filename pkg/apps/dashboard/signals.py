@@ -0,0 +1,42 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Data, Message
+from .services import agents, api_specs, engines, examples, secrets
+
+
+@receiver(post_save, sender=Data)
+@receiver(post_delete, sender=Data)
+def invalidate_data_agents(sender, instance, **kwargs):
+    agents.agent_cache.invalidate_data(instance.id)
+
+
+@receiver(post_delete, sender=Data)
+def dispose_data_engines(sender, instance, **kwargs):
+    engines.registry.dispose(instance.id)
+
+
+@receiver(post_save, sender=Data)
+def fetch_api_spec(sender, instance, **kwargs):
+    # new source or new spec url: have the spec ready before the first question
+    if instance.is_api and instance.spec_url and api_specs.needs_refresh(instance):
+        from .tasks import refresh_api_spec
+        transaction.on_commit(lambda: refresh_api_spec.delay(instance.id, force=True))
+
+
+@receiver(post_delete, sender=Data)
+def delete_api_spec(sender, instance, **kwargs):
+    if instance.is_api:
+        api_specs.delete(instance.id)
+
+
+@receiver(secrets.secret_changed)
+def invalidate_secret_agents(sender, identifier, **kwargs):
+    agents.agent_cache.invalidate(identifier)
+
+
+@receiver(post_save, sender=Message)
+def index_answer(sender, instance, created, **kwargs):
+    if created and instance.is_ai and instance.sql_query and instance.question:
+        examples.add(instance)
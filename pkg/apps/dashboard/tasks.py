@@ -1,60 +1,249 @@
+import logging
+import random
+import threading
+from datetime import timedelta
+
 from asgiref.sync import async_to_sync
-from celery import shared_task 
+from celery import shared_task
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.exceptions import Retry
+from celery.signals import task_revoked, worker_process_init, worker_ready
 from channels.layers import get_channel_layer
 
-# from langchain.callbacks import get_openai_callback
-
-# from .services import secrets
-# from . import utils
-from . import models
+from .callbacks import CancellationHandler, ChannelStreamHandler, RateLimitHandler
+from .services import agents, answer_cache, api_specs, cancellation, crawl, engines, examples, fair_share, rate_limits, schema_snapshots, singleflight, sql_cache, tracing, usage, warmup
+from . import models, utils
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.sessions.backends.db import SessionStore
+from django.utils import timezone
 
 User = get_user_model()
 
-session = SessionStore()
+logger = logging.getLogger(__name__)
 
-@shared_task
-def return_query_resp(query, user_id, data_id, model):
-    user = User.objects.get(id=user_id)
+
+@shared_task(bind=True, max_retries=None)
+def return_query_resp(self, query, user_id, data_id, model, flight_key=None, use_cache=True, job_id=None, asked_at=None):
+    tracer = tracing.start(data_id, user_id, query, model, "celery", asked_at)
+    try:
+        result = _answer_query(self, query, user_id, data_id, model, flight_key, use_cache, asked_at)
+    except Retry:
+        # delayed by the rate limiter, the flight and the fair-share slot stay with this task
+        raise
+    except Exception as e:
+        if flight_key:
+            singleflight.abandon(flight_key)
+        _finished(self.request.id, user_id, data_id, job_id)
+        cancelled = isinstance(e, cancellation.QuestionCancelled)
+        if tracer:
+            tracer.record("cancelled" if cancelled else "error")
+        if cancelled:
+            logger.info("Cancelled a question on data source %s", data_id)
+            return None
+        raise
+    _finished(self.request.id, user_id, data_id, job_id)
+    if tracer:
+        tracer.record("ok")
+    return result
+
+
+def _finished(task_id, user_id, data_id, job_id):
+    cancellation.untrack_task(data_id, task_id)
+    if job_id:
+        fair_share.release(user_id, job_id)
+
+
+@task_revoked.connect
+def release_revoked_question(request=None, **kwargs):
+    # a question cancelled before it started still holds its flight and fair-share slot
+    if request is None or request.task != return_query_resp.name:
+        return
+    query, user_id, data_id, model = request.args[:4]
+    if request.kwargs.get("flight_key"):
+        singleflight.abandon(request.kwargs["flight_key"])
+    _finished(request.id, user_id, data_id, request.kwargs.get("job_id"))
+
+
+def _run_agent(task, query, user_id, data, model, stream, asked_at=None):
+    """Run the agent within the user's rate limits; returns (answer, sql query)."""
+    scope_ids = rate_limits.scopes(user_id, data.id)
+    slot = rate_limits.acquire_slot(user_id)
+    if slot is None:
+        raise task.retry(countdown=settings.LLM_SLOT_RETRY_DELAY + random.random())
+    try:
+        user = User.objects.get(id=user_id)
+        with tracing.span("agent_build"):
+            agent = agents.get_agent(user, data, model)
+            tables = agents.relevant_tables(data, query)
+        with tracing.span("examples"):
+            question = examples.augment(data, query)
+        # the agent LLM streams, so OpenAI reports no token usage for it
+        llm = utils.agent_llm(agent)
+        cb = RateLimitHandler(llm, scope_ids)
+        callbacks = [stream, cb, CancellationHandler(data.id, asked_at), *tracing.handlers(llm)]
+        with tracing.span("agent"), sql_cache.include_tables(tables):
+            response = agent(question, callbacks=callbacks)
+    except rate_limits.RateLimited as e:
+        raise task.retry(countdown=e.wait + random.random())
+    finally:
+        rate_limits.release_slot(user_id, slot)
+
+    if usage.record(
+        data.id, user.id,
+        prompt_tokens=cb.prompt_tokens,
+        completion_tokens=cb.completion_tokens,
+        total_tokens=cb.total_tokens,
+        total_cost=cb.total_cost,
+    ):
+        flush_usage.delay()
+
+    result = response.get("output", response.get("result"))
+    return result, utils.extract_sql(response.get("intermediate_steps"))
+
+
+def _answer_query(task, query, user_id, data_id, model, flight_key=None, use_cache=True, asked_at=None):
+    cancellation.check(data_id, asked_at)
     data = models.Data.objects.get(id=data_id)
-    identifier = utils.generate_identifier(user, data)
-    
-    if identifier not in session:
-        if data.is_db:
-            username, password = secrets.get_secret_value(identifier)
-            conn_str = data.conn_str(username, password)
-            
-            if data.protocol == models.Data.ProtocolType.ELASTIC_SEARCH:
-                agent = utils.get_elasticsearch_agent(conn_str, model, data.tbls)
-            else:
-                agent = utils.get_db_agent(conn_str, model, data.tbls)
-        elif data.is_api:
-            agent = utils.get_api_agent(
-                header=json.load(data.header), 
-                model=model
-            )
-        session[identifier] = agent
+    stream = ChannelStreamHandler(data_id)
+
+    with tracing.span("answer_cache") as span:
+        cached = answer_cache.get(data, query, model) if use_cache else None
+        span["hit"] = bool(cached)
+    if cached:
+        result, sql_query = cached["text"], cached["sql_query"]
     else:
-        agent = session.get(identifier)
-    
-    with get_openai_callback() as cb:
-        response = agent.run(query)
-        models.Usage.objects.create(
-            prompt_tokens=cb.prompt_tokens,
-            total_tokens=cb.total_tokens,
-            completion_tokens=cb.completion_tokens,
-            total_cost=cb.total_cost,
-        )
-        
-    result = response["result"]
+        result, sql_query = _run_agent(task, query, user_id, data, model, stream, asked_at)
+        answer_cache.set(data, query, model, result, sql_query)
+
     msg = models.Message.objects.create(
-        source=data, 
-        text=result, 
-        sql_query=response["intermediate_steps"][-2],
+        source=data,
+        text=result,
+        sql_query=sql_query,
+        question=query,
         is_ai=True
     )
-    msg.save() # save ai response and sql to the database 
-    async_to_sync(channel_layer.group_send)(f"chat_{data_id}", {"type": "chat_message", "msg_id": msg.id})
-    return result
\ No newline at end of file
+    msg.save() # save ai response and sql to the database
+    if tracing.current():
+        tracing.current().message_id = str(msg.id)
+    with tracing.span("publish"):
+        stream.commit(str(msg.id))
+    if flight_key:
+        # coalesced duplicates listening on other groups get the same answer
+        for group in singleflight.complete(flight_key, str(msg.id)) - {stream.group_name}:
+            send_message(group, str(msg.id))
+    return result
+
+
+def send_message(group, msg_id):
+    async_to_sync(get_channel_layer().group_send)(group, {"type": "chat_message", "msg_id": msg_id})
+
+
+@shared_task
+def dispose_idle_engines():
+    """Close connection pools of data sources nobody has queried recently."""
+    disposed = engines.registry.dispose_idle()
+    logger.info("Data source pools: %s", engines.registry.stats())
+    return disposed
+
+
+@shared_task
+def refresh_schema(data_id, force=False):
+    """Re-introspect the tables of a database source whose definition changed."""
+    data = models.Data.objects.get(id=data_id)
+    return schema_snapshots.refresh(data, engines.get_data_engine(data), force=force)
+
+
+@shared_task
+def refresh_schemas():
+    for data_id in models.Data.objects.database().exclude(
+        protocol=models.Data.ProtocolType.ELASTIC_SEARCH
+    ).values_list("id", flat=True):
+        refresh_schema.delay(data_id)
+
+
+@shared_task
+def refresh_api_spec(data_id, force=False):
+    """Revalidate the OpenAPI spec of an API source, re-reducing it when it changed."""
+    data = models.Data.objects.get(id=data_id)
+    return api_specs.refresh(data, force=force)
+
+
+@shared_task
+def refresh_api_specs():
+    for data_id in models.Data.objects.api().exclude(spec_url__isnull=True).values_list("id", flat=True):
+        refresh_api_spec.delay(data_id)
+
+
+@shared_task
+def flush_usage():
+    """Write buffered usage rows and fold them into the hourly/daily rollups."""
+    return usage.flush()
+
+
+@shared_task
+def flush_traces():
+    return tracing.flush()
+
+
+@shared_task
+def prune_traces():
+    return tracing.prune()
+
+
+@shared_task
+def drain_fair_share():
+    """Dispatch queued questions whose in-flight slots were freed by timeouts."""
+    return fair_share.drain()
+
+
+@shared_task
+def crawl_poll(crawl_id, polls=None):
+    """
+    Check a Glue crawl once and schedule the next check with backoff until it finishes.
+    `polls` is the count the chain expects; a chain another one already moved past stops.
+    """
+    obj = models.Crawl.objects.get(id=crawl_id)
+    if obj.is_finished or (polls is not None and obj.polls != polls):
+        return obj.state
+    delay = crawl.poll(obj)
+    if delay is not None:
+        crawl_poll.apply_async((crawl_id, obj.polls), countdown=delay)
+    return obj.state
+
+
+@shared_task
+def crawl_resume():
+    """Restart the poll chain of crawls whose next check was lost, e.g. with a crashed worker."""
+    now = timezone.now()
+    overdue = now - timedelta(seconds=settings.CRAWL_POLL_MAX_DELAY * 2)
+    stale = list(models.Crawl.objects.exclude(
+        state__in=models.Crawl.FINAL_STATES
+    ).filter(next_poll_at__lt=overdue).values_list("id", "next_poll_at", "polls"))
+    resumed = 0
+    for crawl_id, next_poll_at, polls in stale:
+        # claim the crawl: a concurrent resume or the late poll itself moves next_poll_at first
+        claimed = models.Crawl.objects.filter(
+            id=crawl_id, next_poll_at=next_poll_at, polls=polls
+        ).update(next_poll_at=now)
+        if claimed:
+            crawl_poll.delay(crawl_id, polls)
+            resumed += 1
+    return resumed
+
+
+def _start_warm_up():
+    threading.Thread(target=warmup.warm_up, name="warmup", daemon=True).start()
+
+
+@worker_ready.connect
+def warm_up_worker(sender=None, **kwargs):
+    # prefork children warm themselves up in worker_process_init
+    if settings.WORKER_WARMUP and not isinstance(getattr(sender, "pool", None), PreforkPool):
+        _start_warm_up()
+
+
+@worker_process_init.connect
+def warm_up_process(**kwargs):
+    if settings.WORKER_WARMUP:
+        _start_warm_up()
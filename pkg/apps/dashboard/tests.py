@@ -1,3 +1,748 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from botocore.exceptions import ClientError
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, IntegrityError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from redis.exceptions import RedisError
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from common import aws
+from common.utils import get_redis
+
+from . import models, tasks
+from .services import (
+    agents, api_specs, cancellation, crawl, examples, fair_share, introspection, rate_limits, schema_snapshots,
+    secrets, singleflight, sql_guard, tracing, usage,
+)
+from .services.sql_cache import SQLResultCache, canonicalize
+from .services.sql_guard import QueryRejected, SQLGuard
+from .wrappers import glue_wrapper
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except RedisError:
+        return False
+
+
+class AgentCacheTests(SimpleTestCase):
+    def key(self, identifier, model="gpt-3"):
+        return (identifier, "1", model)
+
+    def test_evicts_least_recently_used(self):
+        cache = agents.AgentCache(max_size=2)
+        cache.set(self.key("a"), "fp", "agent a")
+        cache.set(self.key("b"), "fp", "agent b")
+        self.assertEqual(cache.get(self.key("a"), "fp"), "agent a")
+        cache.set(self.key("c"), "fp", "agent c")
+        self.assertIsNone(cache.get(self.key("b"), "fp"))
+        self.assertEqual(cache.get(self.key("a"), "fp"), "agent a")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expires_idle_entries(self):
+        cache = agents.AgentCache(ttl=60)
+        with mock.patch.object(agents.time, "monotonic", return_value=1000.0):
+            cache.set(self.key("a"), "fp", "agent a")
+        with mock.patch.object(agents.time, "monotonic", return_value=1061.0):
+            self.assertIsNone(cache.get(self.key("a"), "fp"))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_changed_fingerprint_rebuilds(self):
+        cache = agents.AgentCache()
+        cache.set(self.key("a"), "old", "agent a")
+        self.assertIsNone(cache.get(self.key("a"), "new"))
+        self.assertIsNone(cache.get(self.key("a"), "old"))
+
+    def test_invalidate_drops_every_model(self):
+        cache = agents.AgentCache()
+        cache.set(self.key("a", "gpt-3"), "fp", "agent a3")
+        cache.set(self.key("a", "gpt-4"), "fp", "agent a4")
+        cache.set(self.key("b"), "fp", "agent b")
+        cache.invalidate("a")
+        self.assertEqual(cache.stats()["size"], 1)
+        self.assertEqual(cache.get(self.key("b"), "fp"), "agent b")
+
+
+class CanonicalizeTests(SimpleTestCase):
+    def test_collapses_whitespace_and_case_outside_literals(self):
+        self.assertEqual(
+            canonicalize("SELECT  *\n  FROM Users WHERE name = 'Ada  Lovelace' AND \"Team\" = 'R&D';"),
+            "select * from users where name = 'Ada  Lovelace' and \"Team\" = 'R&D'",
+        )
+
+    def test_same_key_for_equivalent_queries(self):
+        self.assertEqual(canonicalize("select count(*) from t;"), canonicalize("SELECT COUNT(*)\nFROM t"))
+        self.assertNotEqual(canonicalize("select 'A'"), canonicalize("select 'a'"))
+
+
+@override_settings(FAIR_SHARE_MAX_IN_FLIGHT=1, FAIR_SHARE_MAX_IN_FLIGHT_PER_USER=1, FAIR_SHARE_TIMEOUT=600)
+class FairShareTests(SimpleTestCase):
+    prefix = "test:fairshare:"
+
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        keys = {
+            "PREFIX": self.prefix,
+            "READY_KEY": f"{self.prefix}ready",
+            "IN_FLIGHT_KEY": f"{self.prefix}inflight",
+            "PASS_KEY": f"{self.prefix}pass",
+            "STRIDE_KEY": f"{self.prefix}stride",
+            "VTIME_KEY": f"{self.prefix}vtime",
+        }
+        self.dispatched = []
+        task = mock.Mock()
+        task.delay.side_effect = self.dispatch
+        patches = [
+            mock.patch.multiple(fair_share, **keys),
+            mock.patch.object(fair_share, "weight", side_effect={"1": 1, "2": 3}.get),
+            mock.patch.object(fair_share.cancellation, "track_task"),
+            mock.patch.object(tasks, "return_query_resp", task),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.clear)
+
+    def clear(self):
+        redis = get_redis()
+        for key in redis.scan_iter(f"{self.prefix}*"):
+            redis.delete(key)
+
+    def dispatch(self, query, user_id, data_id, model, **kwargs):
+        self.dispatched.append((user_id, kwargs["job_id"]))
+        return mock.Mock(id=kwargs["job_id"])
+
+    def test_heavier_plans_get_proportionally_more_turns(self):
+        for user_id in ("1", "2"):
+            for i in range(3):
+                fair_share.submit(f"question {i}", user_id, "1", "gpt-3")
+        while len(self.dispatched) < 6:
+            fair_share.release(*self.dispatched[-1])
+        self.assertEqual([user_id for user_id, _ in self.dispatched], ["1", "2", "2", "2", "1", "1"])
+
+    def test_waits_for_a_free_slot(self):
+        fair_share.submit("first", "1", "1", "gpt-3")
+        fair_share.submit("second", "2", "1", "gpt-3")
+        self.assertEqual(len(self.dispatched), 1)
+        fair_share.release(*self.dispatched[0])
+        self.assertEqual([user_id for user_id, _ in self.dispatched], ["1", "2"])
+
+
+class SQLGuardTests(SimpleTestCase):
+    def setUp(self):
+        self.guard = SQLGuard("postgresql", 100, cost_limit=1000, sample_rows=10)
+
+    def test_parse_accepts_a_single_select(self):
+        statement = self.guard.parse("  SELECT id FROM orders; -- trailing comment")
+        self.assertEqual(str(statement), "SELECT id FROM orders")
+
+    def test_parse_rejects_writes_and_several_statements(self):
+        for sql in (
+            "DELETE FROM orders",
+            "SELECT 1; SELECT 2",
+            "SELECT * INTO copy FROM orders",
+            "WITH gone AS (DELETE FROM orders RETURNING *) SELECT * FROM gone",
+        ):
+            with self.subTest(sql=sql), self.assertRaises(QueryRejected):
+                self.guard.parse(sql)
+
+    def test_parse_rejects_forbidden_calls_only(self):
+        for sql in ("SELECT pg_sleep(10)", 'SELECT "sleep"(1)', "SELECT pg_catalog.set_config('role', 'admin', false)"):
+            with self.subTest(sql=sql), self.assertRaises(QueryRejected):
+                self.guard.parse(sql)
+        self.guard.parse("SELECT sleep, benchmark FROM runs WHERE benchmark > 1")
+
+    def test_limit(self):
+        cases = {
+            "SELECT * FROM t": ("SELECT * FROM t LIMIT 100", None),
+            "SELECT * FROM t LIMIT 5": ("SELECT * FROM t LIMIT 5", None),
+            "SELECT * FROM t LIMIT 500": ("SELECT * FROM t LIMIT 100", "LIMIT lowered to 100 rows"),
+            "SELECT * FROM t LIMIT 10, 500": ("SELECT * FROM t LIMIT 10, 100", "LIMIT lowered to 100 rows"),
+            "SELECT * FROM t OFFSET 5": ("SELECT * FROM (SELECT * FROM t OFFSET 5) AS guarded_query LIMIT 100", None),
+        }
+        for sql, expected in cases.items():
+            with self.subTest(sql=sql):
+                self.assertEqual(self.guard.limit(self.guard.parse(sql), 100), expected)
+
+    def test_limit_leaves_other_dialects_alone(self):
+        guard = SQLGuard("mssql", 100)
+        self.assertEqual(guard.limit(guard.parse("SELECT * FROM t"), 100), ("SELECT * FROM t", None))
+
+    def test_candidates_fall_back_to_a_sample(self):
+        self.assertEqual(list(self.guard.candidates("SELECT * FROM t")), [
+            ("SELECT * FROM t LIMIT 100", None),
+            ("SELECT * FROM t LIMIT 10", "Estimated too expensive in full, LIMIT lowered to 10 rows"),
+        ])
+
+    @override_settings(SQL_GUARD_ROW_LIMIT=100, SQL_GUARD_COST_LIMITS={"postgresql": 1000})
+    def test_get_guard_uses_the_source_overrides(self):
+        default = sql_guard.get_guard(SimpleNamespace(query_row_limit=None, query_cost_limit=None), "postgresql")
+        self.assertEqual((default.row_limit, default.cost_limit), (100, 1000))
+        source = sql_guard.get_guard(SimpleNamespace(query_row_limit=5, query_cost_limit=50.0), "postgresql")
+        self.assertEqual((source.row_limit, source.cost_limit), (5, 50.0))
+
+    def test_limits_must_be_positive(self):
+        for name in ("query_row_limit", "query_cost_limit"):
+            with self.subTest(field=name), self.assertRaises(ValidationError):
+                models.Data._meta.get_field(name).clean(0, None)
+
+
+class ExampleIndexTests(SimpleTestCase):
+    def setUp(self):
+        # smaller than the examples, so adding them grows the matrix
+        self.index = examples.ExampleIndex(capacity=2)
+        self.index.add("How many customers are there?", "SELECT COUNT(*) FROM customers")
+        self.index.add("Total order amount per status", "SELECT status, SUM(amount) FROM orders GROUP BY status")
+        self.index.add("Which products sold best last month?", "SELECT product_id, SUM(quantity) FROM sales GROUP BY 1")
+
+    def test_most_similar_first(self):
+        found = self.index.search("order amount by status", 2)
+        self.assertEqual(found[0][:2], ("Total order amount per status", "SELECT status, SUM(amount) FROM orders GROUP BY status"))
+        self.assertTrue(all(found[i][2] >= found[i + 1][2] for i in range(len(found) - 1)))
+
+    def test_k_and_min_similarity(self):
+        self.assertEqual(len(self.index.search("customers orders products status", 1)), 1)
+        self.assertEqual(self.index.search("weather in paris", 3, min_similarity=0.1), [])
+
+    def test_question_asked_again_replaces_its_sql(self):
+        self.index.add("how many customers are there", "SELECT COUNT(id) FROM customers")
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.search("how many customers", 1)[0][1], "SELECT COUNT(id) FROM customers")
+
+    def test_exclude(self):
+        found = self.index.search("How many customers are there?", 3, exclude="how many customers are there")
+        self.assertNotIn("How many customers are there?", [question for question, _, _ in found])
+
+
+class PercentilesTests(SimpleTestCase):
+    def test_sums_spans_per_kind_within_a_trace(self):
+        traces = [
+            (100, [["llm", None, 0, 40, None], ["sql", None, 40, 5, None], ["llm", None, 50, 20, None]]),
+            (300, [["llm", None, 0, 200, None]]),
+        ]
+        self.assertEqual(tracing.percentiles(traces), {
+            "total": {"count": 2, "p50": 200.0, "p95": 290.0},
+            "llm": {"count": 2, "p50": 130.0, "p95": 193.0},
+            "sql": {"count": 1, "p50": 5.0, "p95": 5.0},
+        })
+
+    def test_no_traces(self):
+        self.assertEqual(tracing.percentiles([]), {})
+
+
+def sqlite_engine(*statements):
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+    return engine
+
+
+SHOP_TABLES = (
+    "CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT)",
+    "CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customers (id), amount NUMERIC)",
+    "CREATE TABLE order_lines (order_id INTEGER REFERENCES orders (id), line INTEGER, sku TEXT, PRIMARY KEY (order_id, line))",
+)
+
+
+class IntrospectionTests(SimpleTestCase):
+    def test_sqlite_catalog(self):
+        tables = introspection.introspect(sqlite_engine(*SHOP_TABLES))
+        self.assertEqual(list(tables), ["customers", "order_lines", "orders"])
+        self.assertEqual(tables["orders"], {
+            "columns": [("id", "INTEGER"), ("customer_id", "INTEGER"), ("amount", "NUMERIC")],
+            "primary_keys": ["id"],
+            "foreign_keys": {"customer_id": "customers"},
+        })
+        self.assertEqual(sorted(tables["order_lines"]["primary_keys"]), ["line", "order_id"])
+        self.assertEqual(tables["order_lines"]["foreign_keys"], {"order_id": "orders"})
+
+    def test_matches_the_inspector(self):
+        engine = sqlite_engine(*SHOP_TABLES)
+        bulk = introspection.introspect(engine)
+        for name, table in introspection.inspector_introspect(engine).items():
+            with self.subTest(table=name):
+                self.assertEqual(bulk[name]["columns"], [(column, str(type)) for column, type in table["columns"]])
+                self.assertEqual(sorted(bulk[name]["primary_keys"]), sorted(table["primary_keys"]))
+                self.assertEqual(bulk[name]["foreign_keys"], table["foreign_keys"])
+
+    def test_fingerprints_move_with_the_definition(self):
+        engine = sqlite_engine(*SHOP_TABLES)
+        before = introspection.catalog_fingerprints(engine)
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE orders ADD COLUMN status TEXT"))
+        after = introspection.catalog_fingerprints(engine)
+        self.assertEqual(set(before), set(after))
+        self.assertEqual([name for name in after if after[name] != before[name]], ["orders"])
+
+
+@mock.patch.object(schema_snapshots.sql_cache, "get_cache")
+@mock.patch.object(schema_snapshots.answer_cache, "invalidate")
+class SchemaSnapshotTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(email="owner@example.com", password="secret")
+        self.data = models.Data.objects.create(user=user, title="shop", is_db=True)
+        self.engine = sqlite_engine(*SHOP_TABLES)
+
+    def alter(self, statement):
+        with self.engine.begin() as conn:
+            conn.execute(text(statement))
+
+    def test_first_refresh_stores_every_table(self, invalidate, get_cache):
+        self.assertTrue(schema_snapshots.refresh(self.data, self.engine))
+        self.assertEqual(list(schema_snapshots.load(self.data)), ["customers", "order_lines", "orders"])
+        self.assertIn("orders|customer_id-fk(customers)", self.data.schema)
+        invalidate.assert_called_once_with(self.data.id)
+
+    def test_unchanged_refresh_keeps_the_hash(self, invalidate, get_cache):
+        schema_snapshots.refresh(self.data, self.engine)
+        schema_hash = self.data.schema_hash
+        with mock.patch.object(schema_snapshots.introspection, "introspect") as introspect:
+            self.assertFalse(schema_snapshots.refresh(self.data, self.engine))
+        introspect.assert_not_called()
+        self.assertEqual(self.data.schema_hash, schema_hash)
+        self.assertFalse(schema_snapshots.has_changed(self.data, self.engine))
+
+    def test_reintrospects_only_altered_tables(self, invalidate, get_cache):
+        schema_snapshots.refresh(self.data, self.engine)
+        schema_hash = self.data.schema_hash
+        self.alter("ALTER TABLE orders ADD COLUMN status TEXT")
+        self.assertTrue(schema_snapshots.has_changed(self.data, self.engine))
+        inspector_introspect = schema_snapshots.introspection.inspector_introspect
+        with mock.patch.object(
+            schema_snapshots.introspection, "inspector_introspect", wraps=inspector_introspect
+        ) as introspect:
+            self.assertTrue(schema_snapshots.refresh(self.data, self.engine))
+        introspect.assert_called_once_with(self.engine, table_names=["orders"])
+        self.assertEqual(schema_snapshots.load(self.data)["orders"]["columns"][-1], ("status", "TEXT"))
+        self.assertNotEqual(self.data.schema_hash, schema_hash)
+
+    def test_dropped_tables_are_removed(self, invalidate, get_cache):
+        schema_snapshots.refresh(self.data, self.engine)
+        self.alter("DROP TABLE order_lines")
+        self.assertTrue(schema_snapshots.refresh(self.data, self.engine))
+        self.assertEqual(list(schema_snapshots.load(self.data)), ["customers", "orders"])
+        self.assertNotIn("order_lines|", self.data.schema)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        self.key = singleflight.flight_key("test", "How many orders?", "gpt-3")
+        self.addCleanup(get_redis().delete, *singleflight._keys(self.key))
+
+    def test_same_question_shares_a_flight(self):
+        self.assertEqual(self.key, singleflight.flight_key("test", "  how many   ORDERS ", "gpt-3"))
+        self.assertNotEqual(self.key, singleflight.flight_key("test", "how many orders", "gpt-4"))
+
+    def test_followers_are_notified_on_complete(self):
+        self.assertEqual(singleflight.join(self.key, "chat_a"), (singleflight.LEADER, None))
+        self.assertEqual(singleflight.join(self.key, "chat_b"), (singleflight.FOLLOWER, None))
+        self.assertEqual(singleflight.join(self.key, "chat_c"), (singleflight.FOLLOWER, None))
+        self.assertEqual(singleflight.complete(self.key, "msg1"), {"chat_b", "chat_c"})
+        self.assertEqual(singleflight.join(self.key, "chat_d"), ("result", "msg1"))
+
+    def test_abandoned_flight_gets_a_new_leader(self):
+        singleflight.join(self.key, "chat_a")
+        singleflight.join(self.key, "chat_b")
+        singleflight.abandon(self.key)
+        self.assertEqual(singleflight.join(self.key, "chat_b"), (singleflight.LEADER, None))
+        self.assertEqual(singleflight.complete(self.key, "msg1"), set())
+
+
+@override_settings(SQL_RESULT_CACHE_MAX_BYTES=100)
+class SQLResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        self.cache = SQLResultCache("test", ttl=60, budget=25)
+        self.addCleanup(self.cache.clear)
+
+    def used(self):
+        return int(get_redis().get(f"{self.cache.prefix}:used") or 0)
+
+    def test_evicts_the_oldest_results_over_budget(self):
+        self.cache.set("SELECT 1", "a" * 10)
+        self.cache.set("SELECT 2", "b" * 10)
+        self.cache.set("select  1", "c" * 5)
+        self.assertEqual(self.used(), 15)
+        self.cache.set("SELECT 3", "d" * 15)
+        self.assertIsNone(self.cache.get("SELECT 2"))
+        self.assertEqual(self.cache.get("SELECT 1"), "c" * 5)
+        self.assertEqual(self.used(), 20)
+
+    def test_clear_resets_the_byte_count(self):
+        self.cache.set("SELECT 1", "a" * 10)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("SELECT 1"))
+        self.assertEqual(self.used(), 0)
+
+
+@override_settings(USAGE_FLUSH_ROWS=2)
+class UsageFlushTests(TestCase):
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        for patch in (
+            mock.patch.object(usage, "BUFFER_KEY", "test:usage:buffer"),
+            mock.patch.object(usage, "FLUSH_LOCK_KEY", "test:usage:flush-lock"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(get_redis().delete, "test:usage:buffer", "test:usage:flush-lock")
+        self.user = get_user_model().objects.create_user(email="owner@example.com", password="secret")
+        self.data = models.Data.objects.create(user=self.user, title="shop", is_db=True)
+
+    def test_rolls_up_per_hour_and_day(self):
+        usage.record(self.data.id, self.user.id, 10, 5, 15, "0.01")
+        self.assertTrue(usage.record(self.data.id, self.user.id, 20, 5, 25, "0.02"))
+        usage.record(self.data.id, None, 1, 1, 2, "0.001")
+        self.assertEqual(usage.flush(), 3)
+        self.assertEqual(models.Usage.objects.count(), 3)
+        self.assertEqual(models.UsageRollup.objects.count(), 4)
+        totals = usage.totals(models.UsageRollup.Period.HOUR, user=self.user)
+        self.assertEqual((totals["requests"], totals["total_tokens"], totals["total_cost"]), (2, 40, Decimal("0.03")))
+
+        # usage without a user lands on the same rollup row every flush
+        usage.record(self.data.id, None, 1, 1, 2, "0.001")
+        self.assertEqual(usage.flush(), 1)
+        totals = usage.totals(user=None, data=self.data)
+        self.assertEqual((totals["requests"], totals["total_tokens"]), (2, 4))
+
+    def test_failed_batch_goes_back_to_the_buffer(self):
+        for tokens in (1, 2, 3):
+            usage.record(self.data.id, self.user.id, tokens, 0, tokens, "0")
+        with mock.patch.object(usage, "_apply", side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            usage.flush()
+        rows = [json.loads(row)["total_tokens"] for row in get_redis().lrange(usage.BUFFER_KEY, 0, -1)]
+        self.assertEqual(rows, [1, 2, 3])
+        self.assertEqual(usage.flush(), 3)
+        self.assertEqual(usage.totals(user=self.user)["total_tokens"], 6)
+
+    def test_one_rollup_per_bucket_without_a_user(self):
+        bucket = timezone.now().replace(minute=0, second=0, microsecond=0)
+        models.UsageRollup.objects.create(period=models.UsageRollup.Period.HOUR, bucket=bucket, data=self.data)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.UsageRollup.objects.create(period=models.UsageRollup.Period.HOUR, bucket=bucket, data=self.data)
+
+
+@override_settings(LLM_RATE_LIMITS={"user": {"rpm": 2, "tpm": 600}}, LLM_ESTIMATED_TOKENS=100)
+class RateLimitTests(SimpleTestCase):
+    scope_ids = [("user", "test")]
+
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        self.addCleanup(get_redis().delete, "ratelimit:user:test:rpm", "ratelimit:user:test:tpm")
+        patch = mock.patch.object(rate_limits.time, "time", return_value=1000.0)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_waits_for_the_shortest_bucket(self):
+        self.assertEqual(rate_limits.acquire(self.scope_ids, 500), 0)
+        # 10 tokens per second refill the 600 tpm bucket: 200 missing tokens take 20s
+        self.assertAlmostEqual(rate_limits.acquire(self.scope_ids, 300), 20.0)
+        # a refused call takes nothing
+        self.assertEqual(rate_limits.state("user", "test"), {"rpm": (1, 2), "tpm": (100, 600)})
+        self.assertEqual(rate_limits.acquire(self.scope_ids, 50), 0)
+        self.assertAlmostEqual(rate_limits.acquire(self.scope_ids, 0), 30.0)
+
+    def test_settle_charges_the_difference(self):
+        rate_limits.acquire(self.scope_ids)
+        rate_limits.settle(self.scope_ids, 40)
+        self.assertEqual(rate_limits.state("user", "test")["tpm"], (560, 600))
+        rate_limits.settle(self.scope_ids, 300, estimated_tokens=0)
+        self.assertEqual(rate_limits.state("user", "test")["tpm"], (260, 600))
+
+    def test_unlimited_scopes_are_granted(self):
+        self.assertEqual(rate_limits.acquire([("data", "test")], 10 ** 6), 0)
+
+
+@override_settings(CRAWL_POLL_INITIAL_DELAY=5, CRAWL_POLL_MAX_DELAY=60, CRAWL_TIMEOUT=3600)
+class CrawlPollTests(TestCase):
+    def setUp(self):
+        self.crawl = models.Crawl.objects.create(identifier="shop", crawler_name="shop-crawler", glue_db_name="shop")
+        self.glue = mock.Mock()
+        patch = mock.patch.object(crawl.glue_wrapper.catalog_cache, "expire")
+        self.expire = patch.start()
+        self.addCleanup(patch.stop)
+
+    def crawler(self, state, status=None, started=None, error=None):
+        last = {"Status": status, "StartTime": started or timezone.now()}
+        if error:
+            last["ErrorMessage"] = error
+        return {"State": state, "LastCrawl": last if status else None}
+
+    def poll(self, crawler):
+        self.glue.get_crawler.return_value = crawler
+        return crawl.poll(self.crawl, self.glue)
+
+    def test_backs_off_exponentially_up_to_the_max(self):
+        with mock.patch.object(crawl.random, "uniform", return_value=1.0):
+            self.assertEqual([crawl.next_delay(polls) for polls in range(6)], [5, 10, 20, 40, 60, 60])
+
+    def test_running_crawl_is_polled_again(self):
+        delay = self.poll(self.crawler("RUNNING"))
+        self.assertTrue(8 <= delay <= 12)
+        self.crawl.refresh_from_db()
+        self.assertEqual((self.crawl.state, self.crawl.polls), (models.Crawl.State.RUNNING, 1))
+        self.assertIsNotNone(self.crawl.next_poll_at)
+
+    def test_ready_before_the_run_started_keeps_waiting(self):
+        previous_run = self.crawl.started_at - timedelta(hours=1)
+        self.assertIsNotNone(self.poll(self.crawler("READY", "SUCCEEDED", started=previous_run)))
+        self.assertEqual(self.crawl.state, models.Crawl.State.STARTING)
+
+    def test_finished_crawl_is_reported_once(self):
+        self.assertIsNone(self.poll(self.crawler("READY", "FAILED", error="Access denied")))
+        self.crawl.refresh_from_db()
+        self.assertEqual((self.crawl.state, self.crawl.error_message), (models.Crawl.State.FAILED, "Access denied"))
+        self.assertIsNotNone(self.crawl.finished_at)
+        self.assertIsNone(self.crawl.next_poll_at)
+
+        # a second poller that read the crawl before it finished doesn't report it again
+        stale = models.Crawl.objects.get(pk=self.crawl.pk)
+        stale.state = models.Crawl.State.RUNNING
+        crawl.poll(stale, self.glue)
+        self.expire.assert_called_once_with("shop")
+
+    def test_missing_crawler_fails(self):
+        self.assertIsNone(self.poll(None))
+        self.assertEqual(self.crawl.state, models.Crawl.State.FAILED)
+        self.assertEqual(self.crawl.error_message, "The crawler no longer exists")
+
+    def test_times_out(self):
+        models.Crawl.objects.filter(pk=self.crawl.pk).update(started_at=timezone.now() - timedelta(hours=2))
+        self.crawl.refresh_from_db()
+        self.assertIsNone(self.poll(self.crawler("RUNNING")))
+        self.crawl.refresh_from_db()
+        self.assertEqual(self.crawl.state, models.Crawl.State.FAILED)
+        self.assertEqual(self.crawl.error_message, "Timed out waiting for the crawler")
+
+
+class GlueWrapperTests(SimpleTestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.can_paginate.return_value = False
+        self.glue = glue_wrapper.GlueWrapper(self.client)
+
+    def pages(self, *pages):
+        responses = []
+        for index, names in enumerate(pages):
+            response = {"TableList": [{"Name": name, "VersionId": "1"} for name in names]}
+            if index < len(pages) - 1:
+                response["NextToken"] = f"token{index + 1}"
+            responses.append(response)
+        self.client.get_tables.side_effect = responses
+
+    def test_follows_next_token(self):
+        self.pages(["a", "b"], ["c"], [])
+        self.assertEqual([table["Name"] for table in self.glue.iter_tables("shop")], ["a", "b", "c"])
+        self.assertEqual(self.client.get_tables.call_args_list, [
+            mock.call(DatabaseName="shop"),
+            mock.call(DatabaseName="shop", NextToken="token1"),
+            mock.call(DatabaseName="shop", NextToken="token2"),
+        ])
+
+    def test_client_errors_are_raised(self):
+        error = ClientError({"Error": {"Code": "AccessDeniedException", "Message": "denied"}}, "GetTables")
+        self.client.get_tables.side_effect = error
+        with self.assertRaises(ClientError):
+            list(self.glue.iter_tables("shop"))
+
+    def test_reports_changed_and_dropped_tables(self):
+        cache = glue_wrapper.CatalogCache()
+        self.pages(["a", "b"], ["c"])
+        self.glue.get_tables("shop", cache=cache)
+        self.assertEqual(cache.changed("shop"), ["a", "b", "c"])
+        self.client.get_tables.side_effect = [
+            {"TableList": [{"Name": "a", "VersionId": "2"}, {"Name": "b", "VersionId": "1"}]},
+        ]
+        cache.expire("shop")
+        self.glue.get_tables("shop", cache=cache)
+        self.assertEqual(cache.changed("shop"), ["a", "c"])
+
+
+class AWSClientTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.multiple(aws, _sessions={}, _clients={}, _resources={})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get_client(self, service="glue", region="eu-west-1", key="AKIATEST", secret="secret"):
+        return aws.get_client(service, region_name=region, aws_access_key_id=key, aws_secret_access_key=secret)
+
+    def test_one_client_per_service_region_and_credentials(self):
+        client = self.get_client()
+        self.assertIs(self.get_client(), client)
+        others = [self.get_client(service="s3"), self.get_client(region="us-east-1"), self.get_client(secret="rotated")]
+        self.assertEqual(len({id(client), *map(id, others)}), 4)
+        self.assertEqual(aws.stats()["clients"], 4)
+
+    def test_clients_of_the_same_credentials_share_a_session(self):
+        with mock.patch.object(aws.boto3.session, "Session", wraps=aws.boto3.session.Session) as session:
+            self.get_client()
+            self.get_client(service="s3", region="us-east-1")
+            self.get_client(secret="rotated")
+        self.assertEqual(session.call_count, 2)
+
+    def test_clients_use_the_pooled_config(self):
+        with self.settings(AWS_MAX_POOL_CONNECTIONS=7):
+            self.assertEqual(self.get_client(service="sts").meta.config.max_pool_connections, 7)
+
+
+class CredentialCacheTests(SimpleTestCase):
+    identifier = "test-secret"
+
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        self.addCleanup(get_redis().delete, f"secrets:generation:{self.identifier}")
+        self.cache = secrets.CredentialCache(ttl=300, refresh_ahead=60)
+        self.versions = iter(range(1, 100))
+        self.secret = mock.Mock()
+        self.secret.get_value.side_effect = self.value
+        self.now = 1000.0
+        for patch in (
+            mock.patch.object(secrets, "_secret", return_value=self.secret),
+            mock.patch.object(secrets.time, "monotonic", side_effect=lambda: self.now),
+            # run the refresh-ahead inline instead of on the cache's thread pool
+            mock.patch.object(self.cache._executor, "submit", side_effect=lambda fn, *args: fn(*args)),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def value(self, name, stage):
+        version = next(self.versions)
+        return {"SecretString": json.dumps({"username": "app", "password": f"v{version}"}), "VersionId": str(version)}
+
+    def test_serves_from_memory_until_the_ttl(self):
+        self.assertEqual(self.cache.get(self.identifier)["password"], "v1")
+        self.now += 200
+        self.assertEqual(self.cache.get(self.identifier)["password"], "v1")
+        self.now += 101
+        self.assertEqual(self.cache.get(self.identifier)["password"], "v2")
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_refreshes_ahead_of_expiry(self):
+        self.cache.get(self.identifier)
+        self.now += 250
+        with mock.patch.object(secrets.secret_changed, "send") as changed:
+            # the read is served from memory, the reload happens behind it
+            self.assertEqual(self.cache.get(self.identifier)["password"], "v1")
+        changed.assert_called_once_with(sender=None, identifier=self.identifier)
+        self.assertEqual(self.cache.get(self.identifier)["password"], "v2")
+        self.assertEqual(self.cache.stats()["refreshes"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_generation_bump_reloads_everywhere(self):
+        other_process = secrets.CredentialCache()
+        self.cache.get(self.identifier)
+        other_process.get(self.identifier)
+        other_process.bump(self.identifier)
+        self.assertEqual(self.cache.get(self.identifier)["password"], "v3")
+
+
+class CancellationTests(SimpleTestCase):
+    data = SimpleNamespace(id="test")
+
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        redis = get_redis()
+        self.addCleanup(redis.delete, *(f"{cancellation.PREFIX}{kind}:test" for kind in ("epoch", "tasks", "sessions")))
+
+    def cancel(self, at):
+        with mock.patch.object(cancellation.current_app.control, "revoke") as revoke:
+            with mock.patch.object(cancellation.time, "time", return_value=at):
+                result = cancellation.cancel(self.data)
+        return result, revoke
+
+    def test_cancels_questions_asked_before_the_stop(self):
+        cancellation.check(self.data.id, 1000.0)
+        self.cancel(2000.0)
+        with self.assertRaises(cancellation.QuestionCancelled):
+            cancellation.check(self.data.id, 1000.0)
+        with self.assertRaises(cancellation.QuestionCancelled):
+            cancellation.check(self.data.id, 2000.0)
+        cancellation.check(self.data.id, 2000.5)
+        cancellation.check(self.data.id, None)
+
+    def test_revokes_tracked_tasks(self):
+        cancellation.track_task(self.data.id, "task1")
+        cancellation.track_task(self.data.id, "task2")
+        cancellation.untrack_task(self.data.id, "task2")
+        result, revoke = self.cancel(2000.0)
+        revoke.assert_called_once_with(["task1"])
+        self.assertEqual(result, {"tasks": 1, "sessions": 0})
+
+
+def openapi_spec(*paths):
+    return {
+        "servers": [{"url": "https://api.example.com"}],
+        "info": {"description": "Shop API"},
+        "paths": {
+            path: {"get": {"description": f"List {path[1:]}", "responses": {"200": {"description": "OK"}}}}
+            for path in paths
+        },
+    }
+
+
+class APISpecTests(TestCase):
+    def setUp(self):
+        if not redis_available():
+            self.skipTest("needs Redis")
+        user = get_user_model().objects.create_user(email="owner@example.com", password="secret")
+        self.data = models.Data.objects.create(
+            user=user, title="shop", is_api=True, spec_url="https://api.example.com/openapi.json"
+        )
+        self.addCleanup(api_specs.delete, self.data.id)
+        patch = mock.patch.object(api_specs.requests, "get")
+        self.get = patch.start()
+        self.addCleanup(patch.stop)
+
+    def respond(self, status, spec=None, etag=None):
+        response = mock.Mock(status_code=status, headers={"ETag": etag} if etag else {})
+        response.json.return_value = spec
+        self.get.return_value = response
+
+    def test_revalidates_with_the_stored_etag(self):
+        self.respond(200, openapi_spec("/orders"), etag='"v1"')
+        self.assertTrue(api_specs.refresh(self.data))
+        self.assertEqual(self.get.call_args.kwargs["headers"], {})
+        spec_hash = self.data.spec_hash
+
+        self.respond(304)
+        self.assertFalse(api_specs.refresh(self.data))
+        self.assertEqual(self.get.call_args.kwargs["headers"], {"If-None-Match": '"v1"'})
+        self.data.refresh_from_db()
+        self.assertEqual(self.data.spec_hash, spec_hash)
+
+        self.respond(200, openapi_spec("/orders", "/customers"), etag='"v2"')
+        self.assertTrue(api_specs.refresh(self.data))
+        self.assertNotEqual(self.data.spec_hash, spec_hash)
+        self.assertEqual(api_specs.load(self.data.id)["etag"], '"v2"')
+
+    def test_force_refetches_in_full(self):
+        self.respond(200, openapi_spec("/orders"), etag='"v1"')
+        api_specs.refresh(self.data)
+        self.assertFalse(api_specs.refresh(self.data, force=True))
+        self.assertEqual(self.get.call_args.kwargs["headers"], {})
+
+    def test_get_serves_the_reduced_spec_from_memory(self):
+        self.respond(200, openapi_spec("/orders"), etag='"v1"')
+        spec = api_specs.get(self.data)
+        self.assertEqual([name for name, _, _ in spec.endpoints], ["GET /orders"])
+        self.assertIs(api_specs.get(self.data), spec)
+        self.assertEqual(self.get.call_count, 1)
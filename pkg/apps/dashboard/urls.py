@@ -8,4 +8,5 @@ urlpatterns = [
     path("", views.DashboardView.as_view(), name="dashboard"),
     path("new/<slug:data_type>/", views.AddDataView.as_view(), name="data_add"),
     path("<str:pk>/", views.chat, name="data_chat"),
+    path("<str:pk>/cancel/", views.chat_cancel, name="data_chat_cancel"),
 ]
\ No newline at end of file
@@ -1,14 +1,20 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.http import HttpResponse
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic import ListView
 from django.views.generic import View
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
 
 from .models import Data, Message
 from .decorators import require_HTMX
 from .forms import ChatForm, DatabaseForm, APIForm
+from .services import cancellation, fair_share, singleflight
 from . import tasks
 
 
@@ -34,10 +40,26 @@ def chat(request, pk):
         if form.is_valid():
             query = form.cleaned_data["message"]
             model = form.cleaned_data["model"]
+            use_cache = not form.cleaned_data["bypass_cache"]
             
             msg = Message.objects.create(source=data, text=query) # save user query to the database
             
-            tasks.return_query_resp.delay(query, user.id, data.id, model)
+            group = f"chat_{data.id}"
+            if not use_cache:
+                # a bypassed cache asks for a fresh answer: never share another question's
+                fair_share.submit(query, request.user.id, data.id, model, use_cache=False)
+                return render(request, "dashboard/partials/_msg.html", {"msg": msg})
+            
+            key = singleflight.flight_key(data.id, query, model)
+            status, msg_id = singleflight.join(key, group)
+            if status == singleflight.LEADER:
+                fair_share.submit(
+                    query, request.user.id, data.id, model, 
+                    flight_key=key, use_cache=use_cache
+                )
+            elif msg_id:
+                # identical question answered moments ago
+                tasks.send_message(group, msg_id)
             
             return render(request, "dashboard/partials/_msg.html", {"msg": msg})
         else:
@@ -47,11 +69,24 @@ def chat(request, pk):
     context = {
         "form": form,
         "messages": Message.objects.filter(source=data),
-        "data": data
+        "data": data,
+        "async_queries": settings.ASYNC_QUERY_EXECUTION,
     }
     return render(request, "dashboard/partials/_chat.html", context)
 
 
+@login_required
+@require_HTMX
+@require_POST
+def chat_cancel(request, pk):
+    """Stop the questions of the data source: the chat's stop button."""
+    data = get_object_or_404(Data, id=pk, user=request.user)
+    cancellation.cancel(data)
+    # open chats drop their partial answers; ASGI processes cancel the questions they run
+    async_to_sync(get_channel_layer().group_send)(f"chat_{data.id}", {"type": "chat_cancel"})
+    return HttpResponse(status=204)
+
+
 @method_decorator(require_HTMX, name="dispatch")
 class AddDataView(View):
     def get(self, request, data_type, *args, **kwargs):
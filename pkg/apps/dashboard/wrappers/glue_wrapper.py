@@ -9,11 +9,91 @@ create and manage crawlers, databases, and jobs.
 """
 
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
 
+class CatalogCache:
+    """
+    Process-local copy of Data Catalog table definitions, per database.
+
+    Each table is kept with its `UpdateTime` and `VersionId`; a re-read keeps the
+    cached definition of every table whose version didn't move and records the
+    names of the ones that were added, updated or dropped, which `changed`
+    returns so callers only re-process those. A database read within `ttl`
+    seconds is served without calling Glue at all; `expire` forces a re-read
+    but keeps the versions to compare against.
+    """
+    def __init__(self, ttl=60 * 5):
+        self.ttl = ttl
+        self._databases = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def version(table):
+        return table.get('UpdateTime'), table.get('VersionId')
+
+    def fresh(self, db_name, max_age=None):
+        """The cached tables of `db_name` if read within `max_age` (default `ttl`) seconds, else None."""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._databases.get(db_name)
+            if entry is None or time.monotonic() - entry['fetched_at'] > max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(entry['tables'].values())
+
+    def merge(self, db_name, table):
+        """Return the cached definition when `table` is unchanged, plus whether it changed."""
+        with self._lock:
+            cached = self._databases.get(db_name, {}).get('tables', {}).get(table['Name'])
+        if cached is not None and self.version(cached) == self.version(table):
+            return cached, False
+        return table, True
+
+    def store(self, db_name, tables, changed=()):
+        """Cache a full read of `db_name`; `changed` names the tables `merge` reported, drops are added here."""
+        tables = {table['Name']: table for table in tables}
+        with self._lock:
+            previous = self._databases.get(db_name, {}).get('tables', {})
+            self._databases[db_name] = {
+                'fetched_at': time.monotonic(),
+                'tables': tables,
+                'changed': sorted(set(changed) | (previous.keys() - tables.keys())),
+            }
+
+    def changed(self, db_name):
+        """Names of the tables added, updated or dropped at the last re-read of `db_name`, None if never read."""
+        with self._lock:
+            entry = self._databases.get(db_name)
+            return None if entry is None else list(entry['changed'])
+
+    def expire(self, db_name):
+        """Make the next read of `db_name` go to Glue, still comparing against the cached versions."""
+        with self._lock:
+            entry = self._databases.get(db_name)
+            if entry is not None:
+                entry['fetched_at'] = float('-inf')
+
+    def invalidate(self, db_name=None):
+        with self._lock:
+            if db_name is None:
+                self._databases.clear()
+            else:
+                self._databases.pop(db_name, None)
+
+
+catalog_cache = CatalogCache()
+
+
 # snippet-start:[python.example_code.glue.GlueWrapper.full]
 # snippet-start:[python.example_code.glue.GlueWrapper.decl]
 class GlueWrapper:
@@ -25,6 +105,32 @@ class GlueWrapper:
         self.glue_client = glue_client
 # snippet-end:[python.example_code.glue.GlueWrapper.decl]
 
+    def paginate(self, operation, result_key, **kwargs):
+        """
+        Yields every item of a paged Glue list operation.
+
+        :param operation: The client method name, such as 'get_tables'.
+        :param result_key: The response key holding the items, such as 'TableList'.
+        :param kwargs: Parameters of the operation.
+        """
+        try:
+            if self.glue_client.can_paginate(operation):
+                for page in self.glue_client.get_paginator(operation).paginate(**kwargs):
+                    yield from page.get(result_key, [])
+                return
+            # Operations without a botocore paginator page by NextToken
+            while True:
+                response = getattr(self.glue_client, operation)(**kwargs)
+                yield from response.get(result_key, [])
+                if not response.get('NextToken'):
+                    return
+                kwargs['NextToken'] = response['NextToken']
+        except ClientError as err:
+            logger.error(
+                "Couldn't %s. Here's why: %s: %s", operation,
+                err.response['Error']['Code'], err.response['Error']['Message'])
+            raise
+
     # snippet-start:[python.example_code.glue.GetCrawler]
     def get_crawler(self, name):
         """
@@ -83,7 +189,7 @@ class GlueWrapper:
                     "UpdateBehavior": "UPDATE_IN_DATABASE",
                     "DeleteBehavior": "DEPRECATE_IN_DATABASE"
                 },
-                Schedule=cron(15 12 * * ? *), # Can be changed later on
+                Schedule="cron(15 12 * * ? *)", # Can be changed later on
                 TablePrefix=db_prefix,
                 Targets=target
             )
@@ -147,22 +253,52 @@ class GlueWrapper:
     # snippet-end:[python.example_code.glue.GetDatabase]
 
     # snippet-start:[python.example_code.glue.GetTables]
-    def get_tables(self, db_name):
+    def iter_tables(self, db_name):
         """
-        Gets a list of tables in a Data Catalog database.
+        Yields every table of a Data Catalog database, page by page.
 
         :param db_name: The name of the database to query.
-        :return: The list of tables in the database.
         """
-        try:
-            response = self.glue_client.get_tables(DatabaseName=db_name)
-        except ClientError as err:
-            logger.error(
-                "Couldn't get tables %s. Here's why: %s: %s", db_name,
-                err.response['Error']['Code'], err.response['Error']['Message'])
-            raise
-        else:
-            return response['TableList']
+        yield from self.paginate('get_tables', 'TableList', DatabaseName=db_name)
+
+    def get_tables(self, db_name, cache=catalog_cache, max_age=None):
+        """
+        Gets the list of tables in a Data Catalog database.
+
+        :param db_name: The name of the database to query.
+        :param cache: The CatalogCache to serve and refresh, or None to always read Glue.
+        :param max_age: Serve a cached read up to this many seconds old (default: the cache's ttl),
+                        0 to always re-read.
+        :return: The list of tables in the database. The names of the tables that
+                 changed since the previous read are in `cache.changed(db_name)`.
+        """
+        if cache is None:
+            return list(self.iter_tables(db_name))
+        cached = cache.fresh(db_name, max_age)
+        if cached is not None:
+            return cached
+        tables, changed = [], []
+        for table in self.iter_tables(db_name):
+            table, is_changed = cache.merge(db_name, table)
+            tables.append(table)
+            if is_changed:
+                changed.append(table['Name'])
+        cache.store(db_name, tables, changed)
+        logger.info("Read %s tables of %s, %s changed", len(tables), db_name, len(cache.changed(db_name)))
+        return tables
+
+    def get_tables_batch(self, db_names, max_workers=8, **kwargs):
+        """
+        Gets the tables of several databases concurrently.
+
+        :param db_names: The names of the databases to query.
+        :param max_workers: The number of databases read at the same time.
+        :return: A dict of database name to its list of tables.
+        """
+        db_names = list(db_names)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(db_names)))) as executor:
+            results = executor.map(lambda name: self.get_tables(name, **kwargs), db_names)
+            return dict(zip(db_names, results))
     # snippet-end:[python.example_code.glue.GetTables]
 
     # snippet-start:[python.example_code.glue.CreateJob]
@@ -225,24 +361,30 @@ class GlueWrapper:
     # snippet-end:[python.example_code.glue.StartJobRun]
 
     # snippet-start:[python.example_code.glue.ListJobs]
+    def iter_jobs(self):
+        """
+        Yields the names of job definitions in your account, page by page.
+        """
+        yield from self.paginate('list_jobs', 'JobNames')
+
     def list_jobs(self):
         """
         Lists the names of job definitions in your account.
 
         :return: The list of job definition names.
         """
-        try:
-            response = self.glue_client.list_jobs()
-        except ClientError as err:
-            logger.error(
-                "Couldn't list jobs. Here's why: %s: %s",
-                err.response['Error']['Code'], err.response['Error']['Message'])
-            raise
-        else:
-            return response['JobNames']
+        return list(self.iter_jobs())
     # snippet-end:[python.example_code.glue.ListJobs]
 
     # snippet-start:[python.example_code.glue.GetJobRuns]
+    def iter_job_runs(self, job_name):
+        """
+        Yields the runs of a job definition, newest first, page by page.
+
+        :param job_name: The name of the job definition to look up.
+        """
+        yield from self.paginate('get_job_runs', 'JobRuns', JobName=job_name)
+
     def get_job_runs(self, job_name):
         """
         Gets information about runs that have been performed for a specific job
@@ -251,15 +393,7 @@ class GlueWrapper:
         :param job_name: The name of the job definition to look up.
         :return: The list of job runs.
         """
-        try:
-            response = self.glue_client.get_job_runs(JobName=job_name)
-        except ClientError as err:
-            logger.error(
-                "Couldn't get job runs for %s. Here's why: %s: %s", job_name,
-                err.response['Error']['Code'], err.response['Error']['Message'])
-            raise
-        else:
-            return response['JobRuns']
+        return list(self.iter_job_runs(job_name))
     # snippet-end:[python.example_code.glue.GetJobRuns]
 
     # snippet-start:[python.example_code.glue.GetJobRun]
@@ -309,6 +443,7 @@ class GlueWrapper:
         """
         try:
             self.glue_client.delete_table(DatabaseName=db_name, Name=table_name)
+            catalog_cache.invalidate(db_name)
         except ClientError as err:
             logger.error(
                 "Couldn't delete table %s. Here's why: %s: %s", table_name,
@@ -325,6 +460,7 @@ class GlueWrapper:
         """
         try:
             self.glue_client.delete_database(Name=name)
+            catalog_cache.invalidate(name)
         except ClientError as err:
             logger.error(
                 "Couldn't delete database %s. Here's why: %s: %s", name,
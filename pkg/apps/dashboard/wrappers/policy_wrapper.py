@@ -14,13 +14,14 @@ import operator
 import pprint
 import time
 
-import boto3
 from botocore.exceptions import ClientError
 
+from common import aws
+
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
-iam = boto3.resource('iam')
+iam = aws.LazyResource('iam')
 # snippet-end:[python.example_code.iam.policy_wrapper.imports]
 
 
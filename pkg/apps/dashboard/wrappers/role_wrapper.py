@@ -12,11 +12,12 @@ import json
 import logging
 import pprint
 
-import boto3
 from botocore.exceptions import ClientError
 
+from common import aws
+
 logger = logging.getLogger(__name__)
-iam = boto3.resource('iam')
+iam = aws.LazyResource('iam')
 # snippet-end:[python.example_code.iam.role_wrapper.imports]
 
 
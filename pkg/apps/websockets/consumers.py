@@ -3,7 +3,9 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
 from django.template.loader import render_to_string
-from apps.dashboard.models import Message
+from apps.dashboard.forms import ChatForm
+from apps.dashboard.models import Data, Message
+from apps.dashboard.services import async_queries, singleflight
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -21,6 +23,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # Receive message from WebSocket
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
+        if "message" in text_data_json:
+            await self.ask(text_data_json)
+            return
         msg_id = text_data_json["msg_id"]
         # Send message to room group
         await self.channel_layer.group_send(
@@ -41,7 +46,77 @@ class ChatConsumer(AsyncWebsocketConsumer):
             {"msg": msg}
         )
         
-        await self.send(text_data=json.dumps({"message": message}))
+        # stream_id lets the client replace the partial answer with the final one
+        await self.send(text_data=json.dumps({
+            "message": message, 
+            "stream_id": event.get("stream_id")
+        }))
+    
+    # Receive a partial answer (tokens or agent step) from room group
+    async def chat_stream(self, event):
+        await self.send(text_data=json.dumps({
+            "stream_id": event["stream_id"],
+            "kind": event["kind"],
+            "text": event["text"],
+        }))
+    
+    # The questions of this source were stopped (views.chat_cancel)
+    async def chat_cancel(self, event):
+        async_queries.cancel(self.data_id)
+        await self.send(text_data=json.dumps({"cancelled": True}))
+    
+    # Receive the outcome of a Glue crawl of this source from room group
+    async def crawl_status(self, event):
+        await self.send(text_data=json.dumps({
+            "crawl": {
+                "id": event["crawl_id"],
+                "state": event["state"],
+                "error_message": event["error_message"],
+            }
+        }))
+    
+    # Answer a question on this process' event loop (ASYNC_QUERY_EXECUTION)
+    async def ask(self, payload):
+        data = await self.get_data()
+        form = ChatForm(payload)
+        if data is None or not form.is_valid():
+            return
+        question = form.cleaned_data["message"]
+        model = form.cleaned_data["model"]
+        use_cache = not form.cleaned_data["bypass_cache"]
+        
+        msg = await database_sync_to_async(Message.objects.create)(source=data, text=question)
+        await self.channel_layer.group_send(
+            self.room_group_name, {"type": "chat_message", "msg_id": str(msg.id)}
+        )
+        
+        if not use_cache:
+            # a bypassed cache asks for a fresh answer: never share another question's
+            await self.submit(data, question, model, None, use_cache)
+            return
+        
+        key = singleflight.flight_key(data.id, question, model)
+        status, msg_id = await database_sync_to_async(singleflight.join)(key, self.room_group_name)
+        if status == singleflight.LEADER:
+            await self.submit(data, question, model, key, use_cache)
+        elif msg_id:
+            # identical question answered moments ago
+            await self.channel_layer.group_send(
+                self.room_group_name, {"type": "chat_message", "msg_id": msg_id}
+            )
+    
+    async def submit(self, data, question, model, flight_key, use_cache):
+        if async_queries.supports_async(data):
+            async_queries.submit(question, data.user_id, data.id, model, flight_key=flight_key, use_cache=use_cache)
+        else:
+            await async_queries.enqueue(question, data.user_id, data.id, model, flight_key, use_cache)
+    
+    @database_sync_to_async
+    def get_data(self):
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            return None
+        return Data.objects.filter(id=self.data_id, user=user).first()
     
     @database_sync_to_async
     def get_msg(self, msg_id):
@@ -0,0 +1,153 @@
+"""
+Shared boto3 clients.
+
+Clients are built lazily, once per process for each (service, region,
+credentials), with one botocore config: a connection pool of
+AWS_MAX_POOL_CONNECTIONS and adaptive retries. Built clients are thread-safe
+and shared by every Celery thread; only creation is serialized, since boto3
+sessions aren't. Call latency and retry counts per service are collected from
+botocore events and exposed by `stats()`.
+"""
+import hashlib
+import threading
+import time
+from collections import defaultdict
+
+import boto3
+from botocore.config import Config
+from django.conf import settings
+
+_sessions = {}
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+
+class ClientMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._services = defaultdict(lambda: {
+            "calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0,
+        })
+
+    def before_call(self, context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+
+    def _record(self, event_name, context, retries, error=False):
+        started = context.get("metrics_started")
+        elapsed = (time.perf_counter() - started) * 1000 if started else 0.0
+        # event names are "<event>.<service id>.<operation>"
+        with self._lock:
+            service = self._services[event_name.split(".")[1]]
+            service["calls"] += 1
+            service["errors"] += error
+            service["retries"] += retries
+            service["total_ms"] += elapsed
+            service["max_ms"] = max(service["max_ms"], elapsed)
+
+    def after_call(self, parsed, context, event_name, **kwargs):
+        # retries are done by then; error responses still arrive here before ClientError is raised
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        self._record(event_name, context, retries, error="Error" in parsed)
+
+    def after_call_error(self, context, event_name, **kwargs):
+        # connection errors and the like, raised without a parsed response
+        self._record(event_name, context, 0, error=True)
+
+    def register(self, client):
+        events = client.meta.events
+        events.register("before-call", self.before_call)
+        events.register("after-call", self.after_call)
+        events.register("after-call-error", self.after_call_error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    **service,
+                    "avg_ms": round(service["total_ms"] / service["calls"], 2) if service["calls"] else 0.0,
+                    "total_ms": round(service["total_ms"], 2),
+                    "max_ms": round(service["max_ms"], 2),
+                }
+                for name, service in self._services.items()
+            }
+
+
+metrics = ClientMetrics()
+
+
+def get_config():
+    return Config(
+        max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+        retries={"mode": settings.AWS_RETRY_MODE, "max_attempts": settings.AWS_MAX_ATTEMPTS},
+        connect_timeout=settings.AWS_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_READ_TIMEOUT,
+    )
+
+
+def _credentials_key(aws_access_key_id, aws_secret_access_key):
+    if not aws_access_key_id:
+        return None
+    secret = hashlib.sha1((aws_secret_access_key or "").encode()).hexdigest()[:12]
+    return f"{aws_access_key_id}:{secret}"
+
+
+def _session(credentials, aws_access_key_id, aws_secret_access_key):
+    # callers hold _lock
+    session = _sessions.get(credentials)
+    if session is None:
+        session = _sessions[credentials] = boto3.session.Session(
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+        )
+    return session
+
+
+def get_client(service, region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
+    """Shared client of `service`; default region and credentials come from the environment."""
+    credentials = _credentials_key(aws_access_key_id, aws_secret_access_key)
+    key = (service, region_name, credentials)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                session = _session(credentials, aws_access_key_id, aws_secret_access_key)
+                client = session.client(service, region_name=region_name, config=get_config())
+                metrics.register(client)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service, region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
+    """Shared resource of `service`. Resources aren't thread-safe; use them from one thread or get a client."""
+    credentials = _credentials_key(aws_access_key_id, aws_secret_access_key)
+    key = (service, region_name, credentials)
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                session = _session(credentials, aws_access_key_id, aws_secret_access_key)
+                resource = session.resource(service, region_name=region_name, config=get_config())
+                metrics.register(resource.meta.client)
+                _resources[key] = resource
+    return resource
+
+
+class LazyResource:
+    """Module-level stand-in for a resource that is only built on first use."""
+    def __init__(self, service, **kwargs):
+        self._service = service
+        self._kwargs = kwargs
+
+    def __getattr__(self, name):
+        return getattr(get_resource(self._service, **self._kwargs), name)
+
+
+def stats():
+    return {
+        "clients": len(_clients),
+        "resources": len(_resources),
+        "services": metrics.stats(),
+    }
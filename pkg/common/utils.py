@@ -1,3 +1,7 @@
+from functools import lru_cache
+
+import redis
+from django.conf import settings
 from rest_framework.exceptions import APIException
 from rest_framework.views import exception_handler
 
@@ -25,3 +29,9 @@ def get_client_ip(request):
         return x_forwarded_for.split(',')[0]
 
     return request.META['REMOTE_ADDR']
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    """Process-wide Redis client on REDIS_URL, shared by the caches and coordination helpers"""
+    return redis.Redis.from_url(settings.REDIS_URL)
@@ -7,6 +7,7 @@ import os
 import datetime
 import environ
 import dj_database_url
+from kombu import Queue
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -356,6 +357,179 @@ USER_DOCUMENTS_NUMBER_LIMIT = env.int("USER_DOCUMENTS_NUMBER_LIMIT", default=10)
 OPENAI_API_KEY = env("OPENAI_API_KEY")
 ANTHROPIC_API_KEY = env("ANTHROPIC_API_KEY")
 
+# Built agents kept per worker process, evicted LRU or after AGENT_CACHE_TTL idle seconds
+AGENT_CACHE_MAX_SIZE = env.int("AGENT_CACHE_MAX_SIZE", default=32)
+AGENT_CACHE_TTL = env.int("AGENT_CACHE_TTL", default=60 * 15)
+
+# Sources with more tables than this only hand the TABLE_PRUNING_TOP_K most
+# relevant ones (plus their foreign key targets) to the SQL agent
+TABLE_PRUNING_THRESHOLD = env.int("TABLE_PRUNING_THRESHOLD", default=30)
+TABLE_PRUNING_TOP_K = env.int("TABLE_PRUNING_TOP_K", default=8)
+
+# Queries of up to FEW_SHOT_EXAMPLES similar past questions (0 disables) are handed
+# to the SQL agent with a new question, if at least FEW_SHOT_MIN_SIMILARITY alike
+FEW_SHOT_EXAMPLES = env.int("FEW_SHOT_EXAMPLES", default=3)
+FEW_SHOT_MIN_SIMILARITY = env.float("FEW_SHOT_MIN_SIMILARITY", default=0.2)
+
+# Usage rows are buffered in Redis and written every USAGE_FLUSH_INTERVAL seconds
+# or as soon as USAGE_FLUSH_ROWS are waiting
+USAGE_FLUSH_ROWS = env.int("USAGE_FLUSH_ROWS", default=200)
+USAGE_FLUSH_INTERVAL = env.int("USAGE_FLUSH_INTERVAL", default=10)
+
+# A TRACE_SAMPLE_RATE share of questions is traced step by step (see dashboard.services.tracing);
+# traces are buffered like usage rows and kept TRACE_RETENTION_DAYS. The admin's p50/p95
+# are computed over the latest TRACE_STATS_WINDOW traces of the filtered list.
+TRACE_SAMPLE_RATE = env.float("TRACE_SAMPLE_RATE", default=1.0)
+TRACE_FLUSH_ROWS = env.int("TRACE_FLUSH_ROWS", default=200)
+TRACE_FLUSH_INTERVAL = env.int("TRACE_FLUSH_INTERVAL", default=10)
+TRACE_RETENTION_DAYS = env.int("TRACE_RETENTION_DAYS", default=14)
+TRACE_STATS_WINDOW = env.int("TRACE_STATS_WINDOW", default=1000)
+
+# Requests and tokens per minute allowed per OpenAI key, per user and per data source
+LLM_RATE_LIMITS = {
+    "key": {
+        "rpm": env.int("LLM_KEY_RPM", default=3500),
+        "tpm": env.int("LLM_KEY_TPM", default=90000),
+    },
+    "user": {
+        "rpm": env.int("LLM_USER_RPM", default=20),
+        "tpm": env.int("LLM_USER_TPM", default=40000),
+    },
+    "data": {
+        "rpm": env.int("LLM_DATA_RPM", default=30),
+        "tpm": env.int("LLM_DATA_TPM", default=60000),
+    },
+}
+# Tokens reserved when nothing better is known, and per LLM call for the completion on top
+# of its counted prompt; the difference to the tokens used is settled after the call
+LLM_ESTIMATED_TOKENS = env.int("LLM_ESTIMATED_TOKENS", default=2000)
+LLM_ESTIMATED_COMPLETION_TOKENS = env.int("LLM_ESTIMATED_COMPLETION_TOKENS", default=256)
+LLM_MAX_CONCURRENT_PER_USER = env.int("LLM_MAX_CONCURRENT_PER_USER", default=2)
+LLM_SLOT_TIMEOUT = env.int("LLM_SLOT_TIMEOUT", default=60 * 5)
+LLM_SLOT_RETRY_DELAY = env.int("LLM_SLOT_RETRY_DELAY", default=2)
+
+# Fair-share dispatch of chat questions: questions on the broker at once (about the
+# concurrency of the chat workers), per user, and how long a dispatched question may hold its slot
+FAIR_SHARE_MAX_IN_FLIGHT = env.int("FAIR_SHARE_MAX_IN_FLIGHT", default=8)
+FAIR_SHARE_MAX_IN_FLIGHT_PER_USER = env.int("FAIR_SHARE_MAX_IN_FLIGHT_PER_USER", default=2)
+FAIR_SHARE_TIMEOUT = env.int("FAIR_SHARE_TIMEOUT", default=60 * 10)
+# Share of dispatch turns per subscription plan. Subscribers are put in a group named after
+# the slugified Stripe product (see finances.utils.add_subscriber_to_group); plans outside
+# the pricing page can be weighted with FAIR_SHARE_WEIGHTS=plan-slug=weight,other-plan=weight
+FAIR_SHARE_WEIGHTS = {
+    "free": env.int("FAIR_SHARE_WEIGHT_FREE", default=1),
+    "pro": env.int("FAIR_SHARE_WEIGHT_PRO", default=4),
+    "enterprise": env.int("FAIR_SHARE_WEIGHT_ENTERPRISE", default=8),
+    **env.dict("FAIR_SHARE_WEIGHTS", cast={"value": int}, default={}),
+}
+# Users without a weighted plan, e.g. on the trial
+FAIR_SHARE_DEFAULT_WEIGHT = env.int("FAIR_SHARE_DEFAULT_WEIGHT", default=1)
+
+
+#-----------------------------------
+# DATA SOURCE CONNECTION POOLS
+#-----------------------------------
+DATA_SOURCE_POOL_SIZE = env.int("DATA_SOURCE_POOL_SIZE", default=5)
+DATA_SOURCE_POOL_MAX_OVERFLOW = env.int("DATA_SOURCE_POOL_MAX_OVERFLOW", default=5)
+DATA_SOURCE_POOL_RECYCLE = env.int("DATA_SOURCE_POOL_RECYCLE", default=60 * 30)
+DATA_SOURCE_POOL_PRE_PING = env.bool("DATA_SOURCE_POOL_PRE_PING", default=True)
+DATA_SOURCE_POOL_IDLE_TIMEOUT = env.int("DATA_SOURCE_POOL_IDLE_TIMEOUT", default=60 * 30)
+# Seconds a statement may run on a data source before the database cancels it
+DATA_SOURCE_STATEMENT_TIMEOUT = env.int("DATA_SOURCE_STATEMENT_TIMEOUT", default=60)
+
+
+#-----------------------------------
+# SINGLE-FLIGHT QUESTIONS
+#-----------------------------------
+# Upper bound on how long duplicates wait on a running question
+SINGLE_FLIGHT_TIMEOUT = env.int("SINGLE_FLIGHT_TIMEOUT", default=60 * 5)
+# How long a finished answer is handed to identical questions arriving late
+SINGLE_FLIGHT_RESULT_TTL = env.int("SINGLE_FLIGHT_RESULT_TTL", default=30)
+# How long stopping a chat is remembered, so queued questions of the source are dropped when they start
+QUESTION_CANCEL_TTL = env.int("QUESTION_CANCEL_TTL", default=60 * 60)
+
+# Schema snapshots of database sources are checked for changes this often
+SCHEMA_REFRESH_INTERVAL = env.int("SCHEMA_REFRESH_INTERVAL", default=60 * 60)
+
+# OpenAPI specs of API sources are reduced once and revalidated every
+# API_SPEC_REFRESH_INTERVAL seconds with a conditional GET
+API_SPEC_REFRESH_INTERVAL = env.int("API_SPEC_REFRESH_INTERVAL", default=60 * 15)
+API_SPEC_FETCH_TIMEOUT = env.int("API_SPEC_FETCH_TIMEOUT", default=30)
+
+# Default lifetime of cached answers, overridable per source with Data.answer_cache_ttl
+ANSWER_CACHE_TTL = env.int("ANSWER_CACHE_TTL", default=60 * 60)
+
+# Executed SQL results: default freshness (Data.sql_cache_ttl overrides), largest
+# cacheable result and total bytes kept per data source
+SQL_RESULT_CACHE_TTL = env.int("SQL_RESULT_CACHE_TTL", default=60 * 5)
+SQL_RESULT_CACHE_MAX_BYTES = env.int("SQL_RESULT_CACHE_MAX_BYTES", default=64 * 1024)
+SQL_RESULT_CACHE_BUDGET = env.int("SQL_RESULT_CACHE_BUDGET", default=8 * 1024 * 1024)
+
+# Guard on the agent's SQL: row limit added to every query (Data.query_row_limit
+# overrides), rows a query over its cost budget is sampled at instead, and the
+# most bytes of a result handed back to the agent
+SQL_GUARD_ROW_LIMIT = env.int("SQL_GUARD_ROW_LIMIT", default=1000)
+SQL_GUARD_SAMPLE_ROWS = env.int("SQL_GUARD_SAMPLE_ROWS", default=10)
+SQL_GUARD_MAX_BYTES = env.int("SQL_GUARD_MAX_BYTES", default=32 * 1024)
+# EXPLAIN cost budget per dialect (Data.query_cost_limit overrides): planner cost
+# for PostgreSQL and MySQL, partitions scanned for Snowflake; no check elsewhere
+SQL_GUARD_COST_LIMITS = {
+    "postgresql": 1_000_000,
+    "mysql": 1_000_000,
+    "snowflake": 10_000,
+}
+
+
+#-----------------------------------
+# ASYNC QUERY EXECUTION
+#-----------------------------------
+# Answer database questions on the ASGI event loop instead of queueing them on Celery
+ASYNC_QUERY_EXECUTION = env.bool("ASYNC_QUERY_EXECUTION", default=False)
+# Questions running at once per ASGI process; the rest go to Celery
+ASYNC_QUERY_CONCURRENCY = env.int("ASYNC_QUERY_CONCURRENCY", default=16)
+
+
+#-----------------------------------
+# WORKER WARM-UP
+#-----------------------------------
+# On start, workers fetch credentials and build engines and agents for the sources
+# asked about most recently, for at most WORKER_WARMUP_BUDGET seconds. Agents reflect
+# the tables the last WORKER_WARMUP_QUESTIONS questions of their source were pruned to
+WORKER_WARMUP = env.bool("WORKER_WARMUP", default=True)
+WORKER_WARMUP_SOURCES = env.int("WORKER_WARMUP_SOURCES", default=20)
+WORKER_WARMUP_BUDGET = env.int("WORKER_WARMUP_BUDGET", default=30)
+WORKER_WARMUP_THREADS = env.int("WORKER_WARMUP_THREADS", default=4)
+WORKER_WARMUP_MODELS = env.list("WORKER_WARMUP_MODELS", default=["gpt-3"])
+WORKER_WARMUP_QUESTIONS = env.int("WORKER_WARMUP_QUESTIONS", default=20)
+
+
+#-----------------------------------
+# AWS CLIENTS
+#-----------------------------------
+# Shared by every thread of a process, see common.aws
+AWS_MAX_POOL_CONNECTIONS = env.int("AWS_MAX_POOL_CONNECTIONS", default=50)
+AWS_RETRY_MODE = env("AWS_RETRY_MODE", default="adaptive")
+AWS_MAX_ATTEMPTS = env.int("AWS_MAX_ATTEMPTS", default=5)
+AWS_CONNECT_TIMEOUT = env.int("AWS_CONNECT_TIMEOUT", default=5)
+AWS_READ_TIMEOUT = env.int("AWS_READ_TIMEOUT", default=30)
+
+# Data source credentials are cached per process for SECRET_CACHE_TTL seconds and
+# reloaded in the background during the last SECRET_CACHE_REFRESH_AHEAD seconds
+SECRET_CACHE_TTL = env.int("SECRET_CACHE_TTL", default=60 * 5)
+SECRET_CACHE_REFRESH_AHEAD = env.int("SECRET_CACHE_REFRESH_AHEAD", default=60)
+# AWSPENDING only exists during a rotation, keep it short
+SECRET_CACHE_PENDING_TTL = env.int("SECRET_CACHE_PENDING_TTL", default=30)
+
+
+#-----------------------------------
+# GLUE CRAWLS
+#-----------------------------------
+# Crawler status polls back off from the initial to the max delay (seconds)
+CRAWL_POLL_INITIAL_DELAY = env.int("CRAWL_POLL_INITIAL_DELAY", default=5)
+CRAWL_POLL_MAX_DELAY = env.int("CRAWL_POLL_MAX_DELAY", default=60)
+# A crawl still running after this long is marked failed
+CRAWL_TIMEOUT = env.int("CRAWL_TIMEOUT", default=60 * 60 * 3)
+
 
 #-----------------------------------
 # REDIS DEFINITION 
@@ -370,5 +544,70 @@ CELERY_RESULT_BACKEND = 'django-db'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
+
+# Interactive chat, schema ingestion, email and Stripe work run on their own queues
+# so each gets its own workers (see config.conf for per-queue concurrency)
+CELERY_TASK_DEFAULT_QUEUE = "default"
+CELERY_TASK_QUEUES = (
+    Queue("chat"),
+    Queue("ingestion"),
+    Queue("email"),
+    Queue("webhooks"),
+    Queue("default"),
+)
+CELERY_TASK_ROUTES = {
+    "apps.dashboard.tasks.return_query_resp": {"queue": "chat", "priority": 0},
+    "apps.dashboard.tasks.drain_fair_share": {"queue": "chat", "priority": 0},
+    "apps.dashboard.tasks.refresh_schema*": {"queue": "ingestion", "priority": 6},
+    "apps.dashboard.tasks.refresh_api_spec*": {"queue": "ingestion", "priority": 6},
+    "apps.dashboard.tasks.crawl*": {"queue": "ingestion", "priority": 6},
+    "config.celery.send_mail": {"queue": "email", "priority": 3},
+    "apps.finances.*": {"queue": "webhooks", "priority": 3},
+}
+# Redis emulates priorities with one list per step; 0 is served first
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+}
+# Reserve one task per process so a long ingestion job doesn't hold queued questions hostage
+CELERY_WORKER_PREFETCH_MULTIPLIER = env.int("CELERY_WORKER_PREFETCH_MULTIPLIER", default=1)
 # this allows you to schedule items in the Django admin.
-CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers.DatabaseScheduler'
\ No newline at end of file
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers.DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    "flush-usage": {
+        "task": "apps.dashboard.tasks.flush_usage",
+        "schedule": USAGE_FLUSH_INTERVAL,
+    },
+    "flush-traces": {
+        "task": "apps.dashboard.tasks.flush_traces",
+        "schedule": TRACE_FLUSH_INTERVAL,
+    },
+    "prune-traces": {
+        "task": "apps.dashboard.tasks.prune_traces",
+        "schedule": 60 * 60 * 24,
+    },
+    "drain-fair-share": {
+        "task": "apps.dashboard.tasks.drain_fair_share",
+        "schedule": 15,
+    },
+    "refresh-schemas": {
+        "task": "apps.dashboard.tasks.refresh_schemas",
+        "schedule": SCHEMA_REFRESH_INTERVAL,
+        # also matched by the refresh_schema* route; explicit so a route change can't move it to the chat queue
+        "options": {"queue": "ingestion"},
+    },
+    "refresh-api-specs": {
+        "task": "apps.dashboard.tasks.refresh_api_specs",
+        "schedule": API_SPEC_REFRESH_INTERVAL,
+    },
+    "dispose-idle-engines": {
+        "task": "apps.dashboard.tasks.dispose_idle_engines",
+        "schedule": 60 * 5,
+    },
+    "crawl-resume": {
+        "task": "apps.dashboard.tasks.crawl_resume",
+        "schedule": 60 * 5,
+    },
+}
\ No newline at end of file